@@ -1,9 +1,13 @@
+import asyncio
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from .routes.search import router as search_router
 from .routes.health import router as health_router
 from .routes.metrics import router as metrics_router
 from .routes.analytics import router as analytics_router
+from .services.vector_index import load_index
+from .services.http_pool import start_session, close_session
+from .services.analytics_writer import analytics
 
 app = FastAPI(title="SwagAI API", version="1.0")
 
@@ -19,3 +23,16 @@ app.include_router(health_router, prefix="/api")
 app.include_router(search_router, prefix="/api")
 app.include_router(metrics_router, prefix="/api")
 app.include_router(analytics_router, prefix="/api")
+
+@app.on_event("startup")
+async def startup():
+    await start_session()
+    analytics.start()
+    # load in the background; searches use the RPC until the index is ready
+    app.state.index_task = asyncio.create_task(load_index())
+
+@app.on_event("shutdown")
+async def shutdown():
+    # flush queued analytics while the HTTP session is still open
+    await analytics.stop()
+    await close_session()
@@ -1,6 +1,13 @@
 import os, datetime
 from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import PlainTextResponse
 from ..services.supabase_client import fetch_recent_events
+from ..services.http_pool import pool_stats
+from ..services.hf_client import hf_stats
+from ..services.embedding_cache import embedding_cache
+from ..services.rate_limit import rate_limit_stats
+from ..services.analytics_writer import analytics
+from ..services.tracing import render_prometheus, tracing_stats
 
 router = APIRouter()
 
@@ -10,4 +17,9 @@ async def metrics(key: str = Query("")):
         raise HTTPException(status_code=401, detail="unauthorized")
     rows = await fetch_recent_events(limit=50)
     avg_ms = int(sum(r.get("event_data",{}).get("search_time_ms",0) for r in rows if r.get("event_type")=="search_succeeded") / max(1, sum(1 for r in rows if r.get("event_type")=="search_succeeded")))
-    return {"recent": rows, "avg_search_time_ms": avg_ms}
+    return {"recent": rows, "avg_search_time_ms": avg_ms, "http_pool": pool_stats(), "hf": hf_stats(), "embed_cache": embedding_cache.snapshot(), "rate_limit": rate_limit_stats(), "stages": tracing_stats(), "analytics": analytics.snapshot()}
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Per-stage /api/search latency in the Prometheus text format"""
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,222 @@
+import os, json, time, asyncio, datetime
+from typing import Optional, List, Dict, Any
+from .supabase_client import insert_events
+
+# Buffered analytics: emit() puts the event on a bounded in-memory queue and
+# returns immediately; a background task bulk-inserts into analytics_events
+# every ANALYTICS_BATCH_SIZE events or ANALYTICS_FLUSH_INTERVAL seconds.
+#   - queue full -> the event is dropped and counted (requests never wait)
+#   - insert fails -> the batch is appended to a local JSONL spool, replayed
+#     after the next successful insert
+#   - shutdown -> the flusher is told to stop, sends what it holds and what's
+#     queued, and is only cancelled after SHUTDOWN_TIMEOUT; whatever is left
+#     then goes to the spool
+# Errors inside the loop are logged and the loop carries on.
+
+QUEUE_SIZE = int(os.getenv("ANALYTICS_QUEUE_SIZE", "10000"))
+BATCH_SIZE = int(os.getenv("ANALYTICS_BATCH_SIZE", "200"))
+FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", "2"))
+SPOOL_DIR = os.getenv("ANALYTICS_SPOOL_DIR", ".analytics_spool")  # empty disables the spool
+SPOOL_MAX_BYTES = int(os.getenv("ANALYTICS_SPOOL_MAX_BYTES", str(64 * 1024 * 1024)))
+SHUTDOWN_TIMEOUT = float(os.getenv("ANALYTICS_SHUTDOWN_TIMEOUT", "5"))
+
+
+class Spool:
+    """Append-only JSONL file of rows that couldn't be inserted"""
+
+    def __init__(self, root: str, max_bytes: int = SPOOL_MAX_BYTES):
+        self.path = os.path.join(root, "events.jsonl")
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def size(self) -> int:
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def append(self, rows: List[Dict[str, Any]]) -> int:
+        """Write rows; returns how many fit under max_bytes"""
+        os.makedirs(self.root, exist_ok=True)
+        budget = self.max_bytes - self.size()
+        lines = []
+        for row in rows:
+            line = json.dumps(row, separators=(",", ":")) + "\n"
+            budget -= len(line)
+            if budget < 0:
+                break
+            lines.append(line)
+        if lines:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.writelines(lines)
+        return len(lines)
+
+    def take(self) -> List[Dict[str, Any]]:
+        """Move the spool aside and return its rows (caller re-appends what it can't send)"""
+        claimed = f"{self.path}.{os.getpid()}.replay"
+        try:
+            os.replace(self.path, claimed)
+        except FileNotFoundError:
+            return []  # nothing spooled, or another worker claimed it first
+        rows = []
+        with open(claimed, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    continue  # torn last line from a crash
+        os.remove(claimed)
+        return rows
+
+
+class AnalyticsWriter:
+    def __init__(self, queue_size: int = QUEUE_SIZE, batch_size: int = BATCH_SIZE,
+                 flush_interval: float = FLUSH_INTERVAL, spool_dir: Optional[str] = SPOOL_DIR):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.spool = Spool(spool_dir) if spool_dir else None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = asyncio.Event()
+        self._batch: List[Dict[str, Any]] = []  # rows the flusher has taken off the queue but not yet written
+        self.stats = {"emitted": 0, "dropped": 0, "sent": 0, "batches": 0, "failed_batches": 0,
+                      "spooled": 0, "spool_dropped": 0, "replayed": 0}
+
+    def emit(self, event_type: str, event_data: dict):
+        """Queue an event without waiting; drops (and counts) it if the queue is full"""
+        row = {"event_type": event_type, "event_data": event_data,
+               "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat()}
+        try:
+            self.queue.put_nowait(row)
+            self.stats["emitted"] += 1
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._stopping.clear()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = SHUTDOWN_TIMEOUT):
+        """Let the flusher send its batch and the rest of the queue, then stop it"""
+        self._stopping.set()
+        task, self._task = self._task, None
+        if task is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(task), timeout)
+            except asyncio.TimeoutError:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+            except Exception as e:
+                print(f"DEBUG: analytics flusher failed: {e}")
+        # a cancelled flush may have landed already; a duplicate row beats a lost one
+        rows = self._batch + self._drain(self.queue.qsize())
+        self._batch = []
+        if rows:
+            await self._to_spool(rows)
+
+    def _drain(self, limit: int) -> List[Dict[str, Any]]:
+        rows = []
+        while len(rows) < limit:
+            try:
+                rows.append(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return rows
+
+    async def _get(self, timeout: Optional[float]) -> Optional[Dict[str, Any]]:
+        """Next queued row, or None on timeout or once stop() is called"""
+        if self._stopping.is_set():
+            return None
+        getter = asyncio.ensure_future(self.queue.get())
+        stopper = asyncio.ensure_future(self._stopping.wait())
+        try:
+            await asyncio.wait((getter, stopper), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stopper.cancel()
+            getter.cancel()
+        # a get that finished before the cancel keeps its row
+        return getter.result() if getter.done() and not getter.cancelled() else None
+
+    async def _run(self):
+        while True:
+            try:
+                # wait for the first event, then collect until the batch fills or the interval passes;
+                # once stopping, just take what's queued
+                self._batch = self._drain(self.batch_size)
+                if not self._batch:
+                    row = await self._get(None)
+                    if row is None:
+                        return  # stopping and the queue is empty
+                    self._batch.append(row)
+                deadline = time.monotonic() + self.flush_interval
+                while len(self._batch) < self.batch_size and not self._stopping.is_set():
+                    self._batch.extend(self._drain(self.batch_size - len(self._batch)))
+                    remaining = deadline - time.monotonic()
+                    if len(self._batch) >= self.batch_size or remaining <= 0:
+                        break
+                    row = await self._get(remaining)
+                    if row is not None:
+                        self._batch.append(row)
+                sent = await self._flush(self._batch)
+                self._batch = []
+                if sent and not self._stopping.is_set() and self.spool is not None and self.spool.size():
+                    await self._replay()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"DEBUG: analytics flusher error: {e}")
+                if self._batch:
+                    await self._to_spool(self._batch)
+                    self._batch = []
+
+    async def _flush(self, rows: List[Dict[str, Any]]) -> bool:
+        """Insert one batch; spools it on failure"""
+        try:
+            ok = await insert_events(rows)
+        except Exception as e:
+            print(f"DEBUG: analytics insert failed: {e}")
+            ok = False
+        if not ok:
+            self.stats["failed_batches"] += 1
+            await self._to_spool(rows)
+            return False
+        self.stats["sent"] += len(rows)
+        self.stats["batches"] += 1
+        return True
+
+    async def _to_spool(self, rows: List[Dict[str, Any]]):
+        if self.spool is None:
+            self.stats["dropped"] += len(rows)
+            return
+        try:
+            written = await asyncio.to_thread(self.spool.append, rows)
+        except OSError as e:
+            print(f"DEBUG: analytics spool write failed: {e}")
+            written = 0
+        self.stats["spooled"] += written
+        self.stats["spool_dropped"] += len(rows) - written
+
+    async def _replay(self):
+        rows = await asyncio.to_thread(self.spool.take)
+        for i in range(0, len(rows), self.batch_size):
+            chunk = rows[i:i + self.batch_size]
+            try:
+                ok = await insert_events(chunk)
+            except Exception:
+                ok = False
+            if not ok:
+                # DB went away again; keep the rest for next time
+                await self._to_spool(rows[i:])
+                return
+            self.stats["replayed"] += len(chunk)
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "queued": self.queue.qsize(), "running": self._task is not None and not self._task.done(),
+                "spool_bytes": self.spool.size() if self.spool is not None else 0}
+
+
+analytics = AnalyticsWriter()
@@ -0,0 +1,98 @@
+import os
+from typing import Optional, List, Dict, Any
+import numpy as np
+
+# Packed attribute bitmaps over the vector index's row order, for strict
+# (pre-filtered) search:
+#   brand / category / color: one bitmap per lower-cased value
+#   price: one bitmap per quantile bucket, plus the raw price column to
+#          refine the two buckets a range only partly covers
+# A Filters combination is ORs within a field and ANDs across fields on
+# n/8-byte arrays; the result is a row mask for a masked scan, so filtered
+# search costs the same however selective the filter is.
+
+PRICE_BUCKETS = int(os.getenv("VECTOR_INDEX_PRICE_BUCKETS", "32"))
+FIELDS = ("brand", "category", "color")
+
+
+def _key(value) -> str:
+    # same matching as search_products_filtered: lower(p.brand) = lower(brand_eq)
+    return str(value).strip().lower() if value else ""
+
+
+def _pack(rows: np.ndarray, n: int) -> np.ndarray:
+    bits = np.zeros(n, dtype=bool)
+    bits[rows] = True
+    return np.packbits(bits)
+
+
+class AttributeBitmaps:
+    def __init__(self, products: List[Dict[str, Any]], price_buckets: int = PRICE_BUCKETS):
+        self.n = len(products)
+        self.bitmaps: Dict[str, Dict[str, np.ndarray]] = {}
+        for field in FIELDS:
+            groups: Dict[str, List[int]] = {}
+            for row, p in enumerate(products):
+                key = _key(p.get(field))
+                if key:
+                    groups.setdefault(key, []).append(row)
+            self.bitmaps[field] = {key: _pack(np.asarray(rows), self.n) for key, rows in groups.items()}
+
+        price = np.array([float(p["price"]) if isinstance(p.get("price"), (int, float)) else np.nan
+                          for p in products], dtype=np.float64)
+        self.price = price
+        known = price[~np.isnan(price)]
+        # bucket i holds edges[i-1] <= price < edges[i]; NaN prices are in no bucket
+        self.price_edges = (np.unique(np.quantile(known, np.linspace(0, 1, price_buckets + 1)[1:-1]))
+                            if known.size else np.zeros(0))
+        bucket = np.searchsorted(self.price_edges, price, side="right")
+        bucket[np.isnan(price)] = -1
+        self.price_rows = [np.flatnonzero(bucket == b) for b in range(len(self.price_edges) + 1)]
+        self.price_bitmaps = [_pack(rows, self.n) for rows in self.price_rows]
+        self._empty = np.zeros((self.n + 7) // 8, dtype=np.uint8)
+
+    def stats(self) -> Dict[str, int]:
+        return {**{field: len(maps) for field, maps in self.bitmaps.items()}, "price_buckets": len(self.price_bitmaps)}
+
+    def _any_of(self, field: str, values: List[str]) -> np.ndarray:
+        packed = self._empty.copy()
+        for value in values:
+            bits = self.bitmaps[field].get(_key(value))
+            if bits is not None:
+                packed |= bits
+        return packed
+
+    def _price_range(self, lo: Optional[float], hi: Optional[float]) -> np.ndarray:
+        lo = -np.inf if lo is None else lo
+        hi = np.inf if hi is None else hi
+        bounds = np.concatenate(([-np.inf], self.price_edges, [np.inf]))
+        packed = self._empty.copy()
+        partial: List[np.ndarray] = []
+        for b, bits in enumerate(self.price_bitmaps):
+            start, end = bounds[b], bounds[b + 1]
+            if end <= lo or start > hi:
+                continue
+            if start >= lo and end <= hi:
+                packed |= bits
+            else:
+                partial.append(self.price_rows[b])
+        if partial:
+            rows = np.concatenate(partial)
+            p = self.price[rows]
+            packed |= _pack(rows[(p >= lo) & (p <= hi)], self.n)
+        return packed
+
+    def mask(self, filters) -> Optional[np.ndarray]:
+        """Boolean row mask for a Filters object, or None if it sets no filter"""
+        packed = None
+        for field in FIELDS:
+            values = getattr(filters, field, None)
+            if values:
+                bits = self._any_of(field, values)
+                packed = bits if packed is None else packed & bits
+        if filters.priceMin is not None or filters.priceMax is not None:
+            bits = self._price_range(filters.priceMin, filters.priceMax)
+            packed = bits if packed is None else packed & bits
+        if packed is None:
+            return None
+        return np.unpackbits(packed, count=self.n).view(bool)
@@ -0,0 +1,171 @@
+import os, json, time, asyncio, hashlib
+from collections import OrderedDict
+from typing import Optional, Callable, Awaitable, List, Tuple
+import numpy as np
+from .supabase_client import supa_select_cache, supa_insert_cache
+
+# Two-tier query embedding cache:
+#   1. in-process LRU/TTL holding float16 vectors (~2.3KB per 1152-d entry)
+#   2. persistent tier: the query_cache table (default) or a local directory
+# Reads go memory -> persistent -> compute; persistent writes happen in the background.
+
+MODEL_ID = os.getenv("EMBED_MODEL_ID", "google/siglip-so400m-patch14-384")
+MAX_ENTRIES = int(os.getenv("EMBED_CACHE_MAX_ENTRIES", "20000"))
+TTL = float(os.getenv("EMBED_CACHE_TTL", "86400"))
+PERSIST = os.getenv("EMBED_CACHE_PERSIST", "supabase")  # supabase | disk | off
+DISK_DIR = os.getenv("EMBED_CACHE_DIR", ".embed_cache")
+
+
+def cache_key(content_hash: str, bbox: Optional[str] = None, model_id: str = MODEL_ID) -> str:
+    """Key on model + image content + crop, so crops and model upgrades never collide."""
+    crop = ""
+    if bbox:
+        try:
+            box = json.loads(bbox)
+            crop = ",".join(f"{float(box[k]):.4f}" for k in ("x", "y", "w", "h"))
+        except Exception:
+            crop = bbox
+    return hashlib.sha256(f"{model_id}|{content_hash}|{crop}".encode("utf-8")).hexdigest()
+
+
+class MemoryTier:
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: "OrderedDict[str, Tuple[float, np.ndarray]]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires, vec = item
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return vec
+
+    def put(self, key: str, vec: np.ndarray):
+        self._data[key] = (time.monotonic() + self.ttl, vec.astype(np.float16))
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+
+class DiskTier:
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.npy")
+
+    def _read(self, key: str) -> Optional[np.ndarray]:
+        try:
+            return np.load(self._path(key))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write(self, key: str, vec: np.ndarray):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, vec.astype(np.float16))
+        os.replace(tmp, path)
+
+    async def get(self, key: str) -> Optional[np.ndarray]:
+        return await asyncio.to_thread(self._read, key)
+
+    async def put(self, key: str, vec: np.ndarray):
+        await asyncio.to_thread(self._write, key, vec)
+
+
+class SupabaseTier:
+    async def get(self, key: str) -> Optional[np.ndarray]:
+        emb = await supa_select_cache(key)
+        if isinstance(emb, str):
+            emb = json.loads(emb)  # pgvector text literal
+        return np.asarray(emb, dtype=np.float32) if emb else None
+
+    async def put(self, key: str, vec: np.ndarray):
+        if not await supa_insert_cache(key, vec.astype(np.float32).tolist()):
+            raise RuntimeError("query_cache insert rejected")
+
+
+class EmbeddingCache:
+    def __init__(self, memory: MemoryTier, persistent=None):
+        self.memory = memory
+        self.persistent = persistent
+        self._inflight: dict = {}
+        self._writes: set = set()
+        self.stats = {"memory_hits": 0, "persistent_hits": 0, "misses": 0, "coalesced": 0,
+                      "persistent_errors": 0, "write_errors": 0}
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[List[float]]]) -> Tuple[np.ndarray, str]:
+        """Return (vector, source) where source is "memory", "persistent" or "miss".
+
+        Concurrent misses on the same key share one compute call.
+        """
+        vec = self.memory.get(key)
+        if vec is not None:
+            self.stats["memory_hits"] += 1
+            return vec.astype(np.float32), "memory"
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key, compute))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.stats["coalesced"] += 1
+        # shield: one cancelled request must not cancel the load other requests wait on
+        vec, source = await asyncio.shield(task)
+        return vec.astype(np.float32), source
+
+    async def _load(self, key: str, compute) -> Tuple[np.ndarray, str]:
+        if self.persistent is not None:
+            try:
+                vec = await self.persistent.get(key)
+            except Exception as e:
+                self.stats["persistent_errors"] += 1
+                print(f"DEBUG: embedding cache read failed: {e}")
+                vec = None
+            if vec is not None:
+                self.stats["persistent_hits"] += 1
+                self.memory.put(key, vec)
+                return vec, "persistent"
+        self.stats["misses"] += 1
+        vec = np.asarray(await compute(), dtype=np.float32)
+        self.memory.put(key, vec)
+        if self.persistent is not None:
+            write = asyncio.ensure_future(self._write_behind(key, vec))
+            self._writes.add(write)
+            write.add_done_callback(self._writes.discard)
+        return vec, "miss"
+
+    async def _write_behind(self, key: str, vec: np.ndarray):
+        try:
+            await self.persistent.put(key, vec)
+        except Exception as e:
+            self.stats["write_errors"] += 1
+            print(f"DEBUG: embedding cache write failed: {e}")
+
+    def snapshot(self) -> dict:
+        lookups = self.stats["memory_hits"] + self.stats["persistent_hits"] + self.stats["misses"]
+        hits = self.stats["memory_hits"] + self.stats["persistent_hits"]
+        return {**self.stats, "entries": len(self.memory), "max_entries": self.memory.max_entries,
+                "persist": type(self.persistent).__name__ if self.persistent else "off", "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "pending_writes": len(self._writes)}
+
+
+def _persistent_tier():
+    if PERSIST == "supabase":
+        return SupabaseTier()
+    if PERSIST == "disk":
+        return DiskTier(DISK_DIR)
+    return None
+
+
+embedding_cache = EmbeddingCache(MemoryTier(MAX_ENTRIES, TTL), _persistent_tier())
@@ -1,8 +1,66 @@
-import os, requests
+import os, time, json, base64, asyncio
+import numpy as np
+from .http_pool import request
+from .tracing import record, server_timing_seconds, trace_headers
 
 HF_URL = os.getenv("HF_EMBED_ENDPOINT","").rstrip("/")
 HF_TOKEN = os.getenv("HF_TOKEN","")
 TIMEOUT = int(os.getenv("REQUEST_TIMEOUT","15"))
+MAX_CONCURRENCY = int(os.getenv("HF_MAX_CONCURRENCY","16"))
+RETRIES = int(os.getenv("HF_RETRIES","2"))
+BREAKER_THRESHOLD = int(os.getenv("HF_BREAKER_THRESHOLD","5"))   # consecutive failures before opening
+BREAKER_RESET = float(os.getenv("HF_BREAKER_RESET","30"))        # seconds before a half-open probe
+# json (float lists, default) | base64 (packed floats in JSON) | binary (raw octet-stream)
+WIRE_FORMAT = os.getenv("HF_WIRE_FORMAT","json")
+WIRE_DTYPE = os.getenv("HF_WIRE_DTYPE","float16")
+_NP_DTYPES = {"float16": "<f2", "float32": "<f4"}
+
+
+class CircuitBreaker:
+    """Fail fast while the endpoint is down instead of queueing requests behind timeouts"""
+
+    def __init__(self, threshold: int, reset_after: float):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.failures < self.threshold:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_after:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self.probing:
+            self.probing = True  # let exactly one request through to test the endpoint
+            return True
+        return False
+
+    def abandon(self):
+        """The request finished without a verdict (e.g. cancelled); let another probe through"""
+        self.probing = False
+
+    def record(self, ok: bool):
+        self.probing = False
+        if ok:
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+_breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_RESET)
+_limiter = asyncio.Semaphore(MAX_CONCURRENCY)
+_in_flight = 0
+
 
 async def hf_embed_1152(image_url: str):
     # Handle both regular URLs and base64 data URLs
@@ -12,13 +70,78 @@ async def hf_embed_1152(image_url: str):
     else:
         # Regular URL
         payload = {"inputs": {"image_url": image_url}}
-    
-    r = requests.post(
-        HF_URL,
-        headers={"Authorization": f"Bearer {HF_TOKEN}", "Content-Type": "application/json"},
-        json=payload,
-        timeout=TIMEOUT,
-    )
+
+    headers = {"Authorization": f"Bearer {HF_TOKEN}", "Content-Type": "application/json", **trace_headers()}
+    if WIRE_FORMAT == "binary":
+        headers["Accept"] = "application/octet-stream, application/json;q=0.9"
+        headers["X-Embedding-Dtype"] = WIRE_DTYPE
+    elif WIRE_FORMAT == "base64":
+        payload["parameters"] = {"encoding": "base64", "dtype": WIRE_DTYPE}
+
+    if not _breaker.allow():
+        return {"error": "HF endpoint unavailable (circuit open)"}
+
+    global _in_flight
+    try:
+        async with _limiter:
+            _in_flight += 1
+            try:
+                # embedding is a pure function of the image, so retries are safe
+                r = await request(
+                    "POST", HF_URL,
+                    headers=headers,
+                    json=payload,
+                    timeout=TIMEOUT,
+                    idempotent=True,
+                    retries=RETRIES,
+                )
+            except Exception as e:
+                _breaker.record(False)
+                return {"error": f"HF request failed: {e!r}"}
+            finally:
+                _in_flight -= 1
+    except BaseException:
+        # cancelled (client disconnect, wait_for timeout) while queued or in flight: record() never ran,
+        # and a half-open probe left marked in progress would keep the breaker open for good
+        _breaker.abandon()
+        raise
+
+    # 4xx means a bad input, not an unhealthy endpoint
+    _breaker.record(r.status < 500)
+    # time spent inside the encoder, so "embed" minus this is network + queueing
+    server_seconds = server_timing_seconds(r.headers.get("Server-Timing"))
+    if server_seconds is not None:
+        record("embed_server", server_seconds)
     if not r.ok:
-        return {"error": f"HF {r.status_code}: {r.text}"}
-    return r.json()
+        return {"error": f"HF {r.status}: {r.text()}"}
+    try:
+        return decode_embedding_response(r.headers.get("Content-Type", ""), r.headers, r.body)
+    except ValueError as e:
+        return {"error": f"HF bad response: {e}"}
+
+
+def decode_embedding_response(content_type: str, headers, body: bytes) -> dict:
+    """Decode the compact wire formats to {"embedding": np.float32 array, "dim": n}
+    with one np.frombuffer call; plain JSON payloads are returned as-is."""
+    if content_type.startswith("application/octet-stream"):
+        dtype = headers.get("X-Embedding-Dtype", "float32")
+        vec = np.frombuffer(body, dtype=_NP_DTYPES.get(dtype, "<f4")).astype(np.float32)
+        return {"embedding": vec, "dim": vec.shape[0]}
+    try:
+        payload = json.loads(body)
+    except Exception as e:
+        raise ValueError(str(e))
+    if isinstance(payload, dict) and "embedding_b64" in payload:
+        raw = base64.b64decode(payload.pop("embedding_b64"))
+        vec = np.frombuffer(raw, dtype=_NP_DTYPES.get(payload.get("dtype"), "<f2")).astype(np.float32)
+        payload.update({"embedding": vec, "dim": vec.shape[0]})
+    return payload
+
+
+def hf_stats() -> dict:
+    return {
+        "in_flight": _in_flight,
+        "max_concurrency": MAX_CONCURRENCY,
+        "breaker": _breaker.state,
+        "consecutive_failures": _breaker.failures,
+    }
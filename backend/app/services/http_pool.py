@@ -0,0 +1,111 @@
+import os, json, random, asyncio
+from typing import Optional
+import aiohttp
+
+# One app-lifetime aiohttp session shared by every outbound helper, so calls
+# reuse keep-alive connections instead of paying TCP+TLS setup each time.
+
+POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "32"))
+KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30"))
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+TOTAL_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "15"))
+RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.2"))  # seconds, doubled per attempt
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+RETRY_STATUSES = {429, 502, 503, 504}
+
+_session: Optional[aiohttp.ClientSession] = None
+_stats = {"requests": 0, "retries": 0, "errors": 0}
+
+
+class Response:
+    """Fully-read response, so the connection goes back to the pool before the caller parses it."""
+    __slots__ = ("status", "headers", "body")
+
+    def __init__(self, status: int, headers, body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    @property
+    def ok(self) -> bool:
+        return self.status < 400
+
+    def text(self) -> str:
+        return self.body.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.body) if self.body else None
+
+
+async def start_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=POOL_LIMIT,
+            limit_per_host=POOL_LIMIT_PER_HOST,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=300,
+        )
+        timeout = aiohttp.ClientTimeout(total=TOTAL_TIMEOUT, connect=CONNECT_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def get_session() -> aiohttp.ClientSession:
+    # normally opened on app startup; created lazily for scripts and background tasks
+    return await start_session()
+
+
+async def request(method: str, url: str, *, idempotent: Optional[bool] = None,
+                  retries: int = RETRIES, timeout: Optional[float] = None, **kwargs) -> Response:
+    """Send a request on the shared session; retry idempotent calls with exponential backoff + jitter."""
+    method = method.upper()
+    if idempotent is None:
+        idempotent = method in IDEMPOTENT_METHODS
+    attempts = 1 + (retries if idempotent else 0)
+    if timeout is not None:
+        kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout, connect=min(CONNECT_TIMEOUT, timeout))
+    session = await get_session()
+    for attempt in range(attempts):
+        _stats["requests"] += 1
+        last = attempt == attempts - 1
+        try:
+            async with session.request(method, url, **kwargs) as resp:
+                body = await resp.read()
+                if resp.status in RETRY_STATUSES and not last:
+                    raise aiohttp.ClientResponseError(resp.request_info, (), status=resp.status)
+                return Response(resp.status, resp.headers, body)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if last:
+                _stats["errors"] += 1
+                raise
+        _stats["retries"] += 1
+        await asyncio.sleep(RETRY_BACKOFF * (2 ** attempt) * (0.5 + random.random()))
+
+
+def pool_stats() -> dict:
+    out = dict(_stats)
+    out.update({"limit": POOL_LIMIT, "limit_per_host": POOL_LIMIT_PER_HOST, "open": False})
+    if _session is None or _session.closed:
+        return out
+    conn = _session.connector
+    # aiohttp has no public counters for these; read them defensively
+    acquired = getattr(conn, "_acquired", ())
+    idle = getattr(conn, "_conns", {})
+    out.update({
+        "open": True,
+        "in_use": len(acquired),
+        "idle": sum(len(v) for v in idle.values()),
+        "hosts": len(idle),
+    })
+    return out
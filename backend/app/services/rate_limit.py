@@ -1,13 +1,268 @@
-import os, time
+import os, time, math, mmap, fcntl, asyncio, hashlib, struct
+from collections import OrderedDict
+from dataclasses import dataclass
 from fastapi import Request, HTTPException
-from typing import Callable
+from typing import Callable, Dict, Optional, Tuple
 from functools import wraps
 
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # only needed for RATE_LIMIT_BACKEND=redis
+    aioredis = None
+
+# Token buckets keyed by route + client (API key if sent, else IP).
+# Backends:
+#   memory - per-worker LRU/TTL table; entries idle longer than a full refill are
+#            swept (they'd be full again anyway) and the table never exceeds
+#            RATE_LIMIT_MAX_CLIENTS. No awaits inside an update, so no locks.
+#   shm    - fixed-size slot table in a shared memory file, shared by every worker
+#            on the host; slots are hashed from the key and updated under a
+#            non-blocking per-slot byte-range lock (the event loop never waits on
+#            another worker; a contended slot is decided by the per-worker table).
+#            Memory is slots * 16 bytes.
+#   redis  - atomic Lua token bucket on a Redis-compatible server, shared across
+#            hosts; keys expire after a full refill. Falls back to memory on errors.
+# Buckets are per API key only for keys listed in RATE_LIMIT_KEYS; any other
+# (or no) key is limited by IP, so rotating made-up keys doesn't buy new buckets.
+
 RPS = float(os.getenv("RATE_LIMIT_RPS", "1"))
 BURST = int(os.getenv("RATE_LIMIT_BURST", "3"))
-TOKENS: dict[str, tuple[float, float]] = {}  # ip -> (tokens, last)
+BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")          # memory | shm | redis
+MAX_CLIENTS = int(os.getenv("RATE_LIMIT_MAX_CLIENTS", "100000"))
+SWEEP_INTERVAL = float(os.getenv("RATE_LIMIT_SWEEP_INTERVAL", "60"))
+SHM_PATH = os.getenv("RATE_LIMIT_SHM_PATH", "/dev/shm/swagai-rate-limit")
+SHM_SLOTS = int(os.getenv("RATE_LIMIT_SHM_SLOTS", "262144"))  # 4MB
+REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0")
+KEY_HEADER = os.getenv("RATE_LIMIT_KEY_HEADER", "x-api-key")
+SHM_LOCK_TRIES = int(os.getenv("RATE_LIMIT_SHM_LOCK_TRIES", "3"))
+MAX_TTL = 86400.0  # expiry for buckets that never refill (rps=0)
+
+
+@dataclass(frozen=True)
+class Policy:
+    rps: float
+    burst: int
+
+    @property
+    def refill_seconds(self) -> float:
+        return self.burst / self.rps if self.rps > 0 else float("inf")
+
+    @property
+    def ttl_seconds(self) -> float:
+        """How long an idle bucket has to be kept; bounded so rps=0 buckets still expire"""
+        return min(self.refill_seconds, MAX_TTL)
+
+
+def _parse_policies(spec: str) -> Dict[str, Policy]:
+    """"search=1:3,analytics=5:20" -> {"search": Policy(1, 3), ...}"""
+    out = {}
+    for item in filter(None, (s.strip() for s in spec.split(","))):
+        name, _, limits = item.partition("=")
+        rps, _, burst = limits.partition(":")
+        out[name.strip()] = Policy(float(rps), int(burst or max(1, math.ceil(float(rps)))))
+    return out
+
+
+DEFAULT_POLICY = Policy(RPS, BURST)
+ROUTE_POLICIES = _parse_policies(os.getenv("RATE_LIMIT_ROUTES", ""))   # route name -> policy
+KEY_POLICIES = _parse_policies(os.getenv("RATE_LIMIT_KEYS", ""))       # API key -> policy (overrides route)
+
+
+def _refill(tokens: float, last: float, now: float, policy: Policy) -> float:
+    return min(policy.burst, tokens + max(0.0, now - last) * policy.rps)
+
+
+def _retry_after(tokens: float, policy: Policy) -> float:
+    return (1.0 - tokens) / policy.rps if policy.rps > 0 else 3600.0
+
+
+class MemoryStore:
+    name = "memory"
+
+    def __init__(self, max_entries: int = MAX_CLIENTS, sweep_interval: float = SWEEP_INTERVAL):
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self._data: "OrderedDict[str, Tuple[float, float, float]]" = OrderedDict()  # key -> (tokens, last, expires)
+        self._next_sweep = 0.0  # same clock as the `now` passed to take()
+        self.evicted = 0
+        self.swept = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def sweep(self, now: float):
+        # least recently used first; stop at the first live entry
+        while self._data:
+            key, (_, _, expires) = next(iter(self._data.items()))
+            if expires > now:
+                break
+            del self._data[key]
+            self.swept += 1
+
+    def take(self, key: str, policy: Policy, now: float) -> Tuple[bool, float]:
+        if now >= self._next_sweep:
+            self.sweep(now)
+            self._next_sweep = now + self.sweep_interval
+        item = self._data.get(key)
+        tokens = _refill(item[0], item[1], now, policy) if item else float(policy.burst)
+        allowed = tokens >= 1.0
+        if allowed:
+            tokens -= 1.0
+        self._data[key] = (tokens, now, now + policy.ttl_seconds)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evicted += 1
+        return allowed, 0.0 if allowed else _retry_after(tokens, policy)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._data), "max_entries": self.max_entries, "evicted": self.evicted, "swept": self.swept}
+
+
+class SharedMemoryStore:
+    """Fixed slot table shared by all workers on the host; a hash collision shares a bucket (stricter, never looser)"""
+    name = "shm"
+    _SLOT = struct.Struct("<dd")  # tokens, last (wall clock, shared across processes)
+
+    def __init__(self, path: str = SHM_PATH, slots: int = SHM_SLOTS, lock_tries: int = SHM_LOCK_TRIES):
+        self.path = path
+        self.slots = slots
+        self.lock_tries = max(1, lock_tries)
+        self._fallback = MemoryStore()
+        self.contended = 0
+        size = slots * self._SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size != size:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size != size:
+                    os.ftruncate(self._fd, size)  # zero-filled: last=0 reads as a full bucket
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self._mm = mmap.mmap(self._fd, size)
+
+    def _slot(self, key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") % self.slots
+
+    def _try_lock(self, offset: int) -> bool:
+        # the lock is only held for one unpack/pack, so a couple of retries almost always get it
+        for _ in range(self.lock_tries):
+            try:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, self._SLOT.size, offset)
+                return True
+            except (BlockingIOError, PermissionError):
+                continue
+        return False
+
+    def take(self, key: str, policy: Policy, now: float) -> Tuple[bool, float]:
+        offset = self._slot(key) * self._SLOT.size
+        if not self._try_lock(offset):
+            self.contended += 1
+            return self._fallback.take(key, policy, now)
+        try:
+            tokens, last = self._SLOT.unpack_from(self._mm, offset)
+            tokens = _refill(tokens, last, now, policy) if last else float(policy.burst)
+            allowed = tokens >= 1.0
+            if allowed:
+                tokens -= 1.0
+            self._SLOT.pack_into(self._mm, offset, tokens, now)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self._SLOT.size, offset)
+        return allowed, 0.0 if allowed else _retry_after(tokens, policy)
+
+    def stats(self) -> dict:
+        return {"path": self.path, "slots": self.slots, "bytes": self.slots * self._SLOT.size,
+                "contended": self.contended, "fallback": self._fallback.stats()}
+
+
+_REDIS_SCRIPT = """
+local rps, burst, now, ttl_ms = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local b = redis.call('HMGET', KEYS[1], 't', 'l')
+local tokens = tonumber(b[1]) or burst
+local last = tonumber(b[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - last) * rps)
+local allowed = 0
+if tokens >= 1 then tokens = tokens - 1; allowed = 1 end
+redis.call('HSET', KEYS[1], 't', tokens, 'l', now)
+redis.call('PEXPIRE', KEYS[1], ttl_ms)
+return {allowed, tostring(tokens)}
+"""
+
+
+class RedisStore:
+    name = "redis"
+
+    def __init__(self, url: str = REDIS_URL):
+        if aioredis is None:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis needs the redis package (`pip install redis`)")
+        self._client = aioredis.from_url(url)
+        self._script = self._client.register_script(_REDIS_SCRIPT)
+        self._fallback = MemoryStore()
+        self.errors = 0
+
+    async def take(self, key: str, policy: Policy, now: float) -> Tuple[bool, float]:
+        try:
+            ttl_ms = math.ceil(policy.ttl_seconds * 1000)
+            allowed, tokens = await self._script(keys=[f"rl:{key}"], args=[policy.rps, policy.burst, now, ttl_ms])
+        except Exception as e:
+            self.errors += 1
+            print(f"DEBUG: rate limit redis error, limiting per worker: {e}")
+            return self._fallback.take(key, policy, now)
+        return bool(allowed), 0.0 if allowed else _retry_after(float(tokens), policy)
+
+    def stats(self) -> dict:
+        return {"errors": self.errors, "fallback": self._fallback.stats()}
+
+
+def _make_store():
+    if BACKEND == "shm":
+        return SharedMemoryStore()
+    if BACKEND == "redis":
+        return RedisStore()
+    return MemoryStore()
+
+
+_store = _make_store()
+_stats = {"allowed": 0, "limited": 0}
+
+
+def client_key(request: Optional[Request]) -> Tuple[str, Optional[str]]:
+    """(bucket identity, API key if it's one of RATE_LIMIT_KEYS)"""
+    if request is None:
+        return "unknown", None
+    api_key = request.headers.get(KEY_HEADER)
+    if api_key and api_key in KEY_POLICIES:
+        return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:16], api_key
+    return "ip:" + (request.client.host if request.client else "unknown"), None
+
+
+def policy_for(route: str, api_key: Optional[str], fallback: Optional[Policy] = None) -> Policy:
+    if api_key and api_key in KEY_POLICIES:
+        return KEY_POLICIES[api_key]
+    return ROUTE_POLICIES.get(route) or fallback or DEFAULT_POLICY
+
+
+async def check(request: Optional[Request], route: str = "default", policy: Optional[Policy] = None):
+    """Take a token for this client on this route or raise 429 with Retry-After"""
+    client, api_key = client_key(request)
+    result = _store.take(f"{route}:{client}", policy_for(route, api_key, policy), time.time())
+    allowed, retry_after = (await result) if asyncio.iscoroutine(result) else result
+    if allowed:
+        _stats["allowed"] += 1
+        return
+    _stats["limited"] += 1
+    raise HTTPException(status_code=429, detail="Too many requests",
+                        headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+
+def rate_limit(route: str = "default", rps: Optional[float] = None, burst: Optional[int] = None):
+    """
+    Per-route token bucket. Limits come from, in order: RATE_LIMIT_KEYS for the
+    caller's API key, RATE_LIMIT_ROUTES[route], rps/burst given here, then
+    RATE_LIMIT_RPS / RATE_LIMIT_BURST.
+    """
+    fixed = Policy(rps, burst if burst is not None else BURST) if rps is not None else None
 
-def rate_limit():
     def decorator(fn: Callable):
         @wraps(fn)
         async def wrapper(*args, **kwargs):
@@ -15,14 +270,11 @@ def rate_limit():
             if request is None:
                 for a in args:
                     if isinstance(a, Request): request = a; break
-            ip = request.client.host if request else "unknown"
-            now = time.time()
-            tokens, last = TOKENS.get(ip, (BURST, now))
-            # refill
-            tokens = min(BURST, tokens + (now - last) * RPS)
-            if tokens < 1.0:
-                raise HTTPException(status_code=429, detail="Too many requests")
-            TOKENS[ip] = (tokens - 1.0, now)
+            await check(request, route, fixed)
             return await fn(*args, **kwargs)
         return wrapper
     return decorator
+
+
+def rate_limit_stats() -> dict:
+    return {"backend": _store.name, **_stats, **_store.stats()}
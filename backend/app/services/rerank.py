@@ -0,0 +1,130 @@
+import os, threading
+from typing import Optional, List, Dict, Any, Iterable, Tuple
+import numpy as np
+
+# Metadata re-ranking for search results, done column-wise:
+#   final = COSINE_WEIGHT * cosine + BOOST_WEIGHT * min(brand + color + price + category boosts, BOOST_CAP)
+# brand/color/category are held as int32 codes (0 = missing) and a filter becomes
+# a boolean lookup table over codes, so scoring N candidates is a few gathers
+# and adds instead of N dict lookups + list membership checks.
+
+COSINE_WEIGHT = float(os.getenv("RERANK_COSINE_WEIGHT", "0.85"))
+BOOST_WEIGHT = float(os.getenv("RERANK_BOOST_WEIGHT", "0.15"))
+CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "500"))  # candidate pool when filters are set
+# pool for the search_similar_products RPC fallback; an HNSW scan returns at most
+# hnsw.ef_search rows (40 by default), and larger top_k risk the RPC's statement timeout
+RPC_CANDIDATES = int(os.getenv("RERANK_RPC_CANDIDATES", "40"))
+
+BRAND_BOOST = 0.10
+COLOR_BOOST = 0.05
+PRICE_BOOST = 0.10
+CATEGORY_BOOST = 0.05
+BOOST_CAP = 0.15
+
+
+class Vocab:
+    """str -> int code; 0 is reserved for missing values"""
+
+    def __init__(self):
+        self._codes: Dict[str, int] = {}
+        # the index build (in a worker thread) and request-path rerank_matches encode concurrently
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._codes) + 1
+
+    def encode(self, values: Iterable[Optional[str]]) -> np.ndarray:
+        codes = self._codes
+        with self._lock:
+            return np.fromiter((codes.setdefault(v, len(codes) + 1) if v else 0 for v in values), dtype=np.int32)
+
+    def lookup(self, values: Optional[List[str]]) -> Optional[np.ndarray]:
+        """Boolean table over codes for a filter list; values never seen can't match and aren't added"""
+        if not values:
+            return None
+        table = np.zeros(len(self), dtype=bool)
+        table[[self._codes[v] for v in values if v in self._codes]] = True
+        return table
+
+
+# one vocabulary per field, shared by the vector index and ad-hoc candidate lists
+VOCABS = {"brand": Vocab(), "color": Vocab(), "category": Vocab()}
+
+
+class MetaColumns:
+    """Columnar brand/color/category codes + price (NaN when missing) for a list of products"""
+
+    def __init__(self, brand: np.ndarray, color: np.ndarray, category: np.ndarray, price: np.ndarray):
+        self.brand = brand
+        self.color = color
+        self.category = category
+        self.price = price
+
+    def __len__(self):
+        return self.price.shape[0]
+
+    @classmethod
+    def from_records(cls, records: List[Dict[str, Any]]) -> "MetaColumns":
+        price = np.fromiter((_as_price(r.get("price")) for r in records), dtype=np.float64, count=len(records))
+        return cls(*(VOCABS[f].encode(r.get(f) for r in records) for f in ("brand", "color", "category")), price)
+
+    def take(self, rows: np.ndarray) -> "MetaColumns":
+        return MetaColumns(self.brand[rows], self.color[rows], self.category[rows], self.price[rows])
+
+
+def _as_price(p) -> float:
+    return float(p) if isinstance(p, (int, float)) else np.nan
+
+
+def has_filters(filters) -> bool:
+    return bool(filters.brand or filters.color or filters.category
+                or filters.priceMin is not None or filters.priceMax is not None)
+
+
+def meta_boost(cols: MetaColumns, filters) -> np.ndarray:
+    boost = np.zeros(len(cols), dtype=np.float32)
+    for field, codes, weight in (("brand", cols.brand, BRAND_BOOST), ("color", cols.color, COLOR_BOOST),
+                                 ("category", cols.category, CATEGORY_BOOST)):
+        table = VOCABS[field].lookup(getattr(filters, field))
+        if table is not None:
+            # candidate codes always predate the table, so they're in range
+            boost += weight * table[codes]
+    if filters.priceMin is not None or filters.priceMax is not None:
+        in_range = np.ones(len(cols), dtype=bool)  # NaN (no price) compares False below
+        if filters.priceMin is not None:
+            in_range &= cols.price >= filters.priceMin
+        if filters.priceMax is not None:
+            in_range &= cols.price <= filters.priceMax
+        boost += PRICE_BOOST * in_range
+    return np.minimum(boost, BOOST_CAP)
+
+
+def _top(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k largest scores, best first; ties keep candidate order."""
+    if k < scores.shape[0]:
+        part = np.argpartition(-scores, k)[:k]
+        return part[np.lexsort((part, -scores[part]))]
+    return np.argsort(-scores, kind="stable")
+
+
+def rerank(cosine: np.ndarray, cols: MetaColumns, filters, k: int,
+           cosine_weight: float = COSINE_WEIGHT, boost_weight: float = BOOST_WEIGHT) -> Tuple[np.ndarray, np.ndarray]:
+    """(candidate indices, fused scores) of the best k candidates"""
+    cosine = np.asarray(cosine, dtype=np.float32)
+    final = cosine_weight * cosine + boost_weight * meta_boost(cols, filters)
+    top = _top(final, k)
+    return top, final[top]
+
+
+def rerank_matches(matches: List[Dict[str, Any]], filters, k: int) -> List[Dict[str, Any]]:
+    """rerank() for match dicts (e.g. from the RPC); sets _final on the kept matches"""
+    if not matches:
+        return matches
+    cosine = np.fromiter((float(m.get("score", 0.0) or 0.0) for m in matches), dtype=np.float32, count=len(matches))
+    top, final = rerank(cosine, MetaColumns.from_records(matches), filters, k)
+    out = []
+    for i, score in zip(top.tolist(), final.tolist()):
+        m = matches[i]
+        m["_final"] = score
+        out.append(m)
+    return out
@@ -1,86 +1,123 @@
-import os, aiohttp, json, base64
+import os, json, base64, asyncio
+from .http_pool import request
 
 URL = os.getenv("SUPABASE_URL","")
 SRK = os.getenv("SUPABASE_SERVICE_ROLE_KEY","")
 BUCKET = os.getenv("SUPABASE_STORAGE_BUCKET","uploads")
 
 
+def _headers(content_type: str = None, **extra):
+    h = {"apikey": SRK, "Authorization": f"Bearer {SRK}"}
+    if content_type:
+        h["Content-Type"] = content_type
+    h.update(extra)
+    return h
+
 # REST helpers
-async def supa_rpc(fn: str, args: dict):
-    async with aiohttp.ClientSession() as s:
-        async with s.post(f"{URL}/rest/v1/rpc/{fn}",
-                          headers={"apikey": SRK, "Authorization": f"Bearer {SRK}", "Content-Type":"application/json"},
-                          data=json.dumps(args)) as resp:
-            if resp.status >= 400:
-                return {"error": f"RPC {resp.status}: {await resp.text()}"}
-            return {"data": await resp.json()}
+async def supa_rpc(fn: str, args: dict, idempotent: bool = True):
+    # the RPCs we call are read-only lookups, so they are safe to retry
+    resp = await request("POST", f"{URL}/rest/v1/rpc/{fn}",
+                         headers=_headers("application/json"),
+                         data=json.dumps(args), idempotent=idempotent)
+    if resp.status >= 400:
+        return {"error": f"RPC {resp.status}: {resp.text()}"}
+    return {"data": resp.json()}
 
 async def supa_upload_bytes(path: str, data: bytes, content_type="image/jpeg"):
-    async with aiohttp.ClientSession() as s:
-        async with s.post(f"{URL}/storage/v1/object/{BUCKET}/{path}",
-                          headers={"apikey": SRK, "Authorization": f"Bearer {SRK}", "Content-Type": content_type},
-                          data=data) as resp:
-            if resp.status >= 400:
-                error_text = await resp.text()
-                print(f"DEBUG: Supabase upload failed - status: {resp.status}, error: {error_text}")
-                # Handle duplicate file error gracefully
-                if resp.status == 400 and "Duplicate" in error_text:
-                    # File already exists, that's okay
-                    print(f"DEBUG: File already exists, continuing...")
-                    return
-                raise RuntimeError(f"upload {resp.status}: {error_text}")
-            else:
-                print(f"DEBUG: Supabase upload successful - status: {resp.status}")
-                response_text = await resp.text()
-                print(f"DEBUG: Upload response: {response_text}")
+    # a retried upload that already landed comes back as "Duplicate", which is handled below
+    resp = await request("POST", f"{URL}/storage/v1/object/{BUCKET}/{path}",
+                         headers=_headers(content_type), data=data, idempotent=True)
+    if resp.status >= 400:
+        error_text = resp.text()
+        print(f"DEBUG: Supabase upload failed - status: {resp.status}, error: {error_text}")
+        # Handle duplicate file error gracefully
+        if resp.status == 400 and "Duplicate" in error_text:
+            # File already exists, that's okay
+            print(f"DEBUG: File already exists, continuing...")
+            return
+        raise RuntimeError(f"upload {resp.status}: {error_text}")
+    else:
+        print(f"DEBUG: Supabase upload successful - status: {resp.status}")
+        print(f"DEBUG: Upload response: {resp.text()}")
 
 async def supa_sign_url(path: str, expires: int):
-    async with aiohttp.ClientSession() as s:
-        async with s.post(f"{URL}/storage/v1/object/sign/{BUCKET}/{path}",
-                          headers={"apikey": SRK, "Authorization": f"Bearer {SRK}", "Content-Type":"application/json"},
-                          data=json.dumps({"expiresIn": expires})) as resp:
-            if resp.status >= 400:
-                raise RuntimeError(f"sign {resp.status}: {await resp.text()}")
-            out = await resp.json()
-            # returns something like {"signedURL": "/storage/v1/object/sign/...token=..."}
-            signed_path = out.get("signedURL","")
-            if signed_path.startswith("/"):
-                return f"{URL}{signed_path}"
-            return signed_path
+    resp = await request("POST", f"{URL}/storage/v1/object/sign/{BUCKET}/{path}",
+                         headers=_headers("application/json"),
+                         data=json.dumps({"expiresIn": expires}), idempotent=True)
+    if resp.status >= 400:
+        raise RuntimeError(f"sign {resp.status}: {resp.text()}")
+    out = resp.json()
+    # returns something like {"signedURL": "/storage/v1/object/sign/...token=..."}
+    signed_path = out.get("signedURL","")
+    if signed_path.startswith("/"):
+        return f"{URL}{signed_path}"
+    return signed_path
 
 # simple cache table and analytics
 async def supa_select_cache(image_hash: str):
-    async with aiohttp.ClientSession() as s:
-        async with s.get(f"{URL}/rest/v1/query_cache?select=embedding&image_hash=eq.{image_hash}&limit=1",
-                         headers={"apikey": SRK, "Authorization": f"Bearer {SRK}"}) as resp:
-            if resp.status == 200:
-                rows = await resp.json()
-                if rows:
-                    # Supabase returns pgvector as array if enabled via REST config; else use RPC to fetch
-                    emb = rows[0].get("embedding")
-                    return emb
-            return None
+    resp = await request("GET", f"{URL}/rest/v1/query_cache?select=embedding&image_hash=eq.{image_hash}&limit=1",
+                         headers=_headers())
+    if resp.status == 200:
+        rows = resp.json()
+        if rows:
+            # Supabase returns pgvector as array if enabled via REST config; else use RPC to fetch
+            emb = rows[0].get("embedding")
+            return emb
+    return None
 
 async def supa_insert_cache(image_hash: str, embedding: list[float]):
-    async with aiohttp.ClientSession() as s:
-        async with s.post(f"{URL}/rest/v1/query_cache",
-                          headers={"apikey": SRK, "Authorization": f"Bearer {SRK}", "Content-Type":"application/json", "Prefer":"resolution=merge-duplicates"},
-                          data=json.dumps({"image_hash": image_hash, "embedding": embedding})) as resp:
-            if resp.status >= 400:
-                # ignore cache errors
-                _ = await resp.text()
+    # merge-duplicates makes this an upsert, so retrying is safe
+    resp = await request("POST", f"{URL}/rest/v1/query_cache",
+                         headers=_headers("application/json", Prefer="resolution=merge-duplicates"),
+                         data=json.dumps({"image_hash": image_hash, "embedding": embedding}), idempotent=True)
+    # ignore cache errors
+    return resp.status < 400
 
 async def log_event(event_type: str, event_data: dict):
-    async with aiohttp.ClientSession() as s:
-        async with s.post(f"{URL}/rest/v1/analytics_events",
-                          headers={"apikey": SRK, "Authorization": f"Bearer {SRK}", "Content-Type":"application/json"},
-                          data=json.dumps({"event_type": event_type, "event_data": event_data})) as resp:
-            return
+    await insert_events([{"event_type": event_type, "event_data": event_data}])
+
+async def insert_events(rows: list) -> bool:
+    """Bulk insert into analytics_events (one POST for the whole batch)"""
+    resp = await request("POST", f"{URL}/rest/v1/analytics_events",
+                         headers=_headers("application/json", Prefer="return=minimal"),
+                         data=json.dumps(rows))
+    if resp.status >= 400:
+        print(f"DEBUG: analytics insert failed - status: {resp.status}, error: {resp.text()}")
+        return False
+    return True
 
 async def fetch_recent_events(limit: int = 50):
-    async with aiohttp.ClientSession() as s:
-        async with s.get(f"{URL}/rest/v1/analytics_events?order=created_at.desc&limit={limit}",
-                         headers={"apikey": SRK, "Authorization": f"Bearer {SRK}"}) as resp:
-            if resp.status == 200:
-                return await resp.json()
-            return []
+    resp = await request("GET", f"{URL}/rest/v1/analytics_events?order=created_at.desc&limit={limit}",
+                         headers=_headers())
+    if resp.status == 200:
+        return resp.json()
+    return []
+
+async def _fetch_all(table: str, query: str, page_size: int):
+    rows, offset = [], 0
+    while True:
+        resp = await request("GET", f"{URL}/rest/v1/{table}?{query}&limit={page_size}&offset={offset}",
+                             headers=_headers(), timeout=120)
+        if resp.status >= 400:
+            raise RuntimeError(f"snapshot {table} {resp.status}: {resp.text()}")
+        page = resp.json()
+        rows.extend(page)
+        if len(page) < page_size:
+            return rows
+        offset += page_size
+
+async def fetch_embedding_snapshot(model_id: str, product_fields, page_size: int = 1000):
+    """Page through product_embeddings and products for the in-process index.
+
+    There is no foreign key from product_embeddings.product_id to products, so
+    PostgREST can't embed products(...); both tables are fetched and joined by id here.
+    """
+    fields = ",".join(dict.fromkeys(("id", *product_fields)))
+    embeddings, products = await asyncio.gather(
+        _fetch_all("product_embeddings", f"select=product_id,image_id,embedding&model_id=eq.{model_id}&order=id", page_size),
+        _fetch_all("products", f"select={fields}&order=id", page_size),
+    )
+    by_id = {p["id"]: p for p in products}
+    for row in embeddings:
+        row["products"] = by_id.get(row.get("product_id"))
+    return embeddings
@@ -0,0 +1,154 @@
+import os, time, uuid, bisect, contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Optional, Dict, List
+import numpy as np
+
+# Per-request stage timing for /api/search.
+#   trace = start_trace(request)         # reuses an incoming X-Trace-Id
+#   with trace.stage("embed"): ...       # works around awaits too
+# Each stage feeds a process-wide histogram (fixed buckets for the Prometheus
+# exposition) plus a window of recent samples for p50/p95/p99. The trace id is
+# kept in a contextvar so outbound calls (hf_client) can forward it.
+
+TRACE_HEADER = "X-Trace-Id"
+WINDOW = int(os.getenv("TRACING_WINDOW", "2048"))  # recent samples per stage kept for percentiles
+# seconds; roughly x2 steps from 0.5ms to 30s
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+_current: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("trace", default=None)
+
+
+class Histogram:
+    def __init__(self, window: int = WINDOW):
+        self.counts = [0] * (len(BUCKETS) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.recent: deque = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+
+    def quantiles(self) -> Dict[float, float]:
+        if not self.recent:
+            return {q: 0.0 for q in QUANTILES}
+        values = np.quantile(np.fromiter(self.recent, dtype=np.float64), QUANTILES)
+        return dict(zip(QUANTILES, values.tolist()))
+
+
+_histograms: Dict[str, Histogram] = {}
+
+
+def observe(stage: str, seconds: float):
+    hist = _histograms.get(stage)
+    if hist is None:
+        hist = _histograms[stage] = Histogram()
+    hist.observe(seconds)
+
+
+class Trace:
+    def __init__(self, trace_id: Optional[str] = None):
+        self.trace_id = trace_id or uuid.uuid4().hex[:16]
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t0
+            # a stage entered twice in one request (e.g. two uploads) is summed
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed
+            observe(name, elapsed)
+
+    def finish(self, name: str = "total") -> float:
+        elapsed = time.perf_counter() - self.started
+        self.stages[name] = elapsed
+        observe(name, elapsed)
+        return elapsed
+
+    def stages_ms(self) -> Dict[str, float]:
+        return {k: round(v * 1000, 2) for k, v in self.stages.items()}
+
+
+def start_trace(request=None) -> Trace:
+    incoming = request.headers.get(TRACE_HEADER) if request is not None else None
+    # only accept short, header-safe ids from clients
+    if incoming and (len(incoming) > 64 or not incoming.replace("-", "").isalnum()):
+        incoming = None
+    trace = Trace(incoming)
+    _current.set(trace)
+    return trace
+
+
+def current_trace_id() -> Optional[str]:
+    trace = _current.get()
+    return trace.trace_id if trace is not None else None
+
+
+def record(stage: str, seconds: float):
+    """Add a timing measured elsewhere (e.g. an upstream Server-Timing) to the current trace"""
+    trace = _current.get()
+    if trace is not None:
+        trace.stages[stage] = trace.stages.get(stage, 0.0) + seconds
+    observe(stage, seconds)
+
+
+def server_timing_seconds(header: Optional[str]) -> Optional[float]:
+    """Total of the dur= entries in a Server-Timing header, in seconds"""
+    if not header:
+        return None
+    total = 0.0
+    for part in header.split(";"):
+        part = part.strip()
+        if part.startswith("dur="):
+            try:
+                total += float(part[4:].split(",")[0])
+            except ValueError:
+                return None
+    return total / 1000
+
+
+def trace_headers() -> Dict[str, str]:
+    trace_id = current_trace_id()
+    return {TRACE_HEADER: trace_id} if trace_id else {}
+
+
+def tracing_stats() -> Dict[str, Dict[str, float]]:
+    out = {}
+    for stage, hist in sorted(_histograms.items()):
+        qs = hist.quantiles()
+        out[stage] = {"count": hist.count, "p50_ms": round(qs[0.5] * 1000, 2),
+                      "p95_ms": round(qs[0.95] * 1000, 2), "p99_ms": round(qs[0.99] * 1000, 2)}
+    return out
+
+
+def render_prometheus(prefix: str = "search_stage") -> str:
+    """Prometheus text format: a histogram over fixed buckets and a summary over the recent window"""
+    lines: List[str] = [
+        f"# HELP {prefix}_duration_seconds Time spent in each /api/search stage",
+        f"# TYPE {prefix}_duration_seconds histogram",
+    ]
+    for stage, hist in sorted(_histograms.items()):
+        cumulative = 0
+        for le, n in zip(BUCKETS + ("+Inf",), hist.counts):
+            cumulative += n
+            lines.append(f'{prefix}_duration_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+        lines.append(f'{prefix}_duration_seconds_sum{{stage="{stage}"}} {hist.sum:.6f}')
+        lines.append(f'{prefix}_duration_seconds_count{{stage="{stage}"}} {hist.count}')
+    lines += [
+        f"# HELP {prefix}_latency_seconds Quantiles over the last {WINDOW} samples per stage",
+        f"# TYPE {prefix}_latency_seconds summary",
+    ]
+    for stage, hist in sorted(_histograms.items()):
+        for q, v in hist.quantiles().items():
+            lines.append(f'{prefix}_latency_seconds{{stage="{stage}",quantile="{q}"}} {v:.6f}')
+        lines.append(f'{prefix}_latency_seconds_sum{{stage="{stage}"}} {sum(hist.recent):.6f}')
+        lines.append(f'{prefix}_latency_seconds_count{{stage="{stage}"}} {len(hist.recent)}')
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,208 @@
+import os, json, time, asyncio
+from typing import Optional, List, Dict, Any, Tuple
+import numpy as np
+from .supabase_client import fetch_embedding_snapshot
+from .rerank import MetaColumns
+from .attribute_index import AttributeBitmaps
+
+# In-process KNN over a snapshot of product_embeddings.
+# The catalog (~10.6k x 1152) fits comfortably in RAM, so an exact scan is a
+# single matrix-vector product; IVF is available for larger catalogs.
+
+ENABLED = os.getenv("VECTOR_INDEX_ENABLED", "1") == "1"
+MODEL_ID = os.getenv("EMBED_MODEL_ID", "google/siglip-so400m-patch14-384")
+DTYPE = os.getenv("VECTOR_INDEX_DTYPE", "float32")      # float32 | float16 (half the RAM, slower scan: no fp16 BLAS on CPU)
+MODE = os.getenv("VECTOR_INDEX_MODE", "exact")          # exact | ivf
+SNAPSHOT = os.getenv("VECTOR_INDEX_SNAPSHOT", "")       # optional .npz cache of the snapshot
+IVF_NLIST = int(os.getenv("VECTOR_INDEX_IVF_NLIST", "0"))  # 0 -> ~sqrt(n)
+IVF_NPROBE = int(os.getenv("VECTOR_INDEX_IVF_NPROBE", "8"))
+OVERSAMPLE = 4  # several images can belong to one product; over-fetch before de-duping
+SPARSE_MASK = 0.25  # masks selecting fewer rows than this fraction are gathered; denser ones mask a full scan
+
+PRODUCT_FIELDS = ("id", "title", "brand", "price", "currency", "category", "color", "url", "main_image_url")
+
+
+def _normalize(mat: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(mat, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return mat / norms
+
+
+def _top_rows(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k largest scores, best first."""
+    if k >= scores.shape[0]:
+        return np.argsort(-scores)
+    part = np.argpartition(-scores, k)[:k]
+    return part[np.argsort(-scores[part])]
+
+
+class VectorIndex:
+    def __init__(self, vectors: np.ndarray, products: List[Dict[str, Any]], dtype: str = DTYPE, mode: str = MODE):
+        if vectors.ndim != 2 or vectors.shape[0] != len(products):
+            raise ValueError(f"vectors {vectors.shape} do not match {len(products)} products")
+        self.dim = vectors.shape[1]
+        self.dtype = np.dtype(dtype)
+        self.matrix = np.ascontiguousarray(_normalize(vectors.astype(np.float32)), dtype=self.dtype)
+        self.products = products
+        # row -> product code, so several images of one product collapse into one hit
+        ids = [p.get("id") for p in products]
+        uniq = {pid: i for i, pid in enumerate(dict.fromkeys(ids))}
+        self.product_codes = np.fromiter((uniq[pid] for pid in ids), dtype=np.int32, count=len(ids))
+        self.n_products = len(uniq)
+        # brand/color/category codes + price per row for the re-ranking stage
+        self.columns = MetaColumns.from_records(products)
+        # brand/category/color/price bitmaps for strict (pre-filtered) search
+        self.attributes = AttributeBitmaps(products)
+        self.mode = mode
+        self.centroids: Optional[np.ndarray] = None
+        self.lists: List[np.ndarray] = []
+        if mode == "ivf":
+            self._build_ivf(IVF_NLIST or max(1, int(np.sqrt(len(products)))))
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    # --- IVF ---------------------------------------------------------------
+    def _build_ivf(self, nlist: int, iters: int = 10, seed: int = 0):
+        """Spherical k-means over the rows; each row is assigned to its nearest centroid."""
+        x = self.matrix.astype(np.float32)
+        nlist = min(nlist, x.shape[0])
+        rng = np.random.default_rng(seed)
+        centroids = x[rng.choice(x.shape[0], nlist, replace=False)].copy()
+        for _ in range(iters):
+            assign = np.argmax(x @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, x)
+            empty = np.bincount(assign, minlength=nlist) == 0
+            sums[empty] = centroids[empty]
+            centroids = _normalize(sums)
+        assign = np.argmax(x @ centroids.T, axis=1)
+        order = np.argsort(assign, kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(nlist + 1))
+        self.centroids = centroids.astype(self.dtype)
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(nlist)]
+
+    def _candidates(self, q: np.ndarray) -> Optional[np.ndarray]:
+        if self.centroids is None:
+            return None
+        probe = _top_rows(self.centroids @ q, min(IVF_NPROBE, len(self.lists)))
+        return np.concatenate([self.lists[i] for i in probe])
+
+    # --- search --------------------------------------------------------------
+    def _scan(self, q: np.ndarray, rows: Optional[np.ndarray], k: int, mask: Optional[np.ndarray] = None):
+        if rows is None:
+            scores = self.matrix @ q
+            if mask is not None:
+                scores = np.where(mask, scores, -np.inf)
+            top = _top_rows(scores, k)
+            return top, scores[top]
+        scores = self.matrix[rows] @ q
+        top = _top_rows(scores, k)
+        return rows[top], scores[top]
+
+    def filter_mask(self, filters) -> Optional[np.ndarray]:
+        return self.attributes.mask(filters)
+
+    def search_rows(self, qvec, top_k: int = 10, mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (rows, cosine scores) of the top_k products, one row per product, best first.
+        With a row mask only matching rows are ranked, by an exact scan (IVF is skipped,
+        since a selective filter can leave the probed lists empty).
+        """
+        q = np.asarray(qvec, dtype=np.float32).reshape(-1)
+        if q.shape[0] != self.dim:
+            raise ValueError(f"query dim {q.shape[0]} != index dim {self.dim}")
+        q = (q / (np.linalg.norm(q) or 1.0)).astype(self.dtype)
+        scan_mask = None
+        if mask is None:
+            rows = self._candidates(q)
+            pool = len(rows) if rows is not None else len(self)
+        else:
+            pool = int(np.count_nonzero(mask))
+            if pool == 0:
+                return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+            rows = np.flatnonzero(mask) if pool < SPARSE_MASK * len(self) else None
+            scan_mask = mask if rows is None else None
+        k = min(top_k, self.n_products, pool)
+        fetch = k * OVERSAMPLE
+        while True:
+            top, scores = self._scan(q, rows, min(fetch, pool), scan_mask)
+            _, first = np.unique(self.product_codes[top], return_index=True)
+            first.sort()
+            if len(first) >= k or fetch >= pool:
+                break
+            fetch = min(pool, fetch * 4)
+        first = first[:k]
+        return top[first], scores[first].astype(np.float32)
+
+    def hits(self, rows: np.ndarray, scores: np.ndarray) -> List[Dict[str, Any]]:
+        out = []
+        for row, score in zip(rows.tolist(), scores.tolist()):
+            hit = dict(self.products[row])
+            hit["score"] = float(score)
+            out.append(hit)
+        return out
+
+    def search(self, qvec, top_k: int = 10) -> List[Dict[str, Any]]:
+        return self.hits(*self.search_rows(qvec, top_k))
+
+    # --- persistence ---------------------------------------------------------
+    def save(self, path: str):
+        np.savez(path, vectors=self.matrix, products=np.array(json.dumps(self.products)))
+
+    @classmethod
+    def load(cls, path: str, **kw) -> "VectorIndex":
+        with np.load(path, allow_pickle=False) as z:
+            return cls(z["vectors"], json.loads(str(z["products"])), **kw)
+
+
+def _parse_vector(v) -> Optional[List[float]]:
+    # pgvector comes back over REST as the text literal "[0.1,0.2,...]"
+    if isinstance(v, str):
+        v = json.loads(v)
+    return v if isinstance(v, list) and v else None
+
+
+def build_from_rows(rows: List[Dict[str, Any]], **kw) -> VectorIndex:
+    vectors, products = [], []
+    for r in rows:
+        vec = _parse_vector(r.get("embedding"))
+        prod = r.get("products") or {}
+        if vec is None or not prod:
+            continue
+        vectors.append(vec)
+        products.append({f: prod.get(f) for f in PRODUCT_FIELDS})
+    if not vectors:
+        raise RuntimeError("no embeddings in snapshot")
+    return VectorIndex(np.asarray(vectors, dtype=np.float32), products, **kw)
+
+
+_index: Optional[VectorIndex] = None
+
+
+def get_index() -> Optional[VectorIndex]:
+    return _index
+
+
+async def load_index():
+    """Load the index from the local snapshot file, else from product_embeddings."""
+    global _index
+    if not ENABLED:
+        return None
+    t0 = time.time()
+    try:
+        if SNAPSHOT and os.path.exists(SNAPSHOT):
+            idx = await asyncio.to_thread(VectorIndex.load, SNAPSHOT)
+            source = SNAPSHOT
+        else:
+            rows = await fetch_embedding_snapshot(MODEL_ID, PRODUCT_FIELDS)
+            idx = await asyncio.to_thread(build_from_rows, rows)
+            source = "product_embeddings"
+            if SNAPSHOT:
+                await asyncio.to_thread(idx.save, SNAPSHOT)
+    except Exception as e:
+        print(f"DEBUG: vector index load failed, using RPC fallback: {e}")
+        return None
+    _index = idx
+    print(f"DEBUG: vector index ready - {len(idx)} rows x {idx.dim} ({idx.dtype}, {idx.mode}) from {source} in {time.time() - t0:.1f}s")
+    return idx
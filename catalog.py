@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Catalog Reader
+
+One place that knows how to read the scraped brand catalogs in output/ and
+data/raw/. Each file is a JSON array of products, and the brands disagree
+on field names (mainImage vs image_url, images vs imageURLs, productURL vs
+product_url, colors vs color, sizes vs size). iter_products() streams the
+files one record at a time and normalizes every record into a Product, so
+memory stays flat however many brands are added.
+
+Usage:
+    from catalog import iter_products
+    for product in iter_products(["output", "data/raw"]):
+        for url, image_type in product.image_urls():
+            ...
+
+    python catalog.py output data/raw     # per-brand product and image counts
+"""
+
+import json
+import hashlib
+import logging
+import argparse
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIRS = ("output", "data/raw")
+CHUNK_SIZE = 1 << 16
+
+# file slug -> brand folder name used under downloaded_images/
+BRAND_NAMES = {
+    'nike': 'Nike',
+    'adidas': 'Adidas',
+    'carhartt': 'Carhartt WIP',
+    'stussy': 'Stussy',
+    'uniqlo': 'Uniqlo',
+    'newbalance': 'New Balance',
+    'aunecollections': 'AuneCollections',
+    'namacheko': 'Namacheko',
+    'ottolinger': 'Otto Linger',
+    'heliotemil': 'HELIOT EMIL',
+    'noahny': 'Noah NY',
+    'aimeleondore': 'Aime Leon Dore',
+    'rickowens': 'Rick Owens',
+    'therow': 'The Row',
+    'avavav': 'Avavav',
+    'fanciclub': 'Fanci Club',
+    '032c': '032c',
+    'nensidojaka': 'Nensi Dojaka',
+    'walesbonner': 'Wales Bonner',
+    'mowalola': 'MOWALOLA',
+    'eytys': 'EYTYS',
+    'dailypaperclothing': 'Daily Paper',
+    'blumarine': 'Blumarine',
+    'jadedldn': 'Jaded London',
+    'palomawool': 'Paloma Wool',
+    'ludovicdesaintsernin': 'Ludovic de Saint Sernin',
+    'diotima': 'DIOTIMA',
+    'maisiewilen': 'Maisie Wilen'
+}
+
+_MAIN_IMAGE_KEYS = ('mainImage', 'image_url', 'image', 'img', 'photo', 'picture')
+_IMAGE_LIST_KEYS = ('images', 'imageURLs')
+_IMAGE_EXTENSIONS = ['jpg', 'jpeg', 'png', 'webp', 'gif']
+
+
+def brand_slug(path) -> str:
+    """'output/adidas_complete_data.json' -> 'adidas'"""
+    return Path(path).stem.replace('_complete_data', '').replace('_data', '')
+
+
+@dataclass(slots=True)
+class Product:
+    """One normalized catalog record"""
+    brand: str
+    name: str
+    source: str                       # brand slug of the file it came from
+    product_url: Optional[str] = None
+    main_image: Optional[str] = None
+    images: Tuple[str, ...] = ()      # secondary images, in catalog order
+    price: Optional[float] = None
+    currency: Optional[str] = None
+    category: Optional[str] = None
+    gender: Optional[str] = None
+    colors: Tuple[str, ...] = ()
+    sizes: Tuple[str, ...] = ()
+    description: Optional[str] = None
+
+    @property
+    def color(self) -> Optional[str]:
+        return self.colors[0] if self.colors else None
+
+    @property
+    def key(self) -> Optional[str]:
+        """Identity used to deduplicate the same product across catalog copies"""
+        return self.product_url or self.main_image
+
+    def image_urls(self, include_secondary: bool = True) -> Iterator[Tuple[str, str]]:
+        """(url, image_type) pairs: ('...', 'main'), ('...', 'secondary_0'), ..."""
+        if self.main_image:
+            yield self.main_image, 'main'
+        if include_secondary:
+            for i, url in enumerate(self.images):
+                yield url, f'secondary_{i}'
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+def _strings(value) -> Tuple[str, ...]:
+    if isinstance(value, str):
+        return (value,) if value else ()
+    if isinstance(value, list):
+        return tuple(v for v in value if isinstance(v, str) and v)
+    return ()
+
+
+def _price(value) -> Optional[float]:
+    try:
+        return float(value) if value is not None and value != '' else None
+    except (TypeError, ValueError):
+        return None
+
+
+def normalize(item: Dict, source: str) -> Product:
+    """Map one raw brand record onto Product"""
+    main = next((item[k] for k in _MAIN_IMAGE_KEYS if isinstance(item.get(k), str) and item[k]), None)
+    images = next((_strings(item[k]) for k in _IMAGE_LIST_KEYS if isinstance(item.get(k), list)), ())
+    return Product(
+        brand=item.get('brand') or source,
+        name=item.get('name') or item.get('title') or 'unknown',
+        source=source,
+        product_url=item.get('productURL') or item.get('product_url') or item.get('url'),
+        main_image=main,
+        images=images,
+        price=_price(item.get('price')),
+        currency=item.get('currency'),
+        category=item.get('category'),
+        gender=item.get('gender'),
+        colors=_strings(item.get('colors')) or _strings(item.get('color')),
+        sizes=_strings(item.get('sizes')) or _strings(item.get('size')),
+        description=item.get('description'),
+    )
+
+
+def iter_json_array(path, chunk_size: int = CHUNK_SIZE) -> Iterator:
+    """
+    Stream the elements of a top-level JSON array without loading the whole
+    file: read fixed-size chunks and raw_decode one element at a time.
+    A top-level object with a 'products' array is also accepted.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buf = f.read(chunk_size).lstrip()
+        if buf.startswith('{'):
+            # rare wrapped form; small enough to parse whole
+            data = json.loads(buf + f.read())
+            yield from data.get('products', []) if isinstance(data, dict) else []
+            return
+        if not buf.startswith('['):
+            raise ValueError(f"{path}: expected a JSON array")
+        pos, eof = 1, False
+        while True:
+            # skip whitespace and the separator before the next element
+            while True:
+                while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                    pos += 1
+                if pos < len(buf) or eof:
+                    break
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+            if pos >= len(buf):
+                raise ValueError(f"{path}: unterminated JSON array")
+            if buf[pos] == ']':
+                return
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                    break
+                except json.JSONDecodeError:
+                    # element straddles the chunk boundary; read more and retry
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        raise
+                    buf, pos = buf[pos:] + chunk, 0
+            yield value
+            # advance in place; the buffer is only compacted when it is refilled
+            pos = end
+
+
+def catalog_files(dirs: Iterable[str] = DEFAULT_DIRS) -> List[Path]:
+    return [p for d in dirs for p in sorted(Path(d).glob("*.json"))]
+
+
+def iter_file(path) -> Iterator[Product]:
+    """Products from one catalog file; unreadable files are logged and skipped"""
+    source = brand_slug(path)
+    try:
+        for item in iter_json_array(path):
+            if isinstance(item, dict):
+                yield normalize(item, source)
+    except (OSError, ValueError) as e:
+        logger.error(f"Error reading {path}: {e}")
+
+
+def _sanitize(name: str) -> str:
+    # same rules as FashionImageDownloader.sanitize_filename
+    for char in '<>:"/\\|?*':
+        name = name.replace(char, '_')
+    return name[:200]
+
+
+def downloaded_image_path(images_dir, brand: str, name: str, url: str, image_type: str) -> Optional[Path]:
+    """Find the file download_all_images.py saved for this image, if any"""
+    brand_dir = Path(images_dir) / _sanitize(brand)
+    stems = [f"{_sanitize(name)}_{image_type}"]
+    # download_all_images.py falls back to a URL hash for long names
+    stems.append(f"{hashlib.md5(url.encode()).hexdigest()[:8]}_{image_type}")
+    path = urlparse(url).path
+    url_ext = path.rsplit('.', 1)[-1].lower() if '.' in path else None
+    exts = ([url_ext] if url_ext in _IMAGE_EXTENSIONS else []) + _IMAGE_EXTENSIONS
+    for stem in stems:
+        for ext in exts:
+            candidate = brand_dir / f"{stem}.{ext}"
+            if candidate.exists():
+                return candidate
+    return None
+
+
+def iter_products(dirs: Iterable[str] = DEFAULT_DIRS, dedupe: bool = True) -> Iterator[Product]:
+    """
+    Products from every catalog file in dirs, in a stable order. With dedupe,
+    a product present in several directories (output/ and data/raw/) is
+    yielded once.
+    """
+    seen = set()
+    for path in catalog_files(dirs):
+        for product in iter_file(path):
+            if dedupe:
+                key = product.key
+                if key is not None:
+                    if key in seen:
+                        continue
+                    seen.add(key)
+            yield product
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Summarize the product catalog")
+    parser.add_argument("dirs", nargs="*", default=list(DEFAULT_DIRS))
+    args = parser.parse_args()
+    counts: Dict[str, List[int]] = {}
+    for product in iter_products(args.dirs):
+        c = counts.setdefault(product.source, [0, 0])
+        c[0] += 1
+        c[1] += sum(1 for _ in product.image_urls())
+    for source, (products, images) in sorted(counts.items()):
+        print(f"{source:24s} {products:6d} products {images:7d} images")
+    print(f"{'total':24s} {sum(c[0] for c in counts.values()):6d} products "
+          f"{sum(c[1] for c in counts.values()):7d} images")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Columnar Catalog Snapshot
+
+Compiles the brand JSON files (output/, data/raw/) into one Parquet file
+with a row per product:
+
+    id, brand, source, name, product_url, main_image, images, price,
+    currency, category, gender, colors, sizes, description,
+    local_path, content_hash
+
+local_path / content_hash are resolved at build time for the main image,
+from the image store (--store) or downloaded_images/. Rows are written in
+catalog file order, one brand after another, so row-group statistics let a
+brand filter skip most of the file.
+
+Jobs read the snapshot memory-mapped, with only the columns and rows they
+need, instead of re-parsing every JSON file on startup:
+
+    from catalog_snapshot import load_table, iter_snapshot_products
+    table = load_table("catalog.parquet", columns=["brand", "name", "local_path"],
+                       filters=[("source", "in", ["nike", "adidas"])])
+
+The snapshot records the size and mtime of every source file; is_stale()
+tells a job that the JSON has changed since the last build.
+
+Usage:
+    python catalog_snapshot.py build [--store image_store] [--images-dir downloaded_images]
+    python catalog_snapshot.py info
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import argparse
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:  # only needed to build or read snapshots
+    pa = pc = pq = None
+
+from catalog import DEFAULT_DIRS, Product, catalog_files, downloaded_image_path, iter_products
+from image_store import ImageStore, sha256_file
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.getenv("CATALOG_SNAPSHOT", "catalog.parquet")
+ROW_GROUP_SIZE = 2048
+_PRODUCT_FIELDS = Product.__slots__
+_METADATA_KEY = b"catalog_snapshot"
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise SystemExit("Catalog snapshots need pyarrow (`pip install pyarrow`)")
+
+
+def schema():
+    _require_pyarrow()
+    strings = pa.list_(pa.string())
+    return pa.schema([
+        ('id', pa.string()),
+        ('brand', pa.string()),
+        ('source', pa.string()),
+        ('name', pa.string()),
+        ('product_url', pa.string()),
+        ('main_image', pa.string()),
+        ('images', strings),
+        ('price', pa.float64()),
+        ('currency', pa.string()),
+        ('category', pa.string()),
+        ('gender', pa.string()),
+        ('colors', strings),
+        ('sizes', strings),
+        ('description', pa.string()),
+        ('local_path', pa.string()),
+        ('content_hash', pa.string()),
+    ])
+
+
+def product_id(product: Product) -> str:
+    """Stable row id: hash of the product's catalog identity"""
+    key = product.key or f"{product.source}/{product.name}"
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def source_fingerprint(dirs: Iterable[str]) -> Dict[str, List]:
+    """path -> [size, mtime] for every catalog file"""
+    fingerprint = {}
+    for path in catalog_files(dirs):
+        st = path.stat()
+        fingerprint[str(path)] = [st.st_size, int(st.st_mtime)]
+    return fingerprint
+
+
+# ---------------------------------------------------------------- build
+
+def _locate(product: Product, images_dir: Optional[Path], store: Optional[ImageStore]):
+    """(local_path, content_hash) of the product's main image, if it has been downloaded"""
+    url = product.main_image
+    if not url:
+        return None, None
+    if store is not None:
+        sha = store.hash_for_url(url)
+        if sha:
+            path = store.path_for_hash(sha)
+            return (str(path), sha) if path else (None, None)
+    if images_dir is not None:
+        path = downloaded_image_path(images_dir, product.brand, product.name, url, 'main')
+        if path is not None:
+            return str(path), sha256_file(path)
+    return None, None
+
+
+def build_snapshot(path: str = DEFAULT_PATH, dirs: Iterable[str] = DEFAULT_DIRS,
+                   images_dir: Optional[str] = "downloaded_images", store: Optional[ImageStore] = None,
+                   row_group_size: int = ROW_GROUP_SIZE) -> Dict:
+    """Stream the catalog into a Parquet snapshot, one row group at a time"""
+    _require_pyarrow()
+    dirs = list(dirs)
+    images_dir = Path(images_dir) if images_dir and Path(images_dir).exists() else None
+    table_schema = schema().with_metadata({_METADATA_KEY: json.dumps({
+        'built_at': time.time(),
+        'dirs': dirs,
+        'sources': source_fingerprint(dirs),
+    })})
+
+    tmp = f"{path}.tmp"
+    rows = located = 0
+    columns = {name: [] for name in table_schema.names}
+
+    def flush(writer):
+        writer.write_table(pa.Table.from_pydict(columns, schema=table_schema))
+        for values in columns.values():
+            values.clear()
+
+    with pq.ParquetWriter(tmp, table_schema, compression='zstd') as writer:
+        for product in iter_products(dirs):
+            local_path, content_hash = _locate(product, images_dir, store)
+            columns['id'].append(product_id(product))
+            for name in _PRODUCT_FIELDS:
+                value = getattr(product, name)
+                columns[name].append(list(value) if isinstance(value, tuple) else value)
+            columns['local_path'].append(local_path)
+            columns['content_hash'].append(content_hash)
+            rows += 1
+            located += local_path is not None
+            if len(columns['id']) >= row_group_size:
+                flush(writer)
+        if columns['id']:
+            flush(writer)
+    os.replace(tmp, path)
+    return {'path': path, 'products': rows, 'with_local_image': located,
+            'bytes': Path(path).stat().st_size}
+
+
+# ---------------------------------------------------------------- read
+
+def load_table(path: str = DEFAULT_PATH, columns: Optional[List[str]] = None, filters=None):
+    """
+    Memory-mapped read with column projection and row-group pruning.
+    filters uses pyarrow's DNF form, e.g. [("source", "=", "nike")], or a
+    pyarrow.compute expression.
+    """
+    _require_pyarrow()
+    return pq.read_table(path, columns=columns, filters=filters, memory_map=True)
+
+
+def with_local_image():
+    """Filter expression: rows whose main image was found when the snapshot was built"""
+    _require_pyarrow()
+    return pc.field('local_path').is_valid()
+
+
+def iter_rows(path: str = DEFAULT_PATH, columns: Optional[List[str]] = None, filters=None) -> Iterator[Dict]:
+    for batch in load_table(path, columns, filters).to_batches():
+        yield from batch.to_pylist()
+
+
+def iter_snapshot_products(path: str = DEFAULT_PATH, filters=None) -> Iterator[Product]:
+    """The snapshot's rows as catalog.Product records (same order as catalog.iter_products)"""
+    for row in iter_rows(path, list(_PRODUCT_FIELDS), filters):
+        yield Product(**{name: tuple(value) if isinstance(value, list) else value
+                         for name, value in row.items()})
+
+
+def snapshot_info(path: str = DEFAULT_PATH) -> Dict:
+    _require_pyarrow()
+    metadata = pq.read_schema(path).metadata or {}
+    return json.loads(metadata.get(_METADATA_KEY, b'{}'))
+
+
+def is_stale(path: str = DEFAULT_PATH, dirs: Optional[Iterable[str]] = None) -> bool:
+    """True if the snapshot is missing or any catalog file changed since it was built"""
+    if not Path(path).exists():
+        return True
+    info = snapshot_info(path)
+    return source_fingerprint(dirs if dirs is not None else info.get('dirs', DEFAULT_DIRS)) != info.get('sources')
+
+
+def warn_if_stale(path: str, dirs: Optional[Iterable[str]] = None):
+    if is_stale(path, dirs):
+        logger.warning(f"{path} is older than the catalog JSON; rebuild it with `python catalog_snapshot.py build`")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Columnar catalog snapshot")
+    parser.add_argument("--path", default=DEFAULT_PATH, help="Snapshot file")
+    sub = parser.add_subparsers(dest="command", required=True)
+    b = sub.add_parser("build", help="Compile the catalog JSON into the snapshot")
+    b.add_argument("--catalog-dirs", nargs="+", default=list(DEFAULT_DIRS))
+    b.add_argument("--images-dir", default="downloaded_images", help="Where download_all_images.py saved images")
+    b.add_argument("--store", default=None, help="image_store.py directory to resolve images from")
+    b.add_argument("--row-group-size", type=int, default=ROW_GROUP_SIZE)
+    sub.add_parser("info", help="Show snapshot metadata and whether it is stale")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        start = time.perf_counter()
+        result = build_snapshot(args.path, args.catalog_dirs, args.images_dir,
+                                ImageStore(args.store) if args.store else None, args.row_group_size)
+        result['seconds'] = round(time.perf_counter() - start, 2)
+    else:
+        info = snapshot_info(args.path)
+        metadata = pq.ParquetFile(args.path).metadata
+        result = {'path': args.path, 'products': metadata.num_rows, 'row_groups': metadata.num_row_groups,
+                  'built_at': info.get('built_at'), 'sources': len(info.get('sources', {})),
+                  'stale': is_stale(args.path)}
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,26 +2,50 @@
 """
 Fashion Image Downloader
 Downloads all images from the 28 JSON files in the output directory
+
+Two modes:
+  --mode async (default)  aiohttp with per-host connection caps, adaptive backoff
+                          on 403/429, and a persistent manifest so reruns only
+                          fetch new or changed images (conditional GETs)
+  --mode threads          the original thread-pool downloader
+
+With --store DIR (async mode) images go into the content-addressed store
+from image_store.py instead of per-brand folders.
 """
 
 import json
 import os
+import random
+import asyncio
+import argparse
 import requests
 import time
 import hashlib
+from collections import defaultdict
+from email.utils import parsedate_to_datetime
 from urllib.parse import urlparse, unquote
 from pathlib import Path
 import concurrent.futures
 from tqdm import tqdm
 import logging
 
+from catalog import iter_file
+from catalog_snapshot import iter_snapshot_products, warn_if_stale
+from image_store import ImageStore
+
+try:
+    import aiohttp
+except ImportError:  # only needed for --mode async
+    aiohttp = None
+
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 class FashionImageDownloader:
-    def __init__(self, output_dir="output", download_dir="downloaded_images", max_workers=10):
+    def __init__(self, output_dir="output", download_dir="downloaded_images", max_workers=10, snapshot=None):
         self.output_dir = Path(output_dir)
+        self.snapshot = snapshot
         self.download_dir = Path(download_dir)
         self.max_workers = max_workers
         self.session = requests.Session()
@@ -42,60 +66,36 @@ class FashionImageDownloader:
         logger.info(f"Found {len(json_files)} JSON files")
         return json_files
     
+    def product_images(self, product):
+        """Image info dicts for one catalog.Product"""
+        return [{
+            'url': url,
+            'brand': product.brand,
+            'product_name': product.name,
+            'product_url': product.product_url,
+            'type': image_type
+        } for url, image_type in product.image_urls()]
+    
     def extract_image_urls_from_json(self, json_file):
         """Extract all image URLs from a JSON file"""
-        brand_name = json_file.stem.replace('_complete_data', '').replace('_data', '')
         image_urls = []
-        
-        try:
-            with open(json_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            for item in data:
-                # Handle different JSON structures
-                if isinstance(item, dict):
-                    # Adidas/Nike style structure
-                    if 'mainImage' in item:
-                        image_urls.append({
-                            'url': item['mainImage'],
-                            'brand': item.get('brand', brand_name),
-                            'product_name': item.get('name', 'unknown'),
-                            'type': 'main'
-                        })
-                    
-                    if 'images' in item and isinstance(item['images'], list):
-                        for i, img_url in enumerate(item['images']):
-                            image_urls.append({
-                                'url': img_url,
-                                'brand': item.get('brand', brand_name),
-                                'product_name': item.get('name', 'unknown'),
-                                'type': f'secondary_{i}'
-                            })
-                    
-                    # Carhartt style structure
-                    if 'image_url' in item:
-                        image_urls.append({
-                            'url': item['image_url'],
-                            'brand': item.get('brand', brand_name),
-                            'product_name': item.get('name', 'unknown'),
-                            'type': 'main'
-                        })
-                    
-                    # Other structures
-                    for key in ['image', 'img', 'photo', 'picture']:
-                        if key in item and isinstance(item[key], str):
-                            image_urls.append({
-                                'url': item[key],
-                                'brand': item.get('brand', brand_name),
-                                'product_name': item.get('name', 'unknown'),
-                                'type': 'main'
-                            })
-        
-        except Exception as e:
-            logger.error(f"Error processing {json_file}: {e}")
-        
+        # catalog.iter_file streams the file and normalizes the brand-specific schemas
+        for product in iter_file(json_file):
+            image_urls.extend(self.product_images(product))
         return image_urls
     
+    def extract_all_image_urls(self):
+        """Image URLs for the whole catalog, from the snapshot if one was given"""
+        if self.snapshot:
+            warn_if_stale(self.snapshot)
+            logger.info(f"Reading catalog snapshot {self.snapshot}")
+            return [img for product in iter_snapshot_products(self.snapshot) for img in self.product_images(product)]
+        all_image_urls = []
+        logger.info("Extracting image URLs from JSON files...")
+        for json_file in tqdm(self.get_json_files(), desc="Processing JSON files"):
+            all_image_urls.extend(self.extract_image_urls_from_json(json_file))
+        return all_image_urls
+    
     def sanitize_filename(self, filename):
         """Sanitize filename for safe file system usage"""
         # Remove or replace invalid characters
@@ -187,14 +187,8 @@ class FashionImageDownloader:
     
     def download_all_images(self):
         """Download all images from all JSON files"""
-        json_files = self.get_json_files()
-        all_image_urls = []
-        
         # Extract all image URLs
-        logger.info("Extracting image URLs from JSON files...")
-        for json_file in tqdm(json_files, desc="Processing JSON files"):
-            image_urls = self.extract_image_urls_from_json(json_file)
-            all_image_urls.extend(image_urls)
+        all_image_urls = self.extract_all_image_urls()
         
         logger.info(f"Found {len(all_image_urls)} total images to download")
         
@@ -244,13 +238,296 @@ class FashionImageDownloader:
         for brand, count in sorted(brand_stats.items()):
             logger.info(f"  {brand}: {count} images")
 
+class DownloadManifest:
+    """
+    Persistent record of every downloaded URL:
+    url -> {path, etag, last_modified, size, sha256, fetched_at}
+    """
+    
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        self._dirty = 0
+    
+    def get(self, url):
+        entry = self.entries.get(url)
+        # a manifest entry is only trusted while its file is still on disk
+        if entry and Path(entry['path']).exists():
+            return entry
+        return None
+    
+    def record(self, url, **entry):
+        self.entries[url] = {**entry, 'fetched_at': time.time()}
+        self._dirty += 1
+        if self._dirty >= 500:
+            self.save()
+    
+    def touch(self, url):
+        self.entries[url]['fetched_at'] = time.time()
+    
+    def save(self):
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+        self._dirty = 0
+
+
+class HostThrottle:
+    """
+    Per-host concurrency cap plus adaptive spacing between requests.
+    403/429 responses double the host's delay (or apply Retry-After);
+    successes shrink it back.
+    """
+    
+    def __init__(self, per_host, min_delay=0.0, max_delay=60.0):
+        self.per_host = per_host
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.semaphores = defaultdict(lambda: asyncio.Semaphore(self.per_host))
+        self.delay = defaultdict(lambda: self.min_delay)
+        self.next_allowed = defaultdict(float)
+        self.throttled = defaultdict(int)
+    
+    async def wait(self, host):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if now >= self.next_allowed[host]:
+                self.next_allowed[host] = now + self.delay[host]
+                return
+            await asyncio.sleep(self.next_allowed[host] - now)
+    
+    def backoff(self, host, retry_after=None):
+        self.throttled[host] += 1
+        self.delay[host] = min(self.max_delay, max(self.delay[host] * 2, 0.5))
+        pause = retry_after if retry_after is not None else self.delay[host]
+        loop = asyncio.get_running_loop()
+        self.next_allowed[host] = max(self.next_allowed[host], loop.time() + pause)
+        return pause
+    
+    def success(self, host):
+        self.delay[host] = max(self.min_delay, self.delay[host] * 0.9)
+
+
+def _retry_after(value):
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+class AsyncFashionImageDownloader(FashionImageDownloader):
+    """asyncio downloader with per-host limits, backoff and a resumable manifest"""
+    
+    THROTTLE_STATUSES = {403, 429}
+    RETRY_STATUSES = {403, 429, 500, 502, 503, 504}
+    
+    def __init__(self, output_dir="output", download_dir="downloaded_images", max_connections=64,
+                 per_host=8, retries=4, revalidate=True, store=None, snapshot=None):
+        super().__init__(output_dir=output_dir, download_dir=download_dir, max_workers=max_connections,
+                         snapshot=snapshot)
+        self.store = store
+        self.per_host = per_host
+        self.retries = retries
+        self.revalidate = revalidate
+        self.manifest = DownloadManifest(self.download_dir / "manifest.json")
+        self.stats = defaultdict(int)
+    
+    def target_path(self, image_info, ext):
+        brand_dir = self.download_dir / self.sanitize_filename(image_info['brand'])
+        brand_dir.mkdir(exist_ok=True)
+        filename = f"{self.sanitize_filename(image_info['product_name'])}_{image_info['type']}.{ext}"
+        if len(filename) > 150:
+            url_hash = hashlib.md5(image_info['url'].encode()).hexdigest()[:8]
+            filename = f"{url_hash}_{image_info['type']}.{ext}"
+        return brand_dir / filename
+    
+    async def fetch(self, session, throttle, image_info):
+        """Download one image; returns 'downloaded', 'not_modified', 'skipped' or 'failed'"""
+        url = image_info['url']
+        host = urlparse(url).netloc
+        known = self.manifest.get(url)
+        if known and not self.revalidate:
+            return 'skipped'
+        
+        headers = {}
+        if known:
+            # conditional GET: unchanged images cost a 304, not a full transfer
+            if known.get('etag'):
+                headers['If-None-Match'] = known['etag']
+            if known.get('last_modified'):
+                headers['If-Modified-Since'] = known['last_modified']
+        
+        error = None
+        for attempt in range(self.retries + 1):
+            async with throttle.semaphores[host]:
+                await throttle.wait(host)
+                try:
+                    async with session.get(url, headers=headers) as response:
+                        if response.status == 304 and known:
+                            throttle.success(host)
+                            self.manifest.touch(url)
+                            return 'not_modified'
+                        if response.status in self.THROTTLE_STATUSES and attempt < self.retries:
+                            # the throttle spaces out every request to this host, not just this retry
+                            error = f"HTTP {response.status}"
+                            pause = throttle.backoff(host, _retry_after(response.headers.get('Retry-After')))
+                            logger.debug(f"{host} throttled ({response.status}); backing off {pause:.1f}s")
+                            continue
+                        response.raise_for_status()
+                        
+                        ext = self.get_file_extension(url, response.headers.get('content-type'))
+                        if self.store:
+                            tmp = self.store.objects / f".{hashlib.md5(url.encode()).hexdigest()}.part"
+                        else:
+                            filepath = self.target_path(image_info, ext)
+                            tmp = filepath.with_name(filepath.name + '.part')
+                        digest, size = hashlib.sha256(), 0
+                        with open(tmp, 'wb') as f:
+                            async for chunk in response.content.iter_chunked(65536):
+                                digest.update(chunk)
+                                size += len(chunk)
+                                f.write(chunk)
+                        if self.store:
+                            # byte-identical images from other URLs collapse onto one stored file
+                            filepath = self.store.adopt(tmp, digest.hexdigest(), ext)
+                            self.store.link(url, digest.hexdigest(), image_info.get('product_url'),
+                                            image_info['brand'], image_info['product_name'], image_info['type'])
+                        else:
+                            os.replace(tmp, filepath)
+                        
+                        throttle.success(host)
+                        self.stats['bytes'] += size
+                        self.manifest.record(
+                            url,
+                            path=str(filepath),
+                            etag=response.headers.get('ETag'),
+                            last_modified=response.headers.get('Last-Modified'),
+                            size=size,
+                            sha256=digest.hexdigest(),
+                            brand=image_info['brand'],
+                            product=image_info['product_name'],
+                            product_url=image_info.get('product_url'),
+                            type=image_info['type'],
+                        )
+                        return 'downloaded'
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    error = str(e) or type(e).__name__
+                    status = getattr(e, 'status', None)
+                    if status is not None and status not in self.RETRY_STATUSES:
+                        break
+            # transient failure: exponential backoff with jitter before the next attempt
+            await asyncio.sleep(min(30.0, 0.5 * 2 ** attempt) * (0.5 + random.random()))
+        
+        self.failed_downloads.append({
+            'url': url,
+            'brand': image_info['brand'],
+            'product': image_info['product_name'],
+            'error': error,
+        })
+        return 'failed'
+    
+    async def download_all_async(self, image_list):
+        timeout = aiohttp.ClientTimeout(total=60, connect=10)
+        connector = aiohttp.TCPConnector(limit=self.max_workers, limit_per_host=self.per_host, ttl_dns_cache=300)
+        throttle = HostThrottle(self.per_host)
+        queue = asyncio.Queue()
+        for img in image_list:
+            queue.put_nowait(img)
+        
+        started = time.perf_counter()
+        with tqdm(total=len(image_list), desc="Downloading images") as pbar:
+            async with aiohttp.ClientSession(
+                connector=connector, timeout=timeout, headers=dict(self.session.headers)
+            ) as session:
+                async def worker():
+                    while True:
+                        try:
+                            img = queue.get_nowait()
+                        except asyncio.QueueEmpty:
+                            return
+                        self.stats[await self.fetch(session, throttle, img)] += 1
+                        elapsed = time.perf_counter() - started
+                        pbar.update(1)
+                        pbar.set_postfix(MBps=f"{self.stats['bytes'] / elapsed / 1e6:.1f}",
+                                         new=self.stats['downloaded'], same=self.stats['not_modified'])
+                
+                await asyncio.gather(*[worker() for _ in range(self.max_workers)])
+        self.manifest.save()
+        
+        elapsed = time.perf_counter() - started
+        fetched = self.stats['downloaded'] + self.stats['not_modified']
+        logger.info(
+            f"{fetched} images checked in {elapsed:.1f}s ({fetched / max(elapsed, 1e-9):.1f} images/sec, "
+            f"{self.stats['bytes'] / max(elapsed, 1e-9) / 1e6:.2f} MB/s): "
+            f"{self.stats['downloaded']} new/changed, {self.stats['not_modified']} unchanged, "
+            f"{self.stats['skipped']} skipped, {self.stats['failed']} failed"
+        )
+        throttled = {h: n for h, n in throttle.throttled.items() if n}
+        if throttled:
+            logger.info(f"Throttled hosts (403/429 responses): {throttled}")
+    
+    def download_all_images(self):
+        """Download all images from all JSON files"""
+        if aiohttp is None:
+            raise SystemExit("Async mode needs aiohttp (`pip install aiohttp`), or use --mode threads")
+        unique = {}
+        for img in self.extract_all_image_urls():
+            unique.setdefault(img['url'], img)
+        logger.info(f"Found {len(unique)} unique images ({len(self.manifest.entries)} in manifest)")
+        
+        asyncio.run(self.download_all_async(list(unique.values())))
+        
+        if self.failed_downloads:
+            logger.info("Failed downloads saved to failed_downloads.json")
+            with open('failed_downloads.json', 'w') as f:
+                json.dump(self.failed_downloads, f, indent=2)
+
 def main():
     """Main function"""
-    downloader = FashionImageDownloader(
-        output_dir="output",
-        download_dir="downloaded_images",
-        max_workers=10
-    )
+    parser = argparse.ArgumentParser(description="Download catalog images")
+    parser.add_argument("--mode", choices=["async", "threads"], default="async")
+    parser.add_argument("--output-dir", default="output", help="Catalog JSON directory")
+    parser.add_argument("--snapshot", default=None, help="Read the catalog from a catalog_snapshot.py Parquet file")
+    parser.add_argument("--download-dir", default="downloaded_images")
+    parser.add_argument("--max-connections", type=int, default=64, help="Total concurrent connections (async mode)")
+    parser.add_argument("--per-host", type=int, default=8, help="Concurrent connections per host (async mode)")
+    parser.add_argument("--retries", type=int, default=4, help="Retries per image on 403/429/5xx (async mode)")
+    parser.add_argument("--no-revalidate", action="store_true",
+                        help="Skip images already in the manifest instead of sending conditional GETs")
+    parser.add_argument("--store", default=None,
+                        help="Save into this content-addressed image store (image_store.py) instead of per-brand folders")
+    parser.add_argument("--max-workers", type=int, default=10, help="Threads (threads mode)")
+    args = parser.parse_args()
+    
+    if args.mode == "threads":
+        downloader = FashionImageDownloader(
+            output_dir=args.output_dir,
+            download_dir=args.download_dir,
+            max_workers=args.max_workers,
+            snapshot=args.snapshot
+        )
+    else:
+        downloader = AsyncFashionImageDownloader(
+            output_dir=args.output_dir,
+            download_dir=args.download_dir,
+            max_connections=args.max_connections,
+            per_host=args.per_host,
+            retries=args.retries,
+            revalidate=not args.no_revalidate,
+            store=ImageStore(args.store) if args.store else None,
+            snapshot=args.snapshot,
+        )
     
     downloader.download_all_images()
 
@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+"""
+Bulk Catalog Embedding Pipeline
+
+Embeds every catalog image with the SigLIP model the encoders serve and
+writes the vectors to on-disk shards, optionally upserting them into
+product_embeddings.
+
+Stages:
+  1. read the catalog JSON files (output/, data/raw/), or the --snapshot Parquet file
+  2. resolve each image to its file in the image store or downloaded_images/ (or fetch it)
+  3. decode + resize on a thread pool, prefetching the next batch
+     (or read the pre-resized array from image_cache.py with --resized-cache)
+  4. embed in large batches
+  5. write shard_NNNNN.npy (N x 1152) + shard_NNNNN.jsonl (one id row per vector)
+
+A shard is only counted once both files exist, so an interrupted run
+resumes from the last complete shard: already-embedded images are skipped.
+With --store, images that are byte-identical to one already embedded
+(same sha256 in image_store.py) reuse its vector instead of being decoded
+and embedded again.
+
+Usage:
+    python embed_catalog.py --out embeddings/siglip
+    python embed_catalog.py --out embeddings/siglip --upsert   # also write product_embeddings
+"""
+
+import os
+import io
+import json
+import time
+import logging
+import argparse
+import concurrent.futures
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+import requests
+from PIL import Image
+from tqdm import tqdm
+
+from catalog import downloaded_image_path, iter_products
+from catalog_snapshot import iter_snapshot_products, warn_if_stale
+from image_store import ImageStore
+from image_cache import ResizedImageCache, content_key, pixel_values, resize_for_model
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = "google/siglip-so400m-patch14-384"
+USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+
+# ---------------------------------------------------------------- catalog
+
+def iter_catalog(catalog_dirs: List[str], all_images: bool = False, snapshot: Optional[str] = None) -> Iterator[Dict]:
+    """Yield one record per catalog image, deduplicated by image URL, in a stable order"""
+    seen = set()
+    if snapshot:
+        warn_if_stale(snapshot, catalog_dirs)
+        products = iter_snapshot_products(snapshot)
+    else:
+        products = iter_products(catalog_dirs, dedupe=False)
+    for product in products:
+        for url, image_type in product.image_urls(include_secondary=all_images):
+            if url in seen:
+                continue
+            seen.add(url)
+            yield {
+                'image_id': url,
+                'image_type': image_type,
+                'product_url': product.product_url,
+                'brand': product.brand,
+                'name': product.name,
+            }
+
+
+def local_image_path(images_dir: Path, record: Dict) -> Optional[Path]:
+    """Find the file download_all_images.py saved for this record, if any"""
+    return downloaded_image_path(images_dir, record['brand'], record['name'], record['image_id'], record['image_type'])
+
+
+# ---------------------------------------------------------------- decode
+
+class ImageLoader:
+    """
+    Produce (S, S, 3) uint8 model-size arrays on a thread pool: from the
+    pre-resized cache when possible, else by decoding and resizing
+    (PIL releases the GIL while decoding)
+    """
+
+    def __init__(self, images_dir: str, image_size: int, workers: int, fetch_missing: bool,
+                 store: Optional[ImageStore] = None, resized: Optional[ResizedImageCache] = None):
+        self.images_dir = Path(images_dir)
+        self.store = store
+        self.resized = resized
+        self.image_size = image_size
+        self.fetch_missing = fetch_missing
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="decode")
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': USER_AGENT})
+
+    def load(self, record: Dict) -> np.ndarray:
+        path = self.store.path_for_url(record['image_id']) if self.store else None
+        if path is None:
+            path = local_image_path(self.images_dir, record)
+        if path is not None and self.resized is not None:
+            cached = self.resized.get(record.get('sha256') or content_key(path))
+            if cached is not None:
+                return cached
+        if path is not None:
+            image = Image.open(path)
+        elif self.fetch_missing:
+            response = self.session.get(record['image_id'], timeout=30)
+            response.raise_for_status()
+            image = Image.open(io.BytesIO(response.content))
+        else:
+            raise FileNotFoundError("image not downloaded (use --fetch-missing)")
+        return resize_for_model(image, self.image_size)
+
+    def _safe_load(self, record: Dict):
+        try:
+            return self.load(record)
+        except Exception as e:
+            return e
+
+    def submit(self, records: List[Dict], skip=None) -> List[Optional[concurrent.futures.Future]]:
+        """Start decoding records; those matching skip() get None instead of a future"""
+        return [None if skip and skip(r) else self.pool.submit(self._safe_load, r) for r in records]
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+# ---------------------------------------------------------------- shards
+
+class ShardWriter:
+    """Append-only shard directory with a checkpoint of completed work"""
+
+    def __init__(self, out_dir: str, model_name: str, dtype: str):
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.dtype = np.float16 if dtype == 'float16' else np.float32
+        self.checkpoint_path = self.out_dir / "checkpoint.json"
+        self.checkpoint = self._load_checkpoint(model_name)
+        self.done_ids = set()
+        for ids_path in self.shard_id_files():
+            with open(ids_path, 'r', encoding='utf-8') as f:
+                self.done_ids.update(json.loads(line)['image_id'] for line in f)
+
+    def _load_checkpoint(self, model_name: str) -> Dict:
+        if self.checkpoint_path.exists():
+            checkpoint = json.loads(self.checkpoint_path.read_text())
+            if checkpoint.get('model') != model_name:
+                raise SystemExit(f"{self.out_dir} holds {checkpoint.get('model')} embeddings; use another --out")
+            return checkpoint
+        return {'model': model_name, 'shards': 0, 'embedded': 0, 'failed': 0, 'upserted_shards': [],
+                'seconds': 0.0}
+
+    def shard_id_files(self) -> List[Path]:
+        # ids are written last, so a shard without its .jsonl never completed
+        return [self.out_dir / f"shard_{i:05d}.jsonl" for i in range(self.checkpoint['shards'])]
+
+    def write(self, vectors: np.ndarray, ids: List[Dict]):
+        index = self.checkpoint['shards']
+        stem = self.out_dir / f"shard_{index:05d}"
+        # write-then-rename so a crash never leaves a truncated shard behind
+        with open(f"{stem}.npy.tmp", 'wb') as f:
+            np.save(f, vectors.astype(self.dtype), allow_pickle=False)
+        os.replace(f"{stem}.npy.tmp", f"{stem}.npy")
+        with open(f"{stem}.jsonl.tmp", 'w', encoding='utf-8') as f:
+            for row in ids:
+                f.write(json.dumps(row) + "\n")
+        os.replace(f"{stem}.jsonl.tmp", f"{stem}.jsonl")
+        self.done_ids.update(row['image_id'] for row in ids)
+        self.checkpoint['shards'] += 1
+        self.checkpoint['embedded'] += len(ids)
+        self.save_checkpoint()
+
+    def save_checkpoint(self):
+        tmp = self.checkpoint_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.checkpoint, indent=2))
+        os.replace(tmp, self.checkpoint_path)
+
+    def vectors_by_hash(self) -> Dict[str, np.ndarray]:
+        """sha256 -> vector for every embedded image whose content hash is known"""
+        by_hash = {}
+        for index in range(self.checkpoint['shards']):
+            vectors, ids = self.read_shard(index)
+            for vec, row in zip(vectors, ids):
+                if row.get('sha256'):
+                    by_hash[row['sha256']] = vec
+        return by_hash
+
+    def read_shard(self, index: int):
+        stem = self.out_dir / f"shard_{index:05d}"
+        vectors = np.load(f"{stem}.npy").astype(np.float32)
+        with open(f"{stem}.jsonl", 'r', encoding='utf-8') as f:
+            ids = [json.loads(line) for line in f]
+        return vectors, ids
+
+
+# ---------------------------------------------------------------- model
+
+class Embedder:
+    def __init__(self, model_name: str, device: Optional[str] = None):
+        import torch
+        from transformers import AutoImageProcessor, AutoModel
+        self.torch = torch
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        logger.info(f"Loading {model_name} on {self.device}")
+        self.processor = AutoImageProcessor.from_pretrained(model_name)
+        self.model = AutoModel.from_pretrained(model_name, low_cpu_mem_usage=True).to(self.device).eval()
+        self.image_size = self.processor.size["height"]
+
+    def __call__(self, images: List[np.ndarray]) -> np.ndarray:
+        """Embed (S, S, 3) uint8 arrays already resized to the model's input size"""
+        batch = pixel_values(np.stack(images), self.processor.image_mean, self.processor.image_std)
+        with self.torch.inference_mode():
+            feats = self.model.get_image_features(pixel_values=self.torch.from_numpy(batch).to(self.device))
+            feats = self.torch.nn.functional.normalize(feats, dim=-1)
+        return feats.float().cpu().numpy()
+
+
+# ---------------------------------------------------------------- upsert
+
+class EmbeddingUpserter:
+    """Bulk-upsert shard rows into product_embeddings, matching products by url"""
+
+    def __init__(self, model_name: str, batch_size: int = 500):
+        self.base = os.getenv("SUPABASE_URL", "").rstrip("/")
+        key = os.getenv("SUPABASE_SERVICE_ROLE_KEY", "")
+        if not self.base or not key:
+            raise SystemExit("--upsert needs SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY")
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.session = requests.Session()
+        self.session.headers.update({"apikey": key, "Authorization": f"Bearer {key}"})
+        self.product_ids = self._product_ids()
+
+    def _product_ids(self) -> Dict[str, str]:
+        ids, offset, page = {}, 0, 1000
+        while True:
+            r = self.session.get(f"{self.base}/rest/v1/products",
+                                 params={"select": "id,url", "order": "id", "limit": page, "offset": offset},
+                                 timeout=60)
+            r.raise_for_status()
+            rows = r.json()
+            ids.update({row["url"]: row["id"] for row in rows if row.get("url")})
+            if len(rows) < page:
+                return ids
+            offset += page
+
+    def upsert(self, vectors: np.ndarray, ids: List[Dict]) -> int:
+        rows = []
+        for vec, meta in zip(vectors, ids):
+            product_id = self.product_ids.get(meta.get('product_url'))
+            if not product_id:
+                continue
+            rows.append({
+                "product_id": product_id,
+                "image_id": meta['image_id'],
+                "model_id": self.model_name,
+                "dimensions": int(vec.shape[0]),
+                "embedding": "[" + ",".join(f"{x:.6g}" for x in vec) + "]",
+            })
+        for i in range(0, len(rows), self.batch_size):
+            r = self.session.post(
+                f"{self.base}/rest/v1/product_embeddings",
+                params={"on_conflict": "product_id,image_id,model_id"},
+                headers={"Prefer": "resolution=merge-duplicates,return=minimal"},
+                json=rows[i:i + self.batch_size],
+                timeout=120,
+            )
+            r.raise_for_status()
+        return len(rows)
+
+
+# ---------------------------------------------------------------- pipeline
+
+def batched(items: List, size: int) -> Iterator[List]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def run(args):
+    writer = ShardWriter(args.out, args.model, args.dtype)
+    records = [r for r in iter_catalog(args.catalog_dirs, args.all_images, args.snapshot) if r['image_id'] not in writer.done_ids]
+    if args.limit:
+        records = records[:args.limit]
+    logger.info(f"{len(writer.done_ids)} images already embedded in {writer.checkpoint['shards']} shards; "
+                f"{len(records)} to go")
+
+    if records:
+        store = ImageStore(args.store) if args.store else None
+        by_hash, claimed = {}, set()
+        if store:
+            for record in records:
+                record['sha256'] = store.hash_for_url(record['image_id'])
+            by_hash = writer.vectors_by_hash()
+
+        def is_duplicate(record):
+            # byte-identical to an image that is embedded, or will be by an earlier item
+            sha = record.get('sha256')
+            if not sha:
+                return False
+            if sha in by_hash or sha in claimed:
+                return True
+            claimed.add(sha)
+            return False
+
+        embedder = Embedder(args.model, args.device)
+        resized = ResizedImageCache(args.resized_cache, embedder.image_size) if args.resized_cache else None
+        loader = ImageLoader(args.images_dir, embedder.image_size, args.workers, args.fetch_missing, store, resized)
+        # failures are retried on every run, so only this run's count is kept
+        writer.checkpoint['failed'] = 0
+        failures = open(Path(args.out) / "failures.jsonl", 'w', encoding='utf-8')
+        pending_vecs, pending_ids = [], []
+        started, embedded, reused = time.perf_counter(), 0, 0
+
+        def fail(record, error):
+            failures.write(json.dumps({'image_id': record['image_id'], 'error': error}) + "\n")
+            writer.checkpoint['failed'] += 1
+
+        batches = list(batched(records, args.batch_size))
+        # keep the next batch decoding while the current one runs through the model
+        inflight = loader.submit(batches[0], is_duplicate)
+        try:
+            with tqdm(total=len(records), desc="Embedding", unit="img") as pbar:
+                for n, batch in enumerate(batches):
+                    results = [f.result() if f is not None else None for f in inflight]
+                    if n + 1 < len(batches):
+                        inflight = loader.submit(batches[n + 1], is_duplicate)
+                    images, kept, duplicates = [], [], []
+                    for record, result in zip(batch, results):
+                        if result is None:
+                            duplicates.append(record)
+                        elif isinstance(result, Exception):
+                            fail(record, str(result))
+                        else:
+                            images.append(result)
+                            kept.append(record)
+                    if images:
+                        vectors = embedder(images)
+                        pending_vecs.append(vectors)
+                        pending_ids.extend(kept)
+                        embedded += len(images)
+                        for record, vec in zip(kept, vectors):
+                            if record.get('sha256'):
+                                by_hash[record['sha256']] = vec
+                    for record in duplicates:
+                        vec = by_hash.get(record['sha256'])
+                        if vec is None:
+                            fail(record, "duplicate of an image that failed to load")
+                            continue
+                        pending_vecs.append(vec[None, :])
+                        pending_ids.append(record)
+                        reused += 1
+                    if len(pending_ids) >= args.shard_size or (n + 1 == len(batches) and pending_ids):
+                        writer.write(np.concatenate(pending_vecs), pending_ids)
+                        pending_vecs, pending_ids = [], []
+                    pbar.update(len(batch))
+                    pbar.set_postfix(img_s=f"{embedded / (time.perf_counter() - started):.1f}")
+        finally:
+            loader.close()
+            failures.close()
+            elapsed = time.perf_counter() - started
+            writer.checkpoint['seconds'] = round(writer.checkpoint['seconds'] + elapsed, 1)
+            writer.save_checkpoint()
+
+        logger.info(f"Embedded {embedded} images in {elapsed:.1f}s ({embedded / max(elapsed, 1e-9):.1f} images/sec), "
+                    f"reused {reused} byte-identical; {writer.checkpoint['failed']} failures logged to {Path(args.out) / 'failures.jsonl'}")
+
+    if args.upsert:
+        upserter = EmbeddingUpserter(args.model, args.upsert_batch_size)
+        done = set(writer.checkpoint['upserted_shards'])
+        for index in tqdm(range(writer.checkpoint['shards']), desc="Upserting shards"):
+            if index in done:
+                continue
+            vectors, ids = writer.read_shard(index)
+            written = upserter.upsert(vectors, ids)
+            logger.info(f"shard {index}: upserted {written}/{len(ids)} rows (rest have no matching product url)")
+            writer.checkpoint['upserted_shards'].append(index)
+            writer.save_checkpoint()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embed the product catalog into on-disk shards")
+    parser.add_argument("--catalog-dirs", nargs="+", default=["output", "data/raw"], help="Directories of catalog JSON files")
+    parser.add_argument("--snapshot", default=None, help="Read the catalog from a catalog_snapshot.py Parquet file")
+    parser.add_argument("--images-dir", default="downloaded_images", help="Where download_all_images.py saved images")
+    parser.add_argument("--store", default=None, help="image_store.py directory to read images from (enables dedup)")
+    parser.add_argument("--resized-cache", default=None, help="image_cache.py directory of pre-resized images")
+    parser.add_argument("--out", default="embeddings/siglip", help="Shard output directory")
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--device", default=None, help="cuda / cpu (default: auto)")
+    parser.add_argument("--batch-size", type=int, default=64, help="Images per forward pass")
+    parser.add_argument("--shard-size", type=int, default=4096, help="Vectors per shard / checkpoint")
+    parser.add_argument("--workers", type=int, default=8, help="Decode threads")
+    parser.add_argument("--dtype", choices=["float16", "float32"], default="float16", help="Shard storage dtype")
+    parser.add_argument("--all-images", action="store_true", help="Embed secondary images too, not just mainImage")
+    parser.add_argument("--fetch-missing", action="store_true", help="Download images missing from --images-dir")
+    parser.add_argument("--limit", type=int, default=0, help="Only embed this many new images")
+    parser.add_argument("--upsert", action="store_true", help="Bulk-upsert shards into product_embeddings")
+    parser.add_argument("--upsert-batch-size", type=int, default=500)
+    args = parser.parse_args()
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
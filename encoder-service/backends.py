@@ -0,0 +1,124 @@
+"""
+Inference backends for the SigLIP vision tower.
+
+Selected with INFERENCE_BACKEND:
+  - torch: fp32 PyTorch (default)
+  - int8:  PyTorch dynamic int8 quantization of the Linear layers (CPU)
+  - onnx:  ONNX Runtime over an export of get_image_features; set
+           ONNX_QUANTIZE=1 to also apply ORT dynamic int8 quantization
+
+Every backend maps pixel_values (N, 3, H, W) to unnormalized float32
+image features (N, D); callers L2-normalize. int8 and onnx keep only their
+own copy of the vision tower, so the caller can drop the fp32 model.
+"""
+
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("torch", "int8", "onnx")
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch")
+ONNX_MODEL_PATH = os.getenv("ONNX_MODEL_PATH", "onnx/siglip_vision.onnx")
+ONNX_QUANTIZE = os.getenv("ONNX_QUANTIZE", "0") == "1"
+ONNX_THREADS = int(os.getenv("ONNX_THREADS", "0"))  # 0 = ORT default
+
+
+class TorchBackend:
+    name = "torch"
+
+    def __init__(self, model, device: str):
+        self.model = model
+        self.device = device
+
+    def __call__(self, pixel_values: torch.Tensor) -> np.ndarray:
+        with torch.no_grad():
+            feats = self.model.get_image_features(pixel_values=pixel_values.to(self.device))
+        return feats.float().cpu().numpy()
+
+
+class _VisionFeatures(torch.nn.Module):
+    """get_image_features over the vision tower alone (the pooled output)"""
+
+    def __init__(self, vision_model):
+        super().__init__()
+        self.vision_model = vision_model
+
+    def forward(self, pixel_values):
+        return self.vision_model(pixel_values=pixel_values).pooler_output
+
+
+class Int8Backend:
+    name = "int8"
+
+    def __init__(self, model, device: str):
+        if device != "cpu":
+            raise ValueError("int8 dynamic quantization is CPU-only")
+        # only the vision tower runs in get_image_features; quantize_dynamic returns a
+        # quantized deep copy of it and leaves the caller's model untouched
+        self.model = _VisionFeatures(torch.quantization.quantize_dynamic(
+            model.vision_model, {torch.nn.Linear}, dtype=torch.qint8
+        )).eval()
+        self.device = device
+
+    def __call__(self, pixel_values: torch.Tensor) -> np.ndarray:
+        with torch.no_grad():
+            feats = self.model(pixel_values.to(self.device))
+        return feats.float().cpu().numpy()
+
+
+def export_onnx(model, image_size: int, path: str, quantize: bool = False) -> str:
+    """Export get_image_features to ONNX with a dynamic batch axis; returns the model path."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    dummy = torch.zeros(1, 3, image_size, image_size)
+    logger.info(f"Exporting vision tower to {path}")
+    torch.onnx.export(
+        _VisionFeatures(model.vision_model.cpu().eval()), (dummy,), str(path),
+        input_names=["pixel_values"], output_names=["image_embeds"],
+        dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+        opset_version=17,
+    )
+    if not quantize:
+        return str(path)
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    qpath = path.with_name(f"{path.stem}.int8{path.suffix}")
+    quantize_dynamic(str(path), str(qpath), weight_type=QuantType.QInt8)
+    return str(qpath)
+
+
+class OnnxBackend:
+    name = "onnx"
+
+    def __init__(self, model, device: str, image_size: int, path: str = ONNX_MODEL_PATH, quantize: bool = ONNX_QUANTIZE):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise RuntimeError("INFERENCE_BACKEND=onnx needs `pip install onnx onnxruntime`")
+        target = Path(path)
+        if quantize:
+            target = target.with_name(f"{target.stem}.int8{target.suffix}")
+        model_path = str(target) if target.exists() else export_onnx(model, image_size, path, quantize)
+        opts = ort.SessionOptions()
+        if ONNX_THREADS:
+            opts.intra_op_num_threads = ONNX_THREADS
+        self.session = ort.InferenceSession(model_path, opts, providers=["CPUExecutionProvider"])
+        self.model_path = model_path
+
+    def __call__(self, pixel_values: torch.Tensor) -> np.ndarray:
+        (feats,) = self.session.run(None, {"pixel_values": pixel_values.cpu().numpy().astype(np.float32)})
+        return feats.astype(np.float32)
+
+
+def load_backend(name: str, model, device: str, image_size: int):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown INFERENCE_BACKEND {name!r}; use one of {', '.join(BACKENDS)}")
+    if name == "int8":
+        return Int8Backend(model, device)
+    if name == "onnx":
+        return OnnxBackend(model, device, image_size)
+    return TorchBackend(model, device)
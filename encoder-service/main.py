@@ -6,18 +6,26 @@ GET /healthz - health check
 """
 
 import os
+import gc
 import io
 import logging
 import time
-from typing import List
+import base64
+import asyncio
+import urllib.parse
+import urllib.request
+from typing import List, Optional, Union
 import uvicorn
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from PIL import Image
 import torch
-import torch.nn.functional as F
-from transformers import AutoImageProcessor, AutoModel
 import numpy as np
+from batcher import MicroBatcher, QueueFullError
+from wire import negotiate, encode_one, encode_many
+from backends import INFERENCE_BACKEND, load_backend
+from model_store import MODEL_CACHE_DIR, load_pretrained, warmup
+from tracing import trace_requests
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -34,43 +42,89 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.middleware("http")(trace_requests)
+
 # Global model variables
 processor = None
 model = None
+backend = None
 model_loaded = False
+model_ready = False  # loaded and warmed up
+startup_task: Optional[asyncio.Task] = None
+startup_error: Optional[str] = None
+startup_timings: dict = {}
 
 # Configuration
 MODEL_NAME = "google/siglip-so400m-patch14-384"
 MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
 ALLOWED_MIME_TYPES = {"image/jpeg", "image/jpg", "image/png", "image/webp"}
+EMBED_DIM = 1152
+MAX_BATCH_SIZE = int(os.getenv("EMBED_MAX_BATCH_SIZE", "16"))
+MAX_WAIT_MS = float(os.getenv("EMBED_MAX_WAIT_MS", "5"))
+MAX_QUEUE = int(os.getenv("EMBED_MAX_QUEUE", "256"))
+MAX_BATCH_ITEMS = int(os.getenv("EMBED_MAX_BATCH_ITEMS", "64"))
+URL_FETCH_TIMEOUT = float(os.getenv("URL_FETCH_TIMEOUT", "15"))
 
 def load_model():
-    """Load SigLIP model and processor"""
-    global processor, model, model_loaded
+    """Load SigLIP model and processor from the local snapshot, then warm up"""
+    global processor, model, backend, model_loaded, model_ready
     
-    if model_loaded:
+    if model_ready:
         return
     
     try:
         logger.info(f"Loading model: {MODEL_NAME}")
         start_time = time.time()
         
-        processor = AutoImageProcessor.from_pretrained(MODEL_NAME)
-        model = AutoModel.from_pretrained(MODEL_NAME)
+        # memory-mapped safetensors from MODEL_CACHE_DIR; downloaded once if missing
+        processor, model, timings = load_pretrained(MODEL_NAME, MODEL_CACHE_DIR)
         
         # Move to GPU if available
         device = "cuda" if torch.cuda.is_available() else "cpu"
         model = model.to(device)
-        model.eval()
         
-        load_time = time.time() - start_time
-        logger.info(f"Model loaded successfully in {load_time:.2f}s on {device}")
+        # fp32 torch by default; int8 / onnx for faster, smaller CPU inference
+        backend = load_backend(INFERENCE_BACKEND, model, device, processor.size["height"])
+        if backend.name != "torch":
+            # int8 / onnx hold their own vision tower; release the fp32 weights
+            model = None
+            gc.collect()
+        timings["backend_seconds"] = round(time.time() - start_time - timings["snapshot_seconds"] - timings["load_seconds"], 3)
         model_loaded = True
         
+        # first forward passes pay for kernel selection and allocator growth; do it before reporting ready
+        timings["warmup_seconds"] = round(warmup(embed_images, processor.size["height"]), 3)
+        timings["total_seconds"] = round(time.time() - start_time, 3)
+        startup_timings.update(timings)
+        
+        logger.info(f"Model ready in {timings['total_seconds']:.2f}s on {device} ({backend.name} backend): {timings}")
+        model_ready = True
+        
     except Exception as e:
         logger.error(f"Failed to load model: {e}")
         raise RuntimeError(f"Model loading failed: {e}")
 
+async def ensure_model():
+    """Wait for the startup load, starting one if none is running; 503 if it failed"""
+    global startup_task, startup_error
+    if model_ready:
+        return
+    if startup_task is None or (startup_task.done() and startup_error):
+        logger.info("Cold start: loading model...")
+        startup_error = None
+        startup_task = asyncio.create_task(_load_in_background())
+    await asyncio.shield(startup_task)
+    if not model_ready:
+        raise HTTPException(status_code=503, detail="Model loading failed")
+
+async def _load_in_background():
+    global startup_error
+    try:
+        # off the event loop, so /healthz keeps answering while weights load
+        await asyncio.to_thread(load_model)
+    except Exception as e:
+        startup_error = str(e)
+
 def validate_image(file: UploadFile) -> None:
     """Validate uploaded image file"""
     # Check file size
@@ -87,82 +141,121 @@ def validate_image(file: UploadFile) -> None:
             detail=f"Invalid file type. Allowed types: {', '.join(ALLOWED_MIME_TYPES)}"
         )
 
-def process_image(image_bytes: bytes) -> List[float]:
-    """Process image and return L2-normalized embedding"""
-    try:
-        # Load and validate image
-        image = Image.open(io.BytesIO(image_bytes))
-        
-        # Convert to RGB if necessary
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        # Process image
-        inputs = processor(images=image, return_tensors="pt")
-        
-        # Move to same device as model
-        device = next(model.parameters()).device
-        inputs = {k: v.to(device) for k, v in inputs.items()}
-        
-        # Generate embedding
-        with torch.no_grad():
-            outputs = model.get_image_features(**inputs)
-            
-        # L2 normalize
-        embedding = F.normalize(outputs, p=2, dim=1)
-        
-        # Convert to list
-        embedding_list = embedding.cpu().numpy().flatten().tolist()
-        
-        # Verify dimensions
-        if len(embedding_list) != 1152:
-            raise ValueError(f"Expected 1152 dimensions, got {len(embedding_list)}")
-        
-        return embedding_list
+def decode_image(image_bytes: bytes) -> Image.Image:
+    """Decode image bytes into an RGB PIL image"""
+    image = Image.open(io.BytesIO(image_bytes))
+    
+    # Convert to RGB if necessary
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image
+
+def embed_images(images: List[Image.Image]) -> np.ndarray:
+    """Run one forward pass over a batch of images, return (N, 1152) L2-normalized float32"""
+    inputs = processor(images=images, return_tensors="pt")
+    
+    # Generate embeddings
+    outputs = backend(inputs["pixel_values"])
         
+    # L2 normalize
+    norms = np.linalg.norm(outputs, axis=1, keepdims=True)
+    embeddings = (outputs / np.maximum(norms, 1e-12)).astype(np.float32)
+    
+    # Verify dimensions
+    if embeddings.shape[1] != EMBED_DIM:
+        raise ValueError(f"Expected {EMBED_DIM} dimensions, got {embeddings.shape[1]}")
+    
+    return embeddings
+
+def run_batch(items: List[bytes]) -> List[Union[np.ndarray, Exception]]:
+    """Batcher worker: decode each item, embed the decodable ones together"""
+    results: List[Union[np.ndarray, Exception]] = [None] * len(items)
+    images, positions = [], []
+    for i, image_bytes in enumerate(items):
+        try:
+            images.append(decode_image(image_bytes))
+            positions.append(i)
+        except Exception as e:
+            results[i] = ValueError(f"Could not decode image: {e}")
+    if images:
+        embeddings = embed_images(images)
+        for pos, vec in zip(positions, embeddings):
+            results[pos] = vec
+    return results
+
+batcher = MicroBatcher(run_batch, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, max_queue=MAX_QUEUE)
+
+async def process_image(image_bytes: bytes) -> np.ndarray:
+    """Process image through the micro-batcher and return L2-normalized embedding"""
+    try:
+        return await batcher.submit(image_bytes)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         logger.error(f"Image processing failed: {e}")
         raise HTTPException(status_code=500, detail=f"Image processing failed: {str(e)}")
 
 @app.on_event("startup")
 async def startup_event():
-    """Load model on startup"""
-    try:
-        load_model()
-    except Exception as e:
-        logger.error(f"Failed to load model on startup: {e}")
-        # Don't fail startup, allow cold-start loading
+    """Start loading the model; /readyz turns 200 once it is loaded and warmed up"""
+    global startup_task
+    await batcher.start()
+    # a failed load is retried by the next request (see ensure_model)
+    startup_task = asyncio.create_task(_load_in_background())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await batcher.stop()
 
 @app.get("/healthz")
 async def health_check():
     """Health check endpoint"""
     global model_loaded
     
+    if model_ready:
+        status = "healthy"
+    elif startup_error:
+        status = "failed"
+    else:
+        status = "loading"
     return {
-        "status": "healthy" if model_loaded else "loading",
+        "status": status,
+        "ready": model_ready,
         "model_loaded": model_loaded,
         "model_name": MODEL_NAME,
-        "device": "cuda" if torch.cuda.is_available() else "cpu"
+        "startup": {**startup_timings, "error": startup_error},
+        "backend": INFERENCE_BACKEND,
+        "device": "cuda" if torch.cuda.is_available() else "cpu",
+        "batching": batcher.snapshot()
     }
 
+@app.get("/readyz")
+async def readiness_check():
+    """Readiness probe: 503 until the model is loaded and warmed up"""
+    if not model_ready:
+        raise HTTPException(status_code=503, detail=startup_error or "loading")
+    return {"ready": True, **startup_timings}
+
 @app.post("/embed")
-async def embed_image(image: UploadFile = File(...)):
+async def embed_image(
+    request: Request,
+    image: UploadFile = File(...),
+    encoding: Optional[str] = Query(None),
+    dtype: Optional[str] = Query(None),
+):
     """
     Generate L2-normalized embedding for uploaded image
-    Returns: {"embedding": [1152 float values]}
+    Returns: {"embedding": [1152 float values]} by default; see wire.py for
+    the binary (Accept: application/octet-stream) and base64 formats
     """
     request_start = time.time()
+    fmt, dtype = negotiate(request, encoding, dtype)
     
     # Validate file
     validate_image(image)
     
-    # Handle cold start
-    if not model_loaded:
-        logger.info("Cold start: loading model...")
-        try:
-            load_model()
-        except Exception as e:
-            raise HTTPException(status_code=503, detail="Model loading failed")
+    # Wait for the startup load if this request beat it
+    await ensure_model()
     
     try:
         # Read image bytes
@@ -172,12 +265,12 @@ async def embed_image(image: UploadFile = File(...)):
         logger.info(f"Processing image: {image.filename}, size: {len(image_bytes)} bytes")
         
         # Process image
-        embedding = process_image(image_bytes)
+        embedding = await process_image(image_bytes)
         
         process_time = time.time() - request_start
         logger.info(f"Embedding generated in {process_time:.3f}s")
         
-        return {"embedding": embedding}
+        return encode_one(embedding, fmt, dtype)
         
     except HTTPException:
         raise
@@ -185,6 +278,105 @@ async def embed_image(image: UploadFile = File(...)):
         logger.error(f"Unexpected error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+URL_SCHEMES = ("http", "https")
+
+def check_url_scheme(url: str):
+    # urlopen would also read file:// (local files) and ftp://
+    scheme = urllib.parse.urlsplit(url).scheme.lower()
+    if scheme not in URL_SCHEMES:
+        raise ValueError(f"Unsupported URL scheme {scheme!r}; use http or https")
+
+class _HTTPOnlyRedirects(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        check_url_scheme(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+_url_opener = urllib.request.build_opener(_HTTPOnlyRedirects)
+
+def fetch_url(url: str) -> bytes:
+    """Download an http(s) image URL, enforcing the upload size limit"""
+    check_url_scheme(url)
+    req = urllib.request.Request(url, headers={"User-Agent": "siglip-embedding-service"})
+    with _url_opener.open(req, timeout=URL_FETCH_TIMEOUT) as resp:
+        data = resp.read(MAX_FILE_SIZE + 1)
+    if len(data) > MAX_FILE_SIZE:
+        raise ValueError(f"Image larger than {MAX_FILE_SIZE // (1024*1024)}MB")
+    return data
+
+async def resolve_batch_inputs(images: List[UploadFile], urls: List[str], b64: List[str]) -> List[Union[bytes, Exception]]:
+    """Turn every batch input into bytes, or the error that prevented it"""
+    items: List[Union[bytes, Exception]] = []
+    for upload in images:
+        try:
+            validate_image(upload)
+            items.append(await upload.read())
+        except HTTPException as e:
+            items.append(ValueError(e.detail))
+    fetched = await asyncio.gather(*[asyncio.to_thread(fetch_url, u) for u in urls], return_exceptions=True)
+    items.extend(fetched)
+    for encoded in b64:
+        try:
+            # tolerate data URLs as well as bare base64
+            if encoded.startswith("data:"):
+                encoded = encoded.split(",", 1)[1]
+            items.append(base64.b64decode(encoded, validate=True))
+        except Exception as e:
+            items.append(ValueError(f"Invalid base64: {e}"))
+    return items
+
+@app.post("/embed/batch")
+async def embed_batch(
+    request: Request,
+    images: Optional[List[UploadFile]] = File(None),
+    urls: Optional[List[str]] = Form(None),
+    b64: Optional[List[str]] = Form(None),
+    encoding: Optional[str] = Query(None),
+    dtype: Optional[str] = Query(None),
+):
+    """
+    Embed many images in one request. Inputs may be any mix of multipart files
+    (`images`), image URLs (`urls`) and base64 strings (`b64`); results are
+    returned in that order.
+    Returns: {"embeddings": [[1152 floats] | null, ...], "errors": [{"index", "error"}], ...}
+    With a compact format (see wire.py) the result is one N x 1152 matrix.
+    """
+    request_start = time.time()
+    fmt, dtype = negotiate(request, encoding, dtype)
+    images, urls, b64 = images or [], urls or [], b64 or []
+    total = len(images) + len(urls) + len(b64)
+    if total == 0:
+        raise HTTPException(status_code=400, detail="Provide images, urls or b64")
+    if total > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Too many items: {total} > {MAX_BATCH_ITEMS}")
+    
+    # Wait for the startup load if this request beat it
+    await ensure_model()
+    
+    items = await resolve_batch_inputs(images, urls, b64)
+    
+    async def _submit(item):
+        if isinstance(item, Exception):
+            return item
+        try:
+            return await batcher.submit(item)
+        except Exception as e:
+            return e
+    
+    # items go through the batcher together, sharing forward passes with other traffic
+    results = await asyncio.gather(*[_submit(item) for item in items])
+    
+    embeddings, errors = [], []
+    for i, result in enumerate(results):
+        if isinstance(result, Exception):
+            embeddings.append(None)
+            errors.append({"index": i, "error": str(result)})
+        else:
+            embeddings.append(result)
+    
+    logger.info(f"Batch of {total} embedded in {time.time() - request_start:.3f}s ({len(errors)} errors)")
+    return encode_many(embeddings, EMBED_DIM, errors, fmt, dtype,
+                       extra={"count": total, "dim": EMBED_DIM, "model": MODEL_NAME})
+
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8001))
     uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Fast model startup.
+
+The first load downloads the model from the Hub and writes a local
+safetensors snapshot to MODEL_CACHE_DIR. Later loads read that snapshot
+with local_files_only (no Hub round-trips) and low_cpu_mem_usage, so the
+weights are memory-mapped straight into the model instead of being
+randomly initialised and then overwritten. Replicas that share the cache
+volume, or images that bake it in with `python model_store.py`, skip the
+download entirely.
+
+warmup() runs synthetic batches through the model so the first real
+request doesn't pay for kernel selection and allocator growth.
+
+Usage (pre-populate the cache, e.g. at image build time):
+    python model_store.py [--model google/siglip-so400m-patch14-384] [--cache-dir model_cache]
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", "model_cache")
+WARMUP_BATCH_SIZE = int(os.getenv("WARMUP_BATCH_SIZE", "4"))
+WARMUP_ITERS = int(os.getenv("WARMUP_ITERS", "2"))  # 0 disables warmup
+
+
+def snapshot_dir(model_name: str, cache_dir: str = MODEL_CACHE_DIR) -> Path:
+    return Path(cache_dir) / model_name.replace("/", "--")
+
+
+def has_snapshot(path: Path) -> bool:
+    return (path / "config.json").exists() and any(path.glob("*.safetensors"))
+
+
+def ensure_snapshot(model_name: str, cache_dir: str = MODEL_CACHE_DIR, model_cls=None, processor_cls=None) -> Path:
+    """Return the local safetensors snapshot for model_name, creating it if missing."""
+    from transformers import AutoImageProcessor, AutoModel
+    model_cls = model_cls or AutoModel
+    processor_cls = processor_cls or AutoImageProcessor
+
+    target = snapshot_dir(model_name, cache_dir)
+    if has_snapshot(target):
+        return target
+
+    logger.info(f"No local snapshot for {model_name}; downloading into {target}")
+    # write next to the target and rename, so a replica never sees a half-written snapshot
+    tmp = target.with_name(f"{target.name}.tmp-{os.getpid()}")
+    shutil.rmtree(tmp, ignore_errors=True)
+    processor_cls.from_pretrained(model_name).save_pretrained(tmp)
+    model_cls.from_pretrained(model_name, low_cpu_mem_usage=True).save_pretrained(tmp, safe_serialization=True)
+    try:
+        tmp.rename(target)
+    except OSError:
+        # another replica finished first
+        shutil.rmtree(tmp, ignore_errors=True)
+    return target
+
+
+def load_pretrained(model_name: str, cache_dir: str = MODEL_CACHE_DIR, model_cls=None, processor_cls=None):
+    """
+    Load (processor, model) from the local snapshot with memory-mapped weights.
+    Returns (processor, model, timings) where timings has snapshot_seconds and load_seconds.
+    """
+    from transformers import AutoImageProcessor, AutoModel
+    model_cls = model_cls or AutoModel
+    processor_cls = processor_cls or AutoImageProcessor
+
+    start = time.perf_counter()
+    path = ensure_snapshot(model_name, cache_dir, model_cls, processor_cls)
+    snapshot_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    processor = processor_cls.from_pretrained(path, local_files_only=True)
+    model = model_cls.from_pretrained(path, local_files_only=True, use_safetensors=True, low_cpu_mem_usage=True)
+    model.eval()
+    timings = {
+        "snapshot_seconds": round(snapshot_seconds, 3),
+        "load_seconds": round(time.perf_counter() - start, 3),
+        "snapshot_path": str(path),
+    }
+    return processor, model, timings
+
+
+def warmup(embed: Callable[[List[Image.Image]], object], image_size: int,
+           batch_size: int = WARMUP_BATCH_SIZE, iters: int = WARMUP_ITERS) -> float:
+    """Run `iters` synthetic batches through embed(); returns elapsed seconds."""
+    if iters <= 0 or batch_size <= 0:
+        return 0.0
+    images = [Image.new("RGB", (image_size, image_size), (127, 127, 127))] * batch_size
+    start = time.perf_counter()
+    for _ in range(iters):
+        embed(images)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-populate the local model snapshot")
+    parser.add_argument("--model", default="google/siglip-so400m-patch14-384")
+    parser.add_argument("--cache-dir", default=MODEL_CACHE_DIR)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    _, _, timings = load_pretrained(args.model, args.cache_dir)
+    logger.info(f"Snapshot ready: {timings}")
+
+
+if __name__ == "__main__":
+    main()
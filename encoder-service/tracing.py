@@ -0,0 +1,31 @@
+"""
+Request tracing shared by encoder-service and encoder_server.
+
+The backend sends an X-Trace-Id with each encoder call. trace_requests
+echoes it back and reports how long the app spent on the request as a
+Server-Timing header, so the caller can separate encoder time from
+network time. Traced requests are also logged with their id.
+
+Register it with:
+    app.middleware("http")(trace_requests)
+"""
+
+import logging
+import time
+
+from fastapi import Request
+
+logger = logging.getLogger(__name__)
+
+
+async def trace_requests(request: Request, call_next):
+    """Echo the caller's X-Trace-Id and report the handling time as Server-Timing"""
+    trace_id = request.headers.get("x-trace-id")
+    start = time.perf_counter()
+    response = await call_next(request)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    response.headers["Server-Timing"] = f"app;dur={elapsed_ms:.1f}"
+    if trace_id:
+        response.headers["X-Trace-Id"] = trace_id
+        logger.info(f"trace={trace_id} {request.method} {request.url.path} {response.status_code} {elapsed_ms:.1f}ms")
+    return response
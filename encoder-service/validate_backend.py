@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Validate an inference backend against the fp32 reference.
+
+Embeds a sample of catalog images with the fp32 torch backend and with the
+candidate backend, each in its own process so latency and memory are
+measured independently, then reports:
+  - cosine agreement between the two embeddings of each image
+  - overlap of the top-k neighbours each backend retrieves within the sample
+  - per-image latency, and peak RSS while serving: the high-water mark is
+    reset once the backend is built and the fp32 model is released, so
+    loading doesn't hide what the backend keeps resident (Linux; elsewhere
+    only the lifetime peak is available)
+
+Usage:
+    python validate_backend.py --backend int8 --images ../downloaded_images --sample 200
+"""
+
+import argparse
+import ctypes
+import gc
+import json
+import logging
+import multiprocessing as mp
+import random
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+
+
+def sample_images(root: str, n: int, seed: int = 0):
+    paths = sorted(p for p in Path(root).rglob("*") if p.suffix.lower() in IMAGE_EXTENSIONS)
+    if not paths:
+        raise SystemExit(f"No images found under {root}")
+    random.Random(seed).shuffle(paths)
+    return [str(p) for p in paths[:n]]
+
+
+def peak_rss_mb() -> float:
+    """Lifetime peak RSS, including model loading"""
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def _status_mb(field: str):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss() -> bool:
+    """Free what was released and restart the VmHWM high-water mark from current RSS"""
+    gc.collect()
+    try:
+        # hand freed heap back to the OS so the reset starts from live memory only
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+    try:
+        # "5" resets the peak RSS (VmHWM) to the current RSS
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def serving_peak_rss_mb() -> float:
+    """Peak RSS since reset_peak_rss(); the lifetime peak if it couldn't be reset"""
+    hwm = _status_mb("VmHWM")
+    return hwm if hwm is not None else peak_rss_mb()
+
+
+def _run_backend(name: str, model_name: str, paths, batch_size: int, out_path: str, result_queue):
+    """Child process: load model + backend, embed all paths, report timings."""
+    import torch
+    from PIL import Image
+    from transformers import AutoImageProcessor, AutoModel
+    from backends import load_backend
+
+    t0 = time.perf_counter()
+    processor = AutoImageProcessor.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+    backend = load_backend(name, model, "cpu", processor.size["height"])
+    if name != "torch":
+        del model  # keep only what the backend needs resident
+    load_s = time.perf_counter() - t0
+    load_peak_mb = peak_rss_mb()
+    hwm_reset = reset_peak_rss()
+    resident_mb = _status_mb("VmRSS")
+
+    images = [Image.open(p).convert("RGB") for p in paths]
+    # warm up so the first batch's one-off costs don't skew latency
+    backend(processor(images=images[:1], return_tensors="pt")["pixel_values"])
+
+    feats, infer_s = [], 0.0
+    for i in range(0, len(images), batch_size):
+        pixel_values = processor(images=images[i:i + batch_size], return_tensors="pt")["pixel_values"]
+        t = time.perf_counter()
+        feats.append(backend(pixel_values))
+        infer_s += time.perf_counter() - t
+    emb = np.concatenate(feats)
+    emb /= np.maximum(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12)
+    np.save(out_path, emb.astype(np.float32))
+    result_queue.put({
+        "backend": name,
+        "load_s": round(load_s, 2),
+        "ms_per_image": round(1000 * infer_s / len(images), 2),
+        "peak_rss_mb": round(serving_peak_rss_mb(), 1),
+        "resident_after_load_mb": round(resident_mb, 1) if resident_mb is not None else None,
+        "load_peak_rss_mb": round(load_peak_mb, 1),
+        "peak_rss_reset": hwm_reset,
+        "threads": torch.get_num_threads(),
+    })
+
+
+def run_isolated(name, model_name, paths, batch_size, workdir):
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    out_path = str(Path(workdir) / f"{name}.npy")
+    proc = ctx.Process(target=_run_backend, args=(name, model_name, paths, batch_size, out_path, queue))
+    proc.start()
+    proc.join()
+    if proc.exitcode != 0:
+        raise SystemExit(f"{name} backend run failed (exit code {proc.exitcode})")
+    return queue.get(), np.load(out_path)
+
+
+def topk_overlap(ref: np.ndarray, cand: np.ndarray, k: int) -> float:
+    """Mean fraction of shared top-k neighbours (excluding self) within the sample."""
+    k = min(k, len(ref) - 1)
+    if k <= 0:
+        return 1.0
+
+    def neighbours(emb):
+        sims = emb @ emb.T
+        np.fill_diagonal(sims, -np.inf)
+        return np.argpartition(-sims, k, axis=1)[:, :k]
+
+    a, b = neighbours(ref), neighbours(cand)
+    return float(np.mean([len(set(x) & set(y)) / k for x, y in zip(a, b)]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare an inference backend with fp32 torch")
+    parser.add_argument("--backend", required=True, choices=["int8", "onnx"], help="Candidate backend")
+    parser.add_argument("--images", default="../downloaded_images", help="Directory of catalog images")
+    parser.add_argument("--sample", type=int, default=200, help="Number of images to compare")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--k", type=int, default=10, help="Neighbours compared for retrieval agreement")
+    parser.add_argument("--model", default="google/siglip-so400m-patch14-384")
+    parser.add_argument("--min-cosine", type=float, default=0.99, help="Fail if mean cosine falls below this")
+    args = parser.parse_args()
+
+    paths = sample_images(args.images, args.sample)
+    logger.info(f"Comparing {args.backend} against torch fp32 on {len(paths)} images")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        ref_stats, ref = run_isolated("torch", args.model, paths, args.batch_size, workdir)
+        cand_stats, cand = run_isolated(args.backend, args.model, paths, args.batch_size, workdir)
+
+    cos = np.sum(ref * cand, axis=1)
+    report = {
+        "images": len(paths),
+        "cosine_mean": round(float(cos.mean()), 5),
+        "cosine_min": round(float(cos.min()), 5),
+        "cosine_p01": round(float(np.percentile(cos, 1)), 5),
+        f"top{args.k}_overlap": round(topk_overlap(ref, cand, args.k), 4),
+        "reference": ref_stats,
+        "candidate": cand_stats,
+        "speedup": round(ref_stats["ms_per_image"] / max(cand_stats["ms_per_image"], 1e-9), 2),
+        # serving peaks only; lifetime peaks would include the fp32 load in both processes
+        "rss_ratio": (round(cand_stats["peak_rss_mb"] / max(ref_stats["peak_rss_mb"], 1e-9), 2)
+                      if ref_stats["peak_rss_reset"] and cand_stats["peak_rss_reset"] else None),
+    }
+    print(json.dumps(report, indent=2))
+    if report["cosine_mean"] < args.min_cosine:
+        logger.error(f"Mean cosine {report['cosine_mean']} is below {args.min_cosine}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Embedding wire formats.
+
+JSON float lists stay the default. Clients can ask for a compact encoding:
+  - raw little-endian float32/float16 bytes: `Accept: application/octet-stream`
+  - base64-packed bytes inside JSON: `?encoding=base64` (or `X-Embedding-Encoding: base64`)
+The element type is chosen with `?dtype=float16|float32` (or `X-Embedding-Dtype`).
+Both compact forms decode with a single `np.frombuffer` call.
+"""
+
+import base64
+import json
+from typing import List, Optional, Tuple
+
+import numpy as np
+from fastapi import HTTPException, Request
+from fastapi.responses import Response
+
+BINARY_MEDIA_TYPE = "application/octet-stream"
+DTYPES = {"float32": "<f4", "float16": "<f2"}
+
+
+def negotiate(request: Request, encoding: Optional[str] = None, dtype: Optional[str] = None) -> Tuple[str, str]:
+    """Return (format, dtype) where format is "json", "base64" or "binary"."""
+    encoding = (encoding or request.headers.get("x-embedding-encoding") or "").lower()
+    dtype = (dtype or request.headers.get("x-embedding-dtype") or "").lower()
+    accept = request.headers.get("accept", "")
+    if BINARY_MEDIA_TYPE in accept and "application/json" not in accept.split(BINARY_MEDIA_TYPE)[0]:
+        fmt = "binary"
+    elif encoding == "base64":
+        fmt = "base64"
+    else:
+        fmt = "json"
+    if fmt == "json":
+        return fmt, "float32"
+    dtype = dtype or ("float16" if fmt == "base64" else "float32")
+    if dtype not in DTYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported dtype {dtype}; use one of {', '.join(DTYPES)}")
+    return fmt, dtype
+
+
+def _pack(matrix: np.ndarray, dtype: str) -> bytes:
+    return np.ascontiguousarray(matrix, dtype=DTYPES[dtype]).tobytes()
+
+
+def encode_one(vec: np.ndarray, fmt: str, dtype: str, extra: Optional[dict] = None):
+    """Encode a single embedding in the negotiated format."""
+    extra = extra or {}
+    if fmt == "binary":
+        return Response(
+            content=_pack(vec, dtype),
+            media_type=BINARY_MEDIA_TYPE,
+            headers={"X-Embedding-Dtype": dtype, "X-Embedding-Dim": str(vec.shape[-1])},
+        )
+    if fmt == "base64":
+        return {"embedding_b64": base64.b64encode(_pack(vec, dtype)).decode("ascii"),
+                "dtype": dtype, "dim": int(vec.shape[-1]), **extra}
+    return {"embedding": vec.tolist(), **extra}
+
+
+def encode_many(vecs: List[Optional[np.ndarray]], dim: int, errors: List[dict], fmt: str, dtype: str,
+                extra: Optional[dict] = None):
+    """
+    Encode a batch. In the compact formats every item occupies one row of an
+    (N, dim) matrix; failed items are NaN rows and are listed in errors.
+    """
+    extra = extra or {}
+    if fmt == "json":
+        return {"embeddings": [v.tolist() if v is not None else None for v in vecs], "errors": errors, **extra}
+    matrix = np.full((len(vecs), dim), np.nan, dtype=np.float32)
+    for i, v in enumerate(vecs):
+        if v is not None:
+            matrix[i] = v
+    if fmt == "binary":
+        return Response(
+            content=_pack(matrix, dtype),
+            media_type=BINARY_MEDIA_TYPE,
+            headers={
+                "X-Embedding-Dtype": dtype,
+                "X-Embedding-Dim": str(dim),
+                "X-Embedding-Count": str(len(vecs)),
+                "X-Embedding-Errors": json.dumps(errors),
+            },
+        )
+    return {"embeddings_b64": base64.b64encode(_pack(matrix, dtype)).decode("ascii"),
+            "dtype": dtype, "errors": errors, **extra}
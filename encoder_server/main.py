@@ -1,11 +1,21 @@
 # encoder_server/main.py
 import io
-from fastapi import FastAPI, UploadFile, File
+import base64
+import sys
+import asyncio
+from pathlib import Path
+from typing import List, Optional
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from PIL import Image
 import torch
 from transformers import AutoImageProcessor, SiglipVisionModel
 
+# snapshot creation (temp dir + rename, replica races, stale temp dirs), warmup and request tracing are shared with encoder-service
+sys.path.append(str(Path(__file__).resolve().parent.parent / "encoder-service"))
+from model_store import MODEL_CACHE_DIR, load_pretrained, warmup
+from tracing import trace_requests
+
 app = FastAPI()
 app.add_middleware(
     CORSMiddleware,
@@ -13,13 +23,55 @@ app.add_middleware(
     allow_methods=["*"], allow_headers=["*"],
 )
 
+app.middleware("http")(trace_requests)
+
 MODEL_NAME = "google/siglip-so400m-patch14-384"
+MAX_BATCH_ITEMS = 64
 device = "cuda" if torch.cuda.is_available() else "cpu"
-proc = AutoImageProcessor.from_pretrained(MODEL_NAME)
-model = SiglipVisionModel.from_pretrained(MODEL_NAME).to(device).eval()
+proc = None
+model = None
+startup = {"ready": False, "error": None}
+
+def _load():
+    """Load from a local safetensors snapshot (memory-mapped), creating it on first run, then warm up"""
+    global proc, model
+    proc, vision, timings = load_pretrained(MODEL_NAME, MODEL_CACHE_DIR, model_cls=SiglipVisionModel,
+                                            processor_cls=AutoImageProcessor)
+    model = vision.to(device).eval()
+    timings["warmup_seconds"] = round(warmup(_embed_images, proc.size["height"]), 3)
+    startup.update(ready=True, error=None, **timings)
+    print(f"[encoder] ready: {startup}")
+
+async def _run_load():
+    try:
+        await asyncio.to_thread(_load)
+    except Exception as e:
+        startup["error"] = str(e)
+        print(f"[encoder] model load failed: {e}")
+
+@app.on_event("startup")
+async def _startup():
+    app.state.load_task = asyncio.create_task(_run_load())
+
+async def _wait_ready():
+    if not startup["ready"] and app.state.load_task.done():
+        # the last load failed; retry it for this request
+        app.state.load_task = asyncio.create_task(_run_load())
+    if not startup["ready"]:
+        await asyncio.shield(app.state.load_task)
+    if not startup["ready"]:
+        raise HTTPException(status_code=503, detail=f"Model not loaded: {startup['error']}")
+
+@app.get("/healthz")
+async def healthz():
+    # 503 until loaded and warmed up, so it doubles as a readiness probe
+    if not startup["ready"]:
+        raise HTTPException(status_code=503, detail=startup)
+    return {"status": "healthy", "model": MODEL_NAME, "device": device, **startup}
 
 @app.post("/embed")
 async def embed(file: UploadFile = File(...)):
+    await _wait_ready()
     try:
         img = Image.open(io.BytesIO(await file.read())).convert("RGB")
         inputs = proc(images=[img], return_tensors="pt").to(device)
@@ -36,3 +88,49 @@ async def embed(file: UploadFile = File(...)):
     except Exception as e:
         print(f"[encoder] error: {e}")
         raise
+
+def _embed_images(imgs):
+    inputs = proc(images=imgs, return_tensors="pt").to(device)
+    with torch.no_grad():
+        pooled = model(**inputs).pooler_output
+        pooled = torch.nn.functional.normalize(pooled, dim=1)
+    return pooled.cpu().tolist()
+
+def _embed_batch(raw):
+    imgs, positions, errors = [], [], []
+    for i, item in enumerate(raw):
+        try:
+            data = base64.b64decode(item.split(",", 1)[-1]) if isinstance(item, str) else item
+            imgs.append(Image.open(io.BytesIO(data)).convert("RGB"))
+            positions.append(i)
+        except Exception as e:
+            errors.append({"index": i, "error": str(e)})
+    embeddings = [None] * len(raw)
+    if imgs:
+        for pos, vec in zip(positions, _embed_images(imgs)):
+            embeddings[pos] = vec
+    return embeddings, errors
+
+@app.post("/embed/batch")
+async def embed_batch(
+    files: Optional[List[UploadFile]] = File(None),
+    b64: Optional[List[str]] = Form(None),
+):
+    await _wait_ready()
+    # count before reading anything, so an oversized batch never gets buffered
+    count = len(files or []) + len(b64 or [])
+    if not count:
+        raise HTTPException(status_code=400, detail="Provide files or b64")
+    if count > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Too many items: {count} > {MAX_BATCH_ITEMS}")
+    # files first, then base64 strings; failed items are null with an entry in "errors"
+    raw = [await f.read() for f in files or []] + list(b64 or [])
+    # decode + forward pass off the event loop, so /healthz and other requests aren't held up
+    embeddings, errors = await asyncio.to_thread(_embed_batch, raw)
+    return {
+        "embeddings": embeddings,
+        "errors": errors,
+        "count": len(raw),
+        "dim": len(next((e for e in embeddings if e), [])),
+        "model": MODEL_NAME
+    }
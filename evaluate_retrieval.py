@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Retrieval Evaluation for SigLIP Checkpoints
+
+Measures what search actually depends on, for one or more checkpoints on
+the same held-out products:
+
+  - quality: every downloaded secondary image of a product is a query
+    against the gallery of main images. A hit is the same product
+    (product level) or any product of the same brand (brand level);
+    recall@1/5/10 and mAP are reported for both.
+  - speed: images/sec for the vision tower alone and end to end
+    (decode + forward), plus per-batch latency percentiles.
+
+The held-out products are picked by a hash of the product id
+(training_data.in_holdout), so every run and every checkpoint is scored on
+the same queries, and the train_siglip_*.py scripts leave the same products
+out of training (--holdout must match). A checkpoint trained by
+train_siglip_local.py --feature_cache (fashion_adapters.pt) is evaluated as
+its base model with the vision adapter applied.
+
+Results are merged into <checkpoint>/training_metadata.json under
+"retrieval_eval"; hub model names (baselines) are only printed / written to
+--output.
+
+Usage:
+    python evaluate_retrieval.py fashion_siglip_model google/siglip-base-patch16-224
+    python evaluate_retrieval.py fashion_siglip_model --holdout 0.1 --max-products 2000 --batch-size 64
+"""
+
+import os
+import json
+import time
+import logging
+import argparse
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import torch
+import torch.nn as nn
+from transformers import AutoModel, AutoProcessor
+
+from catalog import DEFAULT_DIRS, iter_products
+from catalog_snapshot import product_id
+from image_cache import ResizedImageCache, pixel_values
+from image_store import ImageStore
+from training_data import DEFAULT_HOLDOUT, ImagePathDataset, in_holdout, loader_kwargs, locate_image, make_dataloader
+
+logger = logging.getLogger(__name__)
+
+KS = (1, 5, 10)
+
+
+# ---------------------------------------------------------------- eval set
+
+@dataclass
+class EvalSet:
+    """Gallery (main images) and queries (secondary images) with integer product / brand labels"""
+    gallery_paths: List[str] = field(default_factory=list)
+    gallery_product: List[int] = field(default_factory=list)
+    gallery_brand: List[int] = field(default_factory=list)
+    query_paths: List[str] = field(default_factory=list)
+    query_product: List[int] = field(default_factory=list)
+    query_brand: List[int] = field(default_factory=list)
+
+    def summary(self) -> Dict:
+        return {'products': len(self.gallery_paths), 'queries': len(self.query_paths),
+                'brands': len(set(self.gallery_brand))}
+
+
+def build_eval_set(dirs: Sequence[str] = DEFAULT_DIRS, images_dir: str = "downloaded_images",
+                   store: Optional[ImageStore] = None, holdout: float = DEFAULT_HOLDOUT,
+                   max_products: Optional[int] = None, max_queries_per_product: int = 3) -> EvalSet:
+    """Held-out products that have a downloaded main image and at least one downloaded secondary image"""
+
+    def locate(product, url, image_type):
+        return locate_image(product, url, image_type, images_dir, store)
+
+    eval_set = EvalSet()
+    brands: Dict[str, int] = {}
+    for product in iter_products(dirs):
+        if not product.main_image or not product.images or not in_holdout(product_id(product), holdout):
+            continue
+        main = locate(product, product.main_image, 'main')
+        if main is None:
+            continue
+        queries = []
+        for url, image_type in product.image_urls():
+            if image_type == 'main' or url == product.main_image:
+                continue
+            path = locate(product, url, image_type)
+            if path is not None and path != main:
+                queries.append(path)
+            if len(queries) >= max_queries_per_product:
+                break
+        if not queries:
+            continue
+        label = len(eval_set.gallery_paths)
+        brand = brands.setdefault(product.brand, len(brands))
+        eval_set.gallery_paths.append(main)
+        eval_set.gallery_product.append(label)
+        eval_set.gallery_brand.append(brand)
+        eval_set.query_paths.extend(queries)
+        eval_set.query_product.extend([label] * len(queries))
+        eval_set.query_brand.extend([brand] * len(queries))
+        if max_products and label + 1 >= max_products:
+            break
+    return eval_set
+
+
+# ---------------------------------------------------------------- metrics
+
+def retrieval_metrics(queries: np.ndarray, gallery: np.ndarray, query_labels: np.ndarray,
+                      gallery_labels: np.ndarray, ks: Sequence[int] = KS, chunk_size: int = 256) -> Dict:
+    """
+    recall@k (a positive in the top k) and mAP for L2-normalized embeddings.
+    Scores are one matmul per chunk of queries; rankings come from one
+    argsort per chunk, with no per-query Python loop.
+    """
+    query_labels = np.asarray(query_labels)
+    gallery_labels = np.asarray(gallery_labels)
+    hits = {k: 0 for k in ks}
+    ap_sum = 0.0
+    scored = 0
+    ranks = np.arange(1, len(gallery) + 1, dtype=np.float64)
+    for start in range(0, len(queries), chunk_size):
+        scores = queries[start:start + chunk_size] @ gallery.T
+        order = np.argsort(-scores, axis=1)
+        relevant = gallery_labels[order] == query_labels[start:start + chunk_size, None]
+        positives = relevant.sum(axis=1)
+        valid = positives > 0
+        relevant, positives = relevant[valid], positives[valid]
+        for k in ks:
+            hits[k] += int(relevant[:, :k].any(axis=1).sum())
+        # AP = mean over positives of precision at the positive's rank
+        precision = np.cumsum(relevant, axis=1) / ranks
+        ap_sum += float(((precision * relevant).sum(axis=1) / positives).sum())
+        scored += int(valid.sum())
+    result = {f'recall@{k}': round(hits[k] / scored, 4) if scored else 0.0 for k in ks}
+    result['mAP'] = round(ap_sum / scored, 4) if scored else 0.0
+    return result
+
+
+# ---------------------------------------------------------------- encoding
+
+class VisionEncoder:
+    """Checkpoint -> normalized image embeddings (optionally through the fashion vision adapter)"""
+
+    def __init__(self, checkpoint: str, device):
+        self.checkpoint = checkpoint
+        self.device = device
+        adapters_path = Path(checkpoint) / "fashion_adapters.pt"
+        self.adapter = None
+        model_name = checkpoint
+        if adapters_path.exists():
+            # adapter-only runs save the adapters + processor, not the backbone
+            with open(Path(checkpoint) / "training_metadata.json", 'r') as f:
+                model_name = json.load(f)['model_name']
+            state = torch.load(adapters_path, map_location='cpu')['vision_adapter']
+            dim, hidden = state['0.weight'].shape[1], state['0.weight'].shape[0]
+            self.adapter = nn.Sequential(nn.Linear(dim, hidden), nn.ReLU(), nn.Dropout(0.1), nn.Linear(hidden, dim))
+            self.adapter.load_state_dict(state)
+            self.adapter.to(device).eval()
+        self.model_name = model_name
+        self.processor = AutoProcessor.from_pretrained(checkpoint)
+        self.model = AutoModel.from_pretrained(model_name).to(device).eval()
+        self.image_size = self.processor.image_processor.size["height"]
+
+    @torch.no_grad()
+    def embed(self, pixels: torch.Tensor) -> torch.Tensor:
+        embeds = self.model.vision_model(pixel_values=pixels).pooler_output
+        if self.adapter is not None:
+            embeds = embeds + self.adapter(embeds)
+        return embeds / embeds.norm(p=2, dim=-1, keepdim=True)
+
+    def embed_paths(self, paths: List[str], batch_size: int = 64, resized_cache: Optional[ResizedImageCache] = None,
+                    dataloader_kwargs: Optional[Dict] = None):
+        """(N, D) float32 embeddings plus timings for the whole pass"""
+        mean = self.processor.image_processor.image_mean
+        std = self.processor.image_processor.image_std
+        dataset = ImagePathDataset(paths, self.image_size, resized_cache)
+        loader = make_dataloader(dataset, np.stack, batch_size, shuffle=False, **(dataloader_kwargs or {}))
+        cuda = torch.device(self.device).type == 'cuda'
+        out, latencies = [], []
+        start = time.perf_counter()
+        for batch in loader:
+            pixels = torch.from_numpy(pixel_values(batch, mean, std)).to(self.device, non_blocking=True)
+            batch_start = time.perf_counter()
+            embeds = self.embed(pixels)
+            if cuda:
+                torch.cuda.synchronize(self.device)
+            latencies.append(time.perf_counter() - batch_start)
+            out.append(embeds.float().cpu().numpy())
+        total = time.perf_counter() - start
+        return np.concatenate(out), timing_summary(latencies, len(paths), total, batch_size)
+
+
+def timing_summary(latencies: List[float], images: int, total_seconds: float, batch_size: int) -> Dict:
+    model_seconds = sum(latencies)
+    # the first batch includes lazy init / kernel selection
+    steady = np.array(latencies[1:] or latencies) * 1000
+    return {
+        'images': images,
+        'batch_size': batch_size,
+        'images_per_sec': round(images / total_seconds, 1) if total_seconds > 0 else 0.0,
+        'model_images_per_sec': round(images / model_seconds, 1) if model_seconds > 0 else 0.0,
+        'batch_latency_ms': {
+            'p50': round(float(np.percentile(steady, 50)), 2),
+            'p95': round(float(np.percentile(steady, 95)), 2),
+            'max': round(float(steady.max()), 2),
+        },
+    }
+
+
+# ---------------------------------------------------------------- run
+
+def evaluate_checkpoint(checkpoint: str, eval_set: EvalSet, device, batch_size: int = 64,
+                        resized_cache: Optional[str] = None, dataloader_kwargs: Optional[Dict] = None) -> Dict:
+    encoder = VisionEncoder(checkpoint, device)
+    cache = ResizedImageCache(resized_cache, encoder.image_size) if resized_cache else None
+    gallery, gallery_timing = encoder.embed_paths(eval_set.gallery_paths, batch_size, cache, dataloader_kwargs)
+    queries, query_timing = encoder.embed_paths(eval_set.query_paths, batch_size, cache, dataloader_kwargs)
+    timings = [gallery_timing, query_timing]
+    images = sum(t['images'] for t in timings)
+    return {
+        'eval_date': datetime.now().isoformat(),
+        'model_name': encoder.model_name,
+        'adapters': encoder.adapter is not None,
+        'device': str(device),
+        **eval_set.summary(),
+        'product': retrieval_metrics(queries, gallery, eval_set.query_product, eval_set.gallery_product),
+        'brand': retrieval_metrics(queries, gallery, eval_set.query_brand, eval_set.gallery_brand),
+        'benchmark': {
+            # the larger pass (usually the queries) is the steadier latency sample
+            **max(timings, key=lambda t: t['images']),
+            'images': images,
+            'images_per_sec': round(images / sum(t['images'] / t['images_per_sec'] for t in timings), 1),
+        },
+    }
+
+
+def read_metadata(checkpoint: str) -> Dict:
+    path = Path(checkpoint) / "training_metadata.json"
+    if not path.is_file():
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def check_holdout(checkpoint: str, holdout: float):
+    """Warn when a checkpoint was trained with a different hold-out than the one evaluated"""
+    trained = read_metadata(checkpoint).get('holdout')
+    if Path(checkpoint).is_dir() and trained is None:
+        logger.warning(f"{checkpoint} does not record its training hold-out; its products may overlap the eval set")
+    elif trained is not None and trained < holdout:
+        logger.warning(f"{checkpoint} was trained with --holdout {trained}, so part of the --holdout {holdout} "
+                       f"eval set was in its training data")
+
+
+def write_results(checkpoint: str, results: Dict) -> Optional[str]:
+    """Merge results into the checkpoint's training_metadata.json (local checkpoints only)"""
+    if not Path(checkpoint).is_dir():
+        return None
+    path = Path(checkpoint) / "training_metadata.json"
+    metadata = read_metadata(checkpoint)
+    metadata['retrieval_eval'] = results
+    tmp = path.with_suffix('.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(tmp, path)
+    return str(path)
+
+
+def log_comparison(results: Dict[str, Dict]):
+    logger.info(f"{'checkpoint':40} {'R@1':>6} {'R@5':>6} {'R@10':>6} {'mAP':>6} {'brand R@1':>9} {'img/s':>8} {'p50 ms':>8}")
+    for checkpoint, r in results.items():
+        p, b, bench = r['product'], r['brand'], r['benchmark']
+        logger.info(f"{checkpoint[-40:]:40} {p['recall@1']:6.3f} {p['recall@5']:6.3f} {p['recall@10']:6.3f} "
+                    f"{p['mAP']:6.3f} {b['recall@1']:9.3f} {bench['images_per_sec']:8.1f} "
+                    f"{bench['batch_latency_ms']['p50']:8.1f}")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Retrieval quality and embedding speed for SigLIP checkpoints")
+    parser.add_argument("checkpoints", nargs="+", help="Checkpoint directories or hub model names")
+    parser.add_argument("--catalog-dirs", nargs="+", default=list(DEFAULT_DIRS))
+    parser.add_argument("--images-dir", default="downloaded_images", help="Where download_all_images.py saved images")
+    parser.add_argument("--store", default=None, help="image_store.py directory to resolve images from")
+    parser.add_argument("--resized-cache", default=None, help="image_cache.py directory of pre-resized images")
+    parser.add_argument("--holdout", type=float, default=DEFAULT_HOLDOUT,
+                        help="Fraction of products (by id hash) to evaluate on; the --holdout the checkpoints were trained with")
+    parser.add_argument("--max-products", type=int, default=None, help="Cap on gallery size")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--num-workers", type=int, default=4, help="DataLoader decode workers")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--output", default=None, help="Also write all results to this JSON file")
+    args = parser.parse_args()
+
+    eval_set = build_eval_set(args.catalog_dirs, args.images_dir, ImageStore(args.store) if args.store else None,
+                              args.holdout, args.max_products)
+    logger.info(f"Eval set: {eval_set.summary()}")
+    if not eval_set.query_paths:
+        raise SystemExit("No held-out products with downloaded main + secondary images")
+
+    dataloader_kwargs = loader_kwargs(num_workers=args.num_workers)
+    results = {}
+    for checkpoint in args.checkpoints:
+        logger.info(f"Evaluating {checkpoint}")
+        check_holdout(checkpoint, args.holdout)
+        results[checkpoint] = evaluate_checkpoint(checkpoint, eval_set, args.device, args.batch_size,
+                                                  args.resized_cache, dataloader_kwargs)
+        written = write_results(checkpoint, results[checkpoint])
+        if written:
+            logger.info(f"Wrote retrieval_eval to {written}")
+
+    log_comparison(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Frozen-Backbone Feature Cache
+
+When the SigLIP towers are frozen, their outputs for a given image or
+caption never change, so they are computed once and stored memory-mapped:
+
+    feature_cache/<model>/vision/shard_00000.npy   (N, hidden) float16
+    feature_cache/<model>/vision/index.json        image content sha256 -> [shard, row]
+    feature_cache/<model>/text/...                 caption sha1 -> [shard, row]
+
+Features are the towers' pooled outputs (what the adapters in
+train_siglip_local.py take as input). Image keys are the same content
+hashes image_cache.py uses, so renamed or duplicated files share a row.
+Building only runs the backbone on keys that are missing.
+"""
+
+import os
+import json
+import hashlib
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from image_cache import ResizedImageCache, content_key, pixel_values
+from training_data import ImagePathDataset, make_dataloader
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ROOT = os.getenv("FEATURE_CACHE_DIR", "feature_cache")
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class FeatureStore:
+    """Sharded (key -> float16 vector) memory maps for one tower"""
+
+    def __init__(self, root: str, shard_size: int = 8192):
+        self.dir = Path(root)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.shard_size = shard_size
+        self.index: Dict[str, Tuple[int, int]] = {}
+        index_path = self.dir / "index.json"
+        if index_path.exists():
+            with open(index_path, 'r', encoding='utf-8') as f:
+                self.index = {k: tuple(v) for k, v in json.load(f).items()}
+        self.next_shard = 1 + max((s for s, _ in self.index.values()), default=-1)
+        self._shards: Dict[int, np.ndarray] = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def missing(self, keys: List[str]) -> List[str]:
+        return list(dict.fromkeys(k for k in keys if k not in self.index))
+
+    def _shard(self, shard: int) -> np.ndarray:
+        if shard not in self._shards:
+            self._shards[shard] = np.load(self.dir / f"shard_{shard:05d}.npy", mmap_mode='r')
+        return self._shards[shard]
+
+    def write(self, keys: List[str], features: np.ndarray):
+        """Append one shard; the index is rewritten after the shard lands"""
+        if not keys:
+            return
+        shard = self.next_shard
+        tmp = self.dir / f"shard_{shard:05d}.npy.tmp"
+        with open(tmp, 'wb') as f:
+            np.save(f, np.asarray(features, dtype=np.float16))
+        os.replace(tmp, self.dir / f"shard_{shard:05d}.npy")
+        self.index.update({key: (shard, row) for row, key in enumerate(keys)})
+        index_tmp = self.dir / "index.json.tmp"
+        with open(index_tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.index, f)
+        os.replace(index_tmp, self.dir / "index.json")
+        self.next_shard += 1
+
+    def gather(self, keys: List[str]) -> np.ndarray:
+        """(N, D) float32 for keys that are all present, read one shard at a time"""
+        if not keys:
+            return np.zeros((0, 0), dtype=np.float32)
+        dim = self._shard(self.index[keys[0]][0]).shape[1]
+        out = np.empty((len(keys), dim), dtype=np.float32)
+        by_shard: Dict[int, List[Tuple[int, int]]] = {}
+        for i, key in enumerate(keys):
+            shard, row = self.index[key]
+            by_shard.setdefault(shard, []).append((i, row))
+        for shard, pairs in by_shard.items():
+            dest, rows = zip(*pairs)
+            out[list(dest)] = self._shard(shard)[list(rows)]
+        return out
+
+
+class FeatureCache:
+    """Vision + text feature stores for one model"""
+
+    def __init__(self, root: str = DEFAULT_ROOT, model_name: str = "google/siglip-base-patch16-224"):
+        self.dir = Path(root) / model_name.replace("/", "--")
+        self.vision = FeatureStore(self.dir / "vision")
+        self.text = FeatureStore(self.dir / "text")
+
+    @torch.no_grad()
+    def build_vision(self, model, processor, image_paths: List[str], device, batch_size: int = 64,
+                     resized_cache: Optional[ResizedImageCache] = None, dataloader_kwargs: Optional[Dict] = None,
+                     shard_size: Optional[int] = None) -> int:
+        """Run the frozen vision tower on images whose content isn't cached yet"""
+        keys = [content_key(p) for p in image_paths]
+        first_path = {}
+        for key, path in zip(keys, image_paths):
+            first_path.setdefault(key, path)
+        todo = self.vision.missing(keys)
+        if not todo:
+            return 0
+        shard_size = shard_size or self.vision.shard_size
+        image_size = processor.image_processor.size["height"]
+        mean, std = processor.image_processor.image_mean, processor.image_processor.image_std
+        dataset = ImagePathDataset([first_path[k] for k in todo], image_size, resized_cache)
+        loader = make_dataloader(dataset, np.stack, batch_size, shuffle=False, **(dataloader_kwargs or {}))
+        pending_keys, pending = [], []
+        done = 0
+        for batch in tqdm(loader, desc="Caching vision features"):
+            pixels = torch.from_numpy(pixel_values(batch, mean, std)).to(device, non_blocking=True)
+            feats = model.vision_model(pixel_values=pixels).pooler_output
+            pending.append(feats.float().cpu().numpy())
+            pending_keys.extend(todo[done:done + len(batch)])
+            done += len(batch)
+            if len(pending_keys) >= shard_size:
+                self.vision.write(pending_keys, np.concatenate(pending))
+                pending_keys, pending = [], []
+        if pending_keys:
+            self.vision.write(pending_keys, np.concatenate(pending))
+        return len(todo)
+
+    @torch.no_grad()
+    def build_text(self, model, processor, captions: List[str], device, batch_size: int = 256,
+                   max_length: int = 64) -> int:
+        """Run the frozen text tower on captions that aren't cached yet"""
+        by_key = {text_key(c): c for c in captions}
+        todo = self.text.missing(list(by_key))
+        if not todo:
+            return 0
+        tokenizer = processor.tokenizer
+        max_length = min(max_length, getattr(tokenizer, 'model_max_length', max_length))
+        feats = []
+        for i in tqdm(range(0, len(todo), batch_size), desc="Caching text features"):
+            texts = [by_key[k] for k in todo[i:i + batch_size]]
+            tokens = tokenizer(texts, padding="max_length", truncation=True, max_length=max_length,
+                               return_tensors="pt")
+            tokens = {k: v.to(device) for k, v in tokens.items()}
+            feats.append(model.text_model(**tokens).pooler_output.float().cpu().numpy())
+        self.text.write(todo, np.concatenate(feats))
+        return len(todo)
+
+    def features(self, image_paths: List[str], captions: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """(vision, text) float32 feature matrices aligned with the given pairs"""
+        return (self.vision.gather([content_key(p) for p in image_paths]),
+                self.text.gather([text_key(c) for c in captions]))
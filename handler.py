@@ -1,14 +1,21 @@
-import base64, io, json, os
+import base64, io, json, os, time
 from PIL import Image
+import numpy as np
 import torch
 from transformers import AutoProcessor, AutoModel
 
 MODEL_ID = os.getenv("MODEL_ID", "google/siglip-so400m-patch14-384")
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
+WARMUP_BATCH_SIZE = int(os.getenv("WARMUP_BATCH_SIZE", "4"))
+DTYPES = {"float32": "<f4", "float16": "<f2"}  # same names as encoder-service/wire.py
+
+_t0 = time.perf_counter()
 processor = AutoProcessor.from_pretrained(MODEL_ID)
-model = AutoModel.from_pretrained(MODEL_ID).to(device)
+# safetensors are memory-mapped instead of random-init + copy
+model = AutoModel.from_pretrained(MODEL_ID, use_safetensors=True, low_cpu_mem_usage=True).to(device)
 model.eval()
+LOAD_SECONDS = time.perf_counter() - _t0
 
 def _load_image(payload):
     # accept base64 string or URL
@@ -25,18 +32,73 @@ def _load_image(payload):
     
     raise ValueError("inputs must be image URL or base64 string")
 
+def _embed(imgs):
+    batch = processor(images=imgs, return_tensors="pt").to(device)
+    
+    with torch.no_grad():
+        feats = model.get_image_features(**batch)
+        feats = torch.nn.functional.normalize(feats, dim=-1)
+    
+    return feats.detach().cpu().numpy().astype(np.float32)
+
+def _warmup():
+    # run one batch at import so the endpoint's first request isn't the slow one
+    if WARMUP_BATCH_SIZE <= 0:
+        return 0.0
+    t0 = time.perf_counter()
+    size = processor.image_processor.size["height"]
+    _embed([Image.new("RGB", (size, size), (127, 127, 127))] * WARMUP_BATCH_SIZE)
+    return time.perf_counter() - t0
+
+WARMUP_SECONDS = _warmup()
+print(f"[handler] model loaded in {LOAD_SECONDS:.2f}s, warmed up in {WARMUP_SECONDS:.2f}s")
+
+def _pack(vecs, dtype):
+    # base64 of little-endian floats; decode with np.frombuffer(..., "<f2"/"<f4")
+    return base64.b64encode(np.ascontiguousarray(vecs, dtype=DTYPES[dtype]).tobytes()).decode("ascii")
+
 def predict(inputs: dict):
     """
     Expects JSON: {"inputs": "<image_url_or_base64>"}
     Returns: {"embedding": [float, ...]}
+
+    Batch form: {"inputs": ["<url_or_base64>", ...]}
+    Returns: {"embeddings": [[float, ...] | null, ...], "errors": [{"index", "error"}]}
+
+    With {"parameters": {"encoding": "base64", "dtype": "float16"|"float32"}} the
+    vectors come back packed instead: {"embedding_b64" | "embeddings_b64", "dtype", "dim"},
+    failed batch items being NaN rows.
     """
-    img = _load_image(inputs.get("inputs"))
-    batch = processor(images=img, return_tensors="pt").to(device)
-    
-    with torch.no_grad():
-        feats = model.get_image_features(**batch)
-        feats = torch.nn.functional.normalize(feats, dim=-1)
+    payload = inputs.get("inputs")
+    params = inputs.get("parameters") or {}
+    packed = params.get("encoding") == "base64"
+    dtype = str(params.get("dtype") or "float16").lower()
+    if packed and dtype not in DTYPES:
+        # checked before any image is fetched or embedded; surfaces as a 400
+        raise ValueError(f"Unsupported dtype {dtype}; use one of {', '.join(DTYPES)}")
+    if not isinstance(payload, list):
+        emb = _embed(_load_image(payload))[0]
+        if packed:
+            return {"embedding_b64": _pack(emb, dtype), "dtype": dtype, "dim": int(emb.shape[0])}
+        return {"embedding": emb.tolist()}
     
-    emb = feats[0].detach().cpu().tolist()
-    return {"embedding": emb}
+    imgs, positions, errors = [], [], []
+    for i, item in enumerate(payload):
+        try:
+            imgs.append(_load_image(item))
+            positions.append(i)
+        except Exception as e:
+            errors.append({"index": i, "error": str(e)})
+    embeddings = [None] * len(payload)
+    if imgs:
+        for pos, emb in zip(positions, _embed(imgs)):
+            embeddings[pos] = emb
+    if packed:
+        dim = next((int(e.shape[0]) for e in embeddings if e is not None), 0)
+        matrix = np.full((len(payload), dim), np.nan, dtype=np.float32)
+        for i, emb in enumerate(embeddings):
+            if emb is not None:
+                matrix[i] = emb
+        return {"embeddings_b64": _pack(matrix, dtype), "dtype": dtype, "dim": dim, "errors": errors}
+    return {"embeddings": [e.tolist() if e is not None else None for e in embeddings], "errors": errors}
 
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Pre-resized Image Cache
+
+Stores every catalog image once, already decoded and resized to a model's
+input resolution, in memory-mapped uint8 shards:
+
+    image_cache/384/shard_00000.npy   (N, 384, 384, 3) uint8
+    image_cache/384/index.json        content sha256 -> [shard, row]
+
+Resizing matches the SigLIP image processor (bicubic to size x size, no
+crop), so a cached array only needs the final rescale/normalize, which
+pixel_values() does for a whole batch at once. Training epochs and bulk
+embedding then read a slice of a memory map instead of decoding and
+resizing a JPEG per item.
+
+Entries are keyed by the sha256 of the source file: image_store.py objects
+are named by it already, plain files are hashed (a read, no decode).
+
+Usage:
+    python image_cache.py build --size 384 224 --store image_store
+    python image_cache.py build --size 224 --images-dir downloaded_images
+"""
+
+import os
+import re
+import json
+import logging
+import argparse
+import functools
+import concurrent.futures
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from image_store import ImageStore, sha256_file
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ROOT = os.getenv("IMAGE_CACHE_DIR", "image_cache")
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif'}
+_SHA256 = re.compile(r"^[0-9a-f]{64}$")
+
+
+@functools.lru_cache(maxsize=None)
+def _file_key(path: str) -> str:
+    stem = Path(path).stem
+    # image_store.py objects are already named by their hash
+    if _SHA256.match(stem):
+        return stem
+    return sha256_file(path)
+
+
+def content_key(path) -> str:
+    """Cache key for an image file: its content sha256 (memoized per path)"""
+    return _file_key(str(path))
+
+
+def resize_for_model(image: Image.Image, size: int) -> np.ndarray:
+    """Decode + resize the way the SigLIP processor does; returns (size, size, 3) uint8"""
+    # no JPEG draft(): its reduced-scale decode shifts pixels away from what the processor sees
+    image = image.convert('RGB').resize((size, size), Image.BICUBIC)
+    return np.asarray(image, dtype=np.uint8)
+
+
+def pixel_values(batch: np.ndarray, mean: Sequence[float] = (0.5, 0.5, 0.5),
+                 std: Sequence[float] = (0.5, 0.5, 0.5)) -> np.ndarray:
+    """(N, S, S, 3) uint8 -> (N, 3, S, S) float32 normalized model input"""
+    batch = np.asarray(batch)
+    if batch.ndim == 3:
+        batch = batch[None]
+    scale = (1.0 / (255.0 * np.asarray(std, dtype=np.float32))).reshape(1, 3, 1, 1)
+    shift = (np.asarray(mean, dtype=np.float32) / np.asarray(std, dtype=np.float32)).reshape(1, 3, 1, 1)
+    out = batch.transpose(0, 3, 1, 2).astype(np.float32)
+    out *= scale
+    out -= shift
+    return out
+
+
+class ResizedImageCache:
+    """Read side: look up pre-resized images by content key"""
+
+    def __init__(self, root: str = DEFAULT_ROOT, size: int = 384):
+        self.size = size
+        self.dir = Path(root) / str(size)
+        self.index: Dict[str, Tuple[int, int]] = {}
+        index_path = self.dir / "index.json"
+        if index_path.exists():
+            with open(index_path, 'r', encoding='utf-8') as f:
+                self.index = {k: tuple(v) for k, v in json.load(f).items()}
+        self._shards: Dict[int, np.ndarray] = {}
+
+    def __getstate__(self):
+        # DataLoader workers re-open the memory maps instead of pickling their contents
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def _shard(self, shard: int) -> np.ndarray:
+        if shard not in self._shards:
+            self._shards[shard] = np.load(self.dir / f"shard_{shard:05d}.npy", mmap_mode='r')
+        return self._shards[shard]
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """(S, S, 3) uint8 view into the memory map, or None"""
+        loc = self.index.get(key)
+        if loc is None:
+            return None
+        return self._shard(loc[0])[loc[1]]
+
+    def get_image(self, key: str) -> Optional[Image.Image]:
+        arr = self.get(key)
+        return Image.fromarray(np.ascontiguousarray(arr)) if arr is not None else None
+
+    def get_many(self, keys: List[str]) -> np.ndarray:
+        """(N, S, S, 3) uint8 for keys that are all cached, gathered one shard at a time"""
+        out = np.empty((len(keys), self.size, self.size, 3), dtype=np.uint8)
+        by_shard: Dict[int, List[Tuple[int, int]]] = {}
+        for i, key in enumerate(keys):
+            shard, row = self.index[key]
+            by_shard.setdefault(shard, []).append((i, row))
+        for shard, pairs in by_shard.items():
+            dest, rows = zip(*pairs)
+            out[list(dest)] = self._shard(shard)[list(rows)]
+        return out
+
+
+def cached_pixel_values(cache: Optional[ResizedImageCache], path, image_processor) -> Optional[np.ndarray]:
+    """(1, 3, S, S) float32 model input for the image at path, or None if it isn't cached"""
+    if cache is None:
+        return None
+    try:
+        arr = cache.get(content_key(path))
+    except OSError:
+        return None
+    if arr is None:
+        return None
+    return pixel_values(arr, image_processor.image_mean, image_processor.image_std)
+
+
+class ResizedImageCacheWriter(ResizedImageCache):
+    """Append-only build side: buffers arrays and writes one shard at a time"""
+
+    def __init__(self, root: str = DEFAULT_ROOT, size: int = 384, shard_size: int = 2048):
+        super().__init__(root, size)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.shard_size = shard_size
+        self.next_shard = 1 + max((s for s, _ in self.index.values()), default=-1)
+        self._keys: List[str] = []
+        self._arrays: List[np.ndarray] = []
+        self._pending = set()
+
+    def add(self, key: str, array: np.ndarray):
+        if key in self.index or key in self._pending:
+            return
+        self._pending.add(key)
+        self._keys.append(key)
+        self._arrays.append(array)
+        if len(self._keys) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if not self._keys:
+            return
+        shard = self.next_shard
+        path = self.dir / f"shard_{shard:05d}.npy"
+        tmp = self.dir / f"shard_{shard:05d}.npy.tmp"
+        data = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8,
+                                         shape=(len(self._arrays), self.size, self.size, 3))
+        for row, arr in enumerate(self._arrays):
+            data[row] = arr
+        data.flush()
+        del data
+        os.replace(tmp, path)
+        self.index.update({key: (shard, row) for row, key in enumerate(self._keys)})
+        # the index is rewritten after the shard lands, so it never points at a missing file
+        index_tmp = self.dir / "index.json.tmp"
+        with open(index_tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.index, f)
+        os.replace(index_tmp, self.dir / "index.json")
+        self.next_shard += 1
+        self._keys, self._arrays, self._pending = [], [], set()
+
+
+def build(paths: Iterable[Path], sizes: List[int], root: str = DEFAULT_ROOT, workers: int = 8,
+          shard_size: int = 2048) -> Dict[int, int]:
+    """Decode each image once and add it to the cache at every requested size"""
+    writers = {size: ResizedImageCacheWriter(root, size, shard_size) for size in sizes}
+
+    def load(path):
+        try:
+            key = content_key(path)
+            if all(key in w.index for w in writers.values()):
+                return key, None
+            with Image.open(path) as image:
+                image = image.convert('RGB')
+                return key, {size: resize_for_model(image, size) for size in sizes}
+        except Exception as e:
+            logger.warning(f"Skipping {path}: {e}")
+            return None, None
+
+    added = {size: 0 for size in sizes}
+    paths = list(paths)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for key, arrays in tqdm(pool.map(load, paths), total=len(paths), desc="Resizing images"):
+            if arrays is None:
+                continue
+            for size, arr in arrays.items():
+                if key not in writers[size].index:
+                    writers[size].add(key, arr)
+                    added[size] += 1
+    for writer in writers.values():
+        writer.flush()
+    return added
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Pre-resized image cache")
+    parser.add_argument("--root", default=DEFAULT_ROOT, help="Cache directory")
+    sub = parser.add_subparsers(dest="command", required=True)
+    b = sub.add_parser("build", help="Resize catalog images into the cache")
+    b.add_argument("--size", type=int, nargs="+", default=[384, 224],
+                   help="Model input sizes (384 for so400m, 224 for the base model)")
+    source = b.add_mutually_exclusive_group()
+    source.add_argument("--store", default=None, help="image_store.py directory to read from")
+    source.add_argument("--images-dir", default="downloaded_images", help="Directory of downloaded images")
+    b.add_argument("--workers", type=int, default=8)
+    b.add_argument("--shard-size", type=int, default=2048, help="Images per shard")
+    sub.add_parser("stats", help="Show cached image counts per size")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        if args.store:
+            paths = [path for _, path in ImageStore(args.store).iter_blobs()]
+        else:
+            paths = sorted(p for p in Path(args.images_dir).rglob("*") if p.suffix.lower() in IMAGE_EXTENSIONS)
+        added = build(paths, args.size, args.root, args.workers, args.shard_size)
+        logger.info(f"Added {added} images from {len(paths)} sources")
+    else:
+        root = Path(args.root)
+        sizes = sorted(int(p.name) for p in root.iterdir() if p.name.isdigit()) if root.exists() else []
+        print(json.dumps({size: len(ResizedImageCache(args.root, size)) for size in sizes}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Content-Addressed Image Store
+
+Catalog images are stored once per distinct content, keyed by the sha256
+of their bytes:
+
+    image_store/objects/ab/cd/abcd1234...<64 hex>.jpg
+    image_store/index.sqlite   url -> sha256 (+ product url, brand, name, image type)
+
+The same image served under several URLs is stored once (under the
+extension it was first seen with, whatever later URLs call it), and file name
+collisions between products cannot happen. Downstream stages look images
+up by URL or product and can use the hash to skip work on byte-identical
+images.
+
+Usage:
+    python image_store.py import downloaded_images   # adopt an existing download (uses manifest.json)
+    python image_store.py stats
+"""
+
+import os
+import json
+import shutil
+import sqlite3
+import hashlib
+import logging
+import argparse
+import threading
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ROOT = os.getenv("IMAGE_STORE_DIR", "image_store")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    ext TEXT NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS urls (
+    url TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL REFERENCES blobs(sha256),
+    product_url TEXT,
+    brand TEXT,
+    name TEXT,
+    image_type TEXT
+);
+CREATE INDEX IF NOT EXISTS urls_sha256_idx ON urls (sha256);
+CREATE INDEX IF NOT EXISTS urls_product_idx ON urls (product_url);
+"""
+
+
+def sha256_file(path, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ImageStore:
+    """sha256-addressed image files plus a sqlite index of URL -> content hash"""
+
+    def __init__(self, root: str = DEFAULT_ROOT):
+        self.root = Path(root)
+        self.objects = self.root / "objects"
+        self.objects.mkdir(parents=True, exist_ok=True)
+        # one connection shared by decode/download threads, serialized by a lock
+        self._db = sqlite3.connect(str(self.root / "index.sqlite"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------ writes
+
+    def object_path(self, sha256: str, ext: str) -> Path:
+        # two levels of 256-way fan-out keep directories small
+        return self.objects / sha256[:2] / sha256[2:4] / f"{sha256}.{ext}"
+
+    def adopt(self, tmp_path, sha256: str, ext: str) -> Path:
+        """Move an already-hashed file into the store; a duplicate is simply discarded.
+
+        Content is stored once under the extension it was first registered
+        with, so the returned path may end in a different ext than requested.
+        """
+        target = self._register(sha256, ext, os.path.getsize(tmp_path))
+        if target.exists():
+            os.remove(tmp_path)
+        else:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, target)
+        return target
+
+    def _register(self, sha256: str, ext: str, size: int) -> Path:
+        """Record the blob (first ext wins) and return where its content lives"""
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO blobs (sha256, ext, size) VALUES (?, ?, ?)",
+                (sha256, ext, size),
+            )
+            (stored_ext,), = self._db.execute("SELECT ext FROM blobs WHERE sha256 = ?", (sha256,)).fetchall()
+        return self.object_path(sha256, stored_ext)
+
+    def _stored(self, sha256: str) -> bool:
+        path = self.path_for_hash(sha256)
+        return path is not None and path.exists()
+
+    def _tmp_path(self, sha256: str) -> Path:
+        return self.objects / f".{sha256}.{os.getpid()}.{threading.get_ident()}.part"
+
+    def put_bytes(self, data: bytes, ext: str) -> str:
+        sha256 = hashlib.sha256(data).hexdigest()
+        if self._stored(sha256):
+            return sha256
+        tmp = self._tmp_path(sha256)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        self.adopt(tmp, sha256, ext)
+        return sha256
+
+    def put_file(self, path, copy: bool = True) -> str:
+        """Add a file to the store (copying by default, moving with copy=False)"""
+        path = Path(path)
+        sha256 = sha256_file(path)
+        ext = path.suffix.lstrip('.').lower() or 'jpg'
+        if copy:
+            if self._stored(sha256):
+                return sha256
+            tmp = self._tmp_path(sha256)
+            shutil.copyfile(path, tmp)
+            path = tmp
+        self.adopt(path, sha256, ext)
+        return sha256
+
+    def link(self, url: str, sha256: str, product_url: str = None, brand: str = None,
+             name: str = None, image_type: str = None):
+        """Point a URL (and its product metadata) at stored content"""
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO urls (url, sha256, product_url, brand, name, image_type) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (url, sha256, product_url, brand, name, image_type),
+            )
+
+    # ------------------------------------------------------------ lookups
+
+    def _query(self, sql: str, args=()) -> List[tuple]:
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def hash_for_url(self, url: str) -> Optional[str]:
+        rows = self._query("SELECT sha256 FROM urls WHERE url = ?", (url,))
+        return rows[0][0] if rows else None
+
+    def path_for_hash(self, sha256: str) -> Optional[Path]:
+        rows = self._query("SELECT ext FROM blobs WHERE sha256 = ?", (sha256,))
+        return self.object_path(sha256, rows[0][0]) if rows else None
+
+    def path_for_url(self, url: str) -> Optional[Path]:
+        rows = self._query(
+            "SELECT b.sha256, b.ext FROM urls u JOIN blobs b ON b.sha256 = u.sha256 WHERE u.url = ?", (url,)
+        )
+        return self.object_path(*rows[0]) if rows else None
+
+    def images_for_product(self, product_url: str) -> List[Dict]:
+        rows = self._query(
+            "SELECT u.url, u.image_type, b.sha256, b.ext FROM urls u JOIN blobs b ON b.sha256 = u.sha256 "
+            "WHERE u.product_url = ? ORDER BY u.image_type",
+            (product_url,),
+        )
+        return [{'url': url, 'image_type': image_type, 'sha256': sha, 'path': self.object_path(sha, ext)}
+                for url, image_type, sha, ext in rows]
+
+    def urls_for_hash(self, sha256: str) -> List[str]:
+        return [row[0] for row in self._query("SELECT url FROM urls WHERE sha256 = ?", (sha256,))]
+
+    def __contains__(self, url: str) -> bool:
+        return self.hash_for_url(url) is not None
+
+    def iter_blobs(self) -> Iterator[tuple]:
+        """(sha256, path) for every stored image"""
+        for sha256, ext in self._query("SELECT sha256, ext FROM blobs ORDER BY sha256"):
+            yield sha256, self.object_path(sha256, ext)
+
+    def stats(self) -> Dict:
+        (blobs, size), = self._query("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs")
+        (urls,), = self._query("SELECT COUNT(*) FROM urls")
+        (products,), = self._query("SELECT COUNT(DISTINCT product_url) FROM urls")
+        return {
+            'urls': urls,
+            'products': products,
+            'blobs': blobs,
+            'bytes': size,
+            'duplicate_urls': urls - blobs,
+        }
+
+    def close(self):
+        self._db.close()
+
+
+def import_download_dir(store: ImageStore, download_dir: str, move: bool = False) -> Dict:
+    """Adopt a download_all_images.py directory, using its manifest for URLs"""
+    manifest_path = Path(download_dir) / "manifest.json"
+    if not manifest_path.exists():
+        raise SystemExit(f"{manifest_path} not found; run download_all_images.py (async mode) first")
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    imported = missing = 0
+    for url, entry in manifest.items():
+        path = Path(entry['path'])
+        if not path.exists():
+            missing += 1
+            continue
+        sha256 = store.put_file(path, copy=not move)
+        store.link(url, sha256, entry.get('product_url'), entry.get('brand'), entry.get('product'), entry.get('type'))
+        imported += 1
+    return {'imported': imported, 'missing': missing, **store.stats()}
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Content-addressed catalog image store")
+    parser.add_argument("--root", default=DEFAULT_ROOT, help="Store directory")
+    sub = parser.add_subparsers(dest="command", required=True)
+    imp = sub.add_parser("import", help="Adopt images downloaded by download_all_images.py")
+    imp.add_argument("download_dir", nargs="?", default="downloaded_images")
+    imp.add_argument("--move", action="store_true", help="Move files instead of copying them")
+    sub.add_parser("stats", help="Show store statistics")
+    args = parser.parse_args()
+
+    store = ImageStore(args.root)
+    if args.command == "import":
+        result = import_download_dir(store, args.download_dir, move=args.move)
+    else:
+        result = store.stats()
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
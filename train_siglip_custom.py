@@ -8,6 +8,7 @@ to improve clothing identification and similarity search accuracy.
 
 import os
 import json
+import time
 import logging
 import argparse
 from typing import Dict, List, Any, Optional
@@ -15,87 +16,43 @@ from datetime import datetime
 import numpy as np
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader
 from transformers import AutoModel, AutoProcessor, TrainingArguments
 from PIL import Image
 from pathlib import Path
 import random
 from tqdm import tqdm
 
+from image_cache import ResizedImageCache
+from feature_cache import DEFAULT_ROOT as FEATURE_CACHE_DIR, FeatureCache, text_key
+from training_data import (DEFAULT_HOLDOUT, BatchCollator, ImageTextDataset, add_dataloader_args, add_holdout_args,
+                           benchmark_dataloader, drop_holdout_paths, image_caption_from_path, loader_kwargs,
+                           loader_kwargs_from_args, log_benchmark, make_dataloader, pretokenize_captions)
+from training_perf import (add_perf_args, autocast, enable_gradient_checkpointing, find_batch_size,
+                           profile_configs, synthetic_batch)
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class LocalFashionDataset(Dataset):
+class LocalFashionDataset(ImageTextDataset):
     """Custom dataset for fashion items using local images"""
     
-    def __init__(self, image_paths: List[str], processor, max_length: int = 77):
-        self.image_paths = image_paths
-        self.processor = processor
-        self.max_length = max_length
-    
-    def __len__(self):
-        return len(self.image_paths)
+    def image_path(self, item):
+        return item
     
-    def __getitem__(self, idx):
-        image_path = self.image_paths[idx]
-        
-        # Load local image
-        try:
-            image = Image.open(image_path).convert('RGB')
-        except Exception as e:
-            logger.warning(f"Failed to load image {image_path}: {e}")
-            # Create a blank image as fallback
-            image = Image.new('RGB', (224, 224), color='white')
-        
+    def caption(self, item):
         # Create text description from filename and path
-        brand = Path(image_path).parent.name
-        filename = Path(image_path).stem
-        
-        # Clean up filename for better text description
-        text_parts = []
-        text_parts.append(brand)
-        
-        # Extract product info from filename
-        if '_main' in filename:
-            filename = filename.replace('_main', '')
-        if '_secondary' in filename:
-            filename = filename.replace('_secondary_1', '').replace('_secondary_2', '').replace('_secondary_3', '').replace('_secondary_4', '')
-        
-        # Add cleaned filename as description
-        text_parts.append(filename)
-        
-        text = " ".join(text_parts)
-        
-        # Process with SigLIP processor
-        inputs = self.processor(
-            text=text,
-            images=image,
-            return_tensors="pt",
-            padding=True,
-            truncation=True,
-            max_length=self.max_length
-        )
-        
-        # Handle different processor outputs
-        result = {
-            'input_ids': inputs['input_ids'].squeeze(),
-            'pixel_values': inputs['pixel_values'].squeeze(),
-        }
-        
-        # Add attention_mask if available
-        if 'attention_mask' in inputs:
-            result['attention_mask'] = inputs['attention_mask'].squeeze()
-        
-        return result
+        return image_caption_from_path(item)
 
 class SigLIPTrainer:
     """Custom trainer for SigLIP model with contrastive loss"""
     
-    def __init__(self, model, processor, device='cpu'):
+    def __init__(self, model, processor, device='cpu', precision='fp32'):
         self.model = model
         self.processor = processor
         self.device = device
+        # 'bf16' runs forward/backward under autocast; the loss stays fp32
+        self.precision = precision
         self.model.to(device)
         
     def compute_contrastive_loss(self, image_embeds, text_embeds, temperature=0.07):
@@ -117,52 +74,71 @@ class SigLIPTrainer:
         
         return (loss_img + loss_txt) / 2
     
+    def embed_batch(self, batch):
+        """(image_embeds, text_embeds) for a collated batch"""
+        pixel_values = batch['pixel_values'].to(self.device, non_blocking=True)
+        
+        # Frozen text tower: captions arrive as cached text features
+        if 'text_embeds' in batch:
+            # same pooled output SiglipModel returns as image_embeds
+            image_embeds = self.model.vision_model(pixel_values=pixel_values).pooler_output
+            return image_embeds, batch['text_embeds'].to(self.device, non_blocking=True)
+        
+        # Move batch to device
+        input_ids = batch['input_ids'].to(self.device, non_blocking=True)
+        
+        if 'attention_mask' in batch:
+            attention_mask = batch['attention_mask'].to(self.device, non_blocking=True)
+        else:
+            attention_mask = None
+        
+        # Forward pass
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            pixel_values=pixel_values,
+            return_loss=False
+        )
+        
+        # Get embeddings
+        return outputs.image_embeds, outputs.text_embeds
+    
+    def train_step(self, batch, optimizer):
+        """One optimizer step; returns the detached loss"""
+        with autocast(self.precision, self.device):
+            image_embeds, text_embeds = self.embed_batch(batch)
+        
+        # Compute contrastive loss
+        loss = self.compute_contrastive_loss(image_embeds.float(), text_embeds.float())
+        
+        # Backward pass
+        optimizer.zero_grad(set_to_none=True)
+        loss.backward()
+        optimizer.step()
+        return loss.detach()
+    
     def train_epoch(self, dataloader, optimizer, epoch):
-        """Train for one epoch"""
+        """Train for one epoch; returns (mean loss, samples/sec)"""
         self.model.train()
-        total_loss = 0
+        # accumulated on the device; reading it back every step would sync each batch
+        total_loss = torch.zeros((), device=self.device)
+        samples = 0
+        start = time.perf_counter()
         
         progress_bar = tqdm(dataloader, desc=f"Epoch {epoch}")
         
         for batch_idx, batch in enumerate(progress_bar):
-            # Move batch to device
-            input_ids = batch['input_ids'].to(self.device)
-            pixel_values = batch['pixel_values'].to(self.device)
-            
-            if 'attention_mask' in batch:
-                attention_mask = batch['attention_mask'].to(self.device)
-            else:
-                attention_mask = None
-            
-            # Forward pass
-            outputs = self.model(
-                input_ids=input_ids,
-                attention_mask=attention_mask,
-                pixel_values=pixel_values,
-                return_loss=False
-            )
-            
-            # Get embeddings
-            image_embeds = outputs.image_embeds
-            text_embeds = outputs.text_embeds
-            
-            # Compute contrastive loss
-            loss = self.compute_contrastive_loss(image_embeds, text_embeds)
-            
-            # Backward pass
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-            
-            total_loss += loss.item()
-            
-            # Update progress bar
-            progress_bar.set_postfix({'loss': f'{loss.item():.4f}'})
+            loss = self.train_step(batch, optimizer)
+            total_loss += loss
+            samples += batch['pixel_values'].shape[0]
             
             if batch_idx % 100 == 0:
+                # Update progress bar
+                progress_bar.set_postfix({'loss': f'{loss.item():.4f}'})
                 logger.info(f"Epoch {epoch}, Batch {batch_idx}, Loss: {loss.item():.4f}")
         
-        return total_loss / len(dataloader)
+        samples_per_sec = samples / max(time.perf_counter() - start, 1e-9)
+        return total_loss.item() / len(dataloader), samples_per_sec
     
     def save_model(self, output_dir):
         """Save the trained model"""
@@ -171,114 +147,129 @@ class SigLIPTrainer:
         self.processor.save_pretrained(output_dir)
         logger.info(f"Model saved to {output_dir}")
 
-def collate_fn(batch):
-    """Custom collate function to handle variable length sequences"""
-    # Separate different types of data
-    input_ids = [item['input_ids'] for item in batch]
-    pixel_values = [item['pixel_values'] for item in batch]
-    attention_masks = [item.get('attention_mask', torch.ones_like(item['input_ids'])) for item in batch]
-    
-    # Pad sequences to the same length
-    max_length = max(len(ids) for ids in input_ids)
-    
-    padded_input_ids = []
-    padded_attention_masks = []
-    
-    for ids, mask in zip(input_ids, attention_masks):
-        # Pad input_ids
-        if len(ids) < max_length:
-            padding = torch.zeros(max_length - len(ids), dtype=ids.dtype)
-            ids = torch.cat([ids, padding])
-        
-        # Pad attention_mask
-        if len(mask) < max_length:
-            padding = torch.zeros(max_length - len(mask), dtype=mask.dtype)
-            mask = torch.cat([mask, padding])
-        
-        padded_input_ids.append(ids)
-        padded_attention_masks.append(mask)
-    
-    # Stack tensors
-    return {
-        'input_ids': torch.stack(padded_input_ids),
-        'attention_mask': torch.stack(padded_attention_masks),
-        'pixel_values': torch.stack(pixel_values)
-    }
-
-def train_siglip_model(image_paths, output_dir="./fashion_siglip_model", num_epochs=3, batch_size=16, learning_rate=1e-5):
+def train_siglip_model(image_paths, output_dir="./fashion_siglip_model", num_epochs=3, batch_size=16, learning_rate=1e-5,
+                       resized_cache=None, dataloader_kwargs=None, benchmark_batches=0, token_cache=None,
+                       freeze_text_tower=False, feature_cache=None, model_name="google/siglip-base-patch16-224",
+                       precision='fp32', gradient_checkpointing=False, memory_budget_gb=None, max_batch_size=256,
+                       profile_training=False, holdout=DEFAULT_HOLDOUT):
     """Main training function"""
     logger.info("Starting SigLIP model training for fashion items using local images...")
     
-    # Load model and processor
-    model_name = "google/siglip-base-patch16-224"
+    # Load processor (the model is loaded after the input pipeline is set up)
     processor = AutoProcessor.from_pretrained(model_name)
-    model = AutoModel.from_pretrained(model_name)
+    image_size = processor.image_processor.size["height"]
+    cache = ResizedImageCache(resized_cache, image_size) if resized_cache else None
     
     # Setup device
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     logger.info(f"Using device: {device}")
     
-    # Create dataset
-    dataset = LocalFashionDataset(image_paths, processor)
-    
-    # Split data (80% train, 20% eval)
+    # Leave out the products evaluate_retrieval.py scores on, then split the rest (80% train, 20% eval)
+    image_paths = drop_holdout_paths(image_paths, holdout)
     random.shuffle(image_paths)
     split_idx = int(0.8 * len(image_paths))
     train_images = image_paths[:split_idx]
     eval_images = image_paths[split_idx:]
     
-    train_dataset = LocalFashionDataset(train_images, processor)
-    eval_dataset = LocalFashionDataset(eval_images, processor)
+    train_dataset = LocalFashionDataset(train_images, image_size, resized_cache=cache)
+    eval_dataset = LocalFashionDataset(eval_images, image_size, resized_cache=cache)
     
     logger.info(f"Training on {len(train_images)} images, evaluating on {len(eval_images)} images")
     
-    # Create dataloaders
-    train_dataloader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=0, collate_fn=collate_fn)
-    eval_dataloader = DataLoader(eval_dataset, batch_size=batch_size, shuffle=False, num_workers=0, collate_fn=collate_fn)
+    # Captions are fixed, so their text-side inputs are prepared once rather than per batch
+    collator = BatchCollator(processor)
+    model = None
+    if freeze_text_tower:
+        # Frozen text tower: caption features come from feature_cache.py instead of a forward pass per step
+        model = AutoModel.from_pretrained(model_name).to(device)
+        for param in model.text_model.parameters():
+            param.requires_grad = False
+        features = FeatureCache(feature_cache or FEATURE_CACHE_DIR, model_name)
+        for dataset in (train_dataset, eval_dataset):
+            captions = dataset.captions()
+            features.build_text(model, processor, captions, device, max_length=collator.max_length)
+            dataset.use_text_features(features.text.gather([text_key(c) for c in captions]))
+    else:
+        pretokenize_captions(collator, [train_dataset, eval_dataset], token_cache)
+    
+    # Create dataloaders: decode in worker processes, stack + normalize per batch
+    dataloader_kwargs = dataloader_kwargs if dataloader_kwargs is not None else loader_kwargs()
+    if benchmark_batches:
+        train_dataloader = make_dataloader(train_dataset, collator, batch_size, shuffle=True, **dataloader_kwargs)
+        result = benchmark_dataloader(train_dataloader, benchmark_batches)
+        log_benchmark(result)
+        return result
+    
+    if model is None:
+        model = AutoModel.from_pretrained(model_name)
+    if gradient_checkpointing:
+        layers = enable_gradient_checkpointing(model.vision_model)
+        logger.info(f"Gradient checkpointing enabled on {layers} vision layers")
     
     # Create trainer
-    trainer = SigLIPTrainer(model, processor, device)
+    trainer = SigLIPTrainer(model, processor, device, precision)
+    
+    if profile_training or memory_budget_gb:
+        text_dim = model.config.text_config.hidden_size if freeze_text_tower else None
+        
+        def make_batch(size):
+            return synthetic_batch(size, image_size, collator.max_length, model.config.text_config.vocab_size,
+                                   text_dim)
+        
+        def make_step(step_precision, checkpointing):
+            # lr=0 keeps the weights untouched while still allocating the real optimizer state
+            probe_optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=0.0)
+            enable_gradient_checkpointing(model.vision_model, checkpointing)
+            trainer.precision = step_precision
+            return lambda batch: trainer.train_step(batch, probe_optimizer)
+        
+        model.train()
+        if profile_training:
+            results = profile_configs(make_step, make_batch, batch_size, device)
+            os.makedirs(output_dir, exist_ok=True)
+            with open(f"{output_dir}/training_profile.json", 'w') as f:
+                json.dump({'model_name': model_name, 'batch_size': batch_size, 'results': results}, f, indent=2)
+            return results
+        
+        search = find_batch_size(make_step(precision, gradient_checkpointing), make_batch,
+                                 memory_budget_gb * 1024, device, max_batch_size=max_batch_size)
+        model.zero_grad(set_to_none=True)
+        if search['batch_size'] is None:
+            raise SystemExit(f"No batch size fits in {memory_budget_gb}GB with precision={precision}, "
+                             f"gradient_checkpointing={gradient_checkpointing}")
+        batch_size = search['batch_size']
+        logger.info(f"Batch size {batch_size} fits in {memory_budget_gb}GB")
+    
+    train_dataloader = make_dataloader(train_dataset, collator, batch_size, shuffle=True, **dataloader_kwargs)
+    eval_dataloader = make_dataloader(eval_dataset, collator, batch_size, shuffle=False, **dataloader_kwargs)
     
     # Setup optimizer
-    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate)
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=learning_rate)
     
     # Training loop
     best_loss = float('inf')
+    samples_per_sec = 0.0
     
     for epoch in range(num_epochs):
         logger.info(f"Starting epoch {epoch + 1}/{num_epochs}")
         
         # Train
-        train_loss = trainer.train_epoch(train_dataloader, optimizer, epoch + 1)
+        train_loss, samples_per_sec = trainer.train_epoch(train_dataloader, optimizer, epoch + 1)
         
         # Evaluate
         trainer.model.eval()
         eval_loss = 0
         with torch.no_grad():
             for batch in tqdm(eval_dataloader, desc="Evaluating"):
-                input_ids = batch['input_ids'].to(device)
-                pixel_values = batch['pixel_values'].to(device)
-                
-                if 'attention_mask' in batch:
-                    attention_mask = batch['attention_mask'].to(device)
-                else:
-                    attention_mask = None
-                
-                outputs = trainer.model(
-                    input_ids=input_ids,
-                    attention_mask=attention_mask,
-                    pixel_values=pixel_values,
-                    return_loss=False
-                )
-                
-                image_embeds = outputs.image_embeds
-                text_embeds = outputs.text_embeds
-                loss = trainer.compute_contrastive_loss(image_embeds, text_embeds)
+                with autocast(precision, device):
+                    image_embeds, text_embeds = trainer.embed_batch(batch)
+                loss = trainer.compute_contrastive_loss(image_embeds.float(), text_embeds.float())
                 eval_loss += loss.item()
         
         eval_loss /= len(eval_dataloader)
         
-        logger.info(f"Epoch {epoch + 1}: Train Loss: {train_loss:.4f}, Eval Loss: {eval_loss:.4f}")
+        logger.info(f"Epoch {epoch + 1}: Train Loss: {train_loss:.4f}, Eval Loss: {eval_loss:.4f}, "
+                    f"{samples_per_sec:.1f} samples/sec")
         
         # Save best model
         if eval_loss < best_loss:
@@ -298,7 +289,11 @@ def train_siglip_model(image_paths, output_dir="./fashion_siglip_model", num_epo
         'num_epochs': num_epochs,
         'batch_size': batch_size,
         'learning_rate': learning_rate,
+        'precision': precision,
+        'gradient_checkpointing': gradient_checkpointing,
+        'samples_per_sec': round(samples_per_sec, 2),
         'best_eval_loss': best_loss,
+        'holdout': holdout,
         'brands': list(set(Path(p).parent.name for p in image_paths)),
     }
     
@@ -311,9 +306,18 @@ def train_siglip_model(image_paths, output_dir="./fashion_siglip_model", num_epo
 def main():
     parser = argparse.ArgumentParser(description="Train SigLIP model on local fashion images")
     parser.add_argument("--output_dir", default="./fashion_siglip_model", help="Output directory for trained model")
+    parser.add_argument("--model_name", default="google/siglip-base-patch16-224",
+                        help="Base checkpoint (e.g. google/siglip-so400m-patch14-384)")
     parser.add_argument("--epochs", type=int, default=3, help="Number of training epochs")
     parser.add_argument("--batch_size", type=int, default=16, help="Batch size")
     parser.add_argument("--learning_rate", type=float, default=1e-5, help="Learning rate")
+    parser.add_argument("--resized_cache", default=None, help="image_cache.py directory of pre-resized images (skips decode + resize)")
+    parser.add_argument("--freeze_text_tower", action="store_true",
+                        help="Keep the text encoder frozen and train on its cached caption features")
+    parser.add_argument("--feature_cache", default=None, help="feature_cache.py directory for --freeze_text_tower")
+    add_holdout_args(parser)
+    add_dataloader_args(parser)
+    add_perf_args(parser)
     
     args = parser.parse_args()
     
@@ -343,7 +347,20 @@ def main():
         output_dir=args.output_dir, 
         num_epochs=args.epochs,
         batch_size=args.batch_size,
-        learning_rate=args.learning_rate
+        learning_rate=args.learning_rate,
+        resized_cache=args.resized_cache,
+        dataloader_kwargs=loader_kwargs_from_args(args),
+        benchmark_batches=args.benchmark_batches if args.benchmark_data else 0,
+        token_cache=args.token_cache,
+        freeze_text_tower=args.freeze_text_tower,
+        feature_cache=args.feature_cache,
+        model_name=args.model_name,
+        precision=args.precision,
+        gradient_checkpointing=args.gradient_checkpointing,
+        memory_budget_gb=args.memory_budget_gb,
+        max_batch_size=args.max_batch_size,
+        profile_training=args.profile_training,
+        holdout=args.holdout
     )
 
 if __name__ == "__main__":
@@ -9,46 +9,40 @@ to improve clothing identification and similarity search accuracy.
 import os
 import json
 import logging
+import time
 import argparse
 from typing import Dict, List, Any, Optional
 from datetime import datetime
 import numpy as np
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader
 from transformers import AutoModel, AutoProcessor, Trainer, TrainingArguments
 from PIL import Image
 from pathlib import Path
 import random
 from tqdm import tqdm
 
+from catalog import BRAND_NAMES, brand_slug, catalog_files, iter_file
+from catalog_snapshot import load_table, product_id, warn_if_stale, with_local_image
+from image_store import ImageStore
+from image_cache import ResizedImageCache
+from feature_cache import FeatureCache
+from training_data import (DEFAULT_HOLDOUT, BatchCollator, ImageTextDataset, add_dataloader_args, add_holdout_args,
+                           benchmark_dataloader, in_holdout, loader_kwargs, loader_kwargs_from_args, log_benchmark,
+                           make_dataloader, pretokenize_captions, trainer_dataloader_args)
+from training_perf import add_perf_args
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class LocalFashionDataset(Dataset):
+class LocalFashionDataset(ImageTextDataset):
     """Custom dataset for fashion items using local images"""
     
-    def __init__(self, products: List[Dict], processor, max_length: int = 77):
-        self.products = products
-        self.processor = processor
-        self.max_length = max_length
-    
-    def __len__(self):
-        return len(self.products)
+    def image_path(self, product):
+        return product['local_image_path']
     
-    def __getitem__(self, idx):
-        product = self.products[idx]
-        
-        # Load local image
-        try:
-            image_path = product['local_image_path']
-            image = Image.open(image_path).convert('RGB')
-        except Exception as e:
-            logger.warning(f"Failed to load image {product['local_image_path']}: {e}")
-            # Create a blank image as fallback
-            image = Image.new('RGB', (224, 224), color='white')
-        
+    def caption(self, product):
         # Create text description from metadata
         text_parts = []
         if product.get('title'):
@@ -59,33 +53,37 @@ class LocalFashionDataset(Dataset):
             text_parts.append(f"category: {product['category']}")
         if product.get('color'):
             text_parts.append(f"color: {product['color']}")
-        
-        text = " ".join(text_parts)
-        
-        # Process with SigLIP processor
-        inputs = self.processor(
-            text=text,
-            images=image,
-            return_tensors="pt",
-            padding=True,
-            truncation=True,
-            max_length=self.max_length
-        )
-        
-        return {
-            'input_ids': inputs['input_ids'].squeeze(),
-            'attention_mask': inputs['attention_mask'].squeeze(), 
-            'pixel_values': inputs['pixel_values'].squeeze(),
-            'product_id': product.get('id', idx)
-        }
+        return " ".join(text_parts)
 
 class LocalSigLIPTrainer:
     """Handles training of SigLIP model using local fashion images"""
     
-    def __init__(self, model_name: str = "google/siglip-base-patch16-224"):
+    def __init__(self, model_name: str = "google/siglip-base-patch16-224", image_store: Optional[str] = None,
+                 resized_cache: Optional[str] = None, catalog_snapshot: Optional[str] = None,
+                 dataloader_kwargs: Optional[Dict] = None, token_cache: Optional[str] = None,
+                 batch_size: int = 8, gradient_accumulation_steps: int = 2, precision: str = "fp32",
+                 gradient_checkpointing: bool = False, holdout: float = DEFAULT_HOLDOUT):
         self.model_name = model_name
+        # products evaluate_retrieval.py scores on are never trained on
+        self.holdout = holdout
+        self.batch_size = batch_size
+        self.gradient_accumulation_steps = gradient_accumulation_steps
+        # bf16 autocast / activation recomputation, passed through to TrainingArguments
+        self.precision = precision
+        self.gradient_checkpointing = gradient_checkpointing
+        # catalog_snapshot.py Parquet file; replaces parsing the JSON catalog on every run
+        self.catalog_snapshot = catalog_snapshot
+        # content-addressed store from image_store.py; looked up by image URL before the brand folders
+        self.image_store = ImageStore(image_store) if image_store else None
         self.processor = AutoProcessor.from_pretrained(model_name)
         self.model = AutoModel.from_pretrained(model_name)
+        image_size = self.processor.image_processor.size["height"]
+        self.image_size = image_size
+        self.resized_cache = ResizedImageCache(resized_cache, image_size) if resized_cache else None
+        # workers / prefetch / pinned memory for the Trainer's DataLoaders
+        self.dataloader_kwargs = dataloader_kwargs if dataloader_kwargs is not None else loader_kwargs()
+        self.collator = BatchCollator(self.processor)
+        self.token_cache = token_cache
         
         # Setup model for fine-tuning
         self.setup_model_for_finetuning()
@@ -127,121 +125,101 @@ class LocalSigLIPTrainer:
         logger.info(f"Loading products from {json_dir} and linking with images from {images_dir}")
         
         products = []
-        json_path = Path(json_dir)
         images_path = Path(images_dir)
+        image_dirs = [d for d in images_path.iterdir() if d.is_dir()] if images_path.exists() else []
         
         # Get all JSON files
-        json_files = list(json_path.glob("*.json"))
+        json_files = catalog_files([json_dir])
         logger.info(f"Found {len(json_files)} JSON files")
         
         for json_file in tqdm(json_files, desc="Processing JSON files"):
-            try:
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    brand_data = json.load(f)
-                
-                brand_name = json_file.stem.replace('_complete_data', '').replace('_data', '').title()
+            brand_name = brand_slug(json_file).title()
+            
+            # Find corresponding image directory
+            brand_image_dir = None
+            mapped_brand = BRAND_NAMES.get(brand_name.lower())
+            for img_dir in image_dirs:
+                # Try to match using the mapping
+                if mapped_brand and img_dir.name == mapped_brand:
+                    brand_image_dir = img_dir
+                    break
                 
-                # Handle different JSON structures
-                if isinstance(brand_data, list):
-                    products_list = brand_data
-                elif isinstance(brand_data, dict) and 'products' in brand_data:
-                    products_list = brand_data['products']
-                else:
-                    logger.warning(f"Unknown structure in {json_file}")
+                # Fallback: try partial matching
+                if brand_name.lower() in img_dir.name.lower() or img_dir.name.lower() in brand_name.lower():
+                    brand_image_dir = img_dir
+                    break
+            
+            if not brand_image_dir and not self.image_store:
+                logger.warning(f"No image directory found for brand {brand_name}")
+                continue
+            
+            # Link products with local images; records are streamed and normalized by catalog.py
+            brand_count = 0
+            for record in iter_file(json_file):
+                if not record.main_image:
                     continue
                 
-                # Find corresponding image directory
-                brand_image_dir = None
-                for img_dir in images_path.iterdir():
-                    if img_dir.is_dir():
-                        # Create a mapping for brand names
-                        brand_mapping = {
-                            'nike': 'Nike',
-                            'adidas': 'Adidas',
-                            'carhartt': 'Carhartt WIP',
-                            'stussy': 'Stussy',
-                            'uniqlo': 'Uniqlo',
-                            'newbalance': 'New Balance',
-                            'aunecollections': 'AuneCollections',
-                            'namacheko': 'Namacheko',
-                            'ottolinger': 'Otto Linger',
-                            'heliotemil': 'HELIOT EMIL',
-                            'noahny': 'Noah NY',
-                            'aimeleondore': 'Aime Leon Dore',
-                            'rickowens': 'Rick Owens',
-                            'therow': 'The Row',
-                            'avavav': 'Avavav',
-                            'fanciclub': 'Fanci Club',
-                            '032c': '032c',
-                            'nensidojaka': 'Nensi Dojaka',
-                            'walesbonner': 'Wales Bonner',
-                            'mowalola': 'MOWALOLA',
-                            'eytys': 'EYTYS',
-                            'dailypaperclothing': 'Daily Paper',
-                            'blumarine': 'Blumarine',
-                            'jadedldn': 'Jaded London',
-                            'palomawool': 'Paloma Wool',
-                            'ludovicdesaintsernin': 'Ludovic de Saint Sernin',
-                            'diotima': 'DIOTIMA',
-                            'maisiewilen': 'Maisie Wilen'
-                        }
-                        
-                        # Try to match using the mapping
-                        mapped_brand = brand_mapping.get(brand_name.lower())
-                        if mapped_brand and img_dir.name == mapped_brand:
-                            brand_image_dir = img_dir
-                            break
-                        
-                        # Fallback: try partial matching
-                        if brand_name.lower() in img_dir.name.lower() or img_dir.name.lower() in brand_name.lower():
-                            brand_image_dir = img_dir
-                            break
-                
-                if not brand_image_dir:
-                    logger.warning(f"No image directory found for brand {brand_name}")
-                    continue
+                # Extract filename from URL
+                url_path = record.main_image
+                filename = url_path.split('/')[-1]
                 
-                # Link products with local images
-                for product in products_list:
-                    if not product.get('mainImage'):
+                # Look for the image file, in the image store first
+                image_file = self.image_store.path_for_url(url_path) if self.image_store else None
+                if image_file is None:
+                    if not brand_image_dir:
                         continue
-                    
-                    # Extract filename from URL
-                    url_path = product['mainImage']
-                    filename = url_path.split('/')[-1]
-                    
-                    # Look for the image file
                     image_file = brand_image_dir / filename
-                    if not image_file.exists():
-                        # Try with different extensions
-                        for ext in ['.jpg', '.jpeg', '.png', '.webp']:
-                            alt_file = brand_image_dir / f"{filename.split('.')[0]}{ext}"
-                            if alt_file.exists():
-                                image_file = alt_file
-                                break
-                    
-                    if image_file.exists():
-                        product['local_image_path'] = str(image_file)
-                        product['brand'] = brand_name
-                        product['title'] = product.get('name', '')
-                        products.append(product)
-                
-                logger.info(f"Processed {brand_name}: {len([p for p in products if p.get('brand') == brand_name])} products")
+                if not image_file.exists() and brand_image_dir:
+                    # Try with different extensions
+                    for ext in ['.jpg', '.jpeg', '.png', '.webp']:
+                        alt_file = brand_image_dir / f"{filename.split('.')[0]}{ext}"
+                        if alt_file.exists():
+                            image_file = alt_file
+                            break
                 
-            except Exception as e:
-                logger.error(f"Error processing {json_file}: {e}")
-                continue
+                if image_file.exists():
+                    product = record.to_dict()
+                    product['id'] = product_id(record)
+                    product['local_image_path'] = str(image_file)
+                    product['brand'] = brand_name
+                    product['title'] = record.name
+                    product['color'] = record.color
+                    products.append(product)
+                    brand_count += 1
+            
+            logger.info(f"Processed {brand_name}: {brand_count} products")
         
         logger.info(f"Total products with local images: {len(products)}")
         return products
     
+    def load_products_from_snapshot(self, path: str) -> List[Dict[str, Any]]:
+        """Load products whose main image was resolved when the catalog snapshot was built"""
+        warn_if_stale(path)
+        table = load_table(
+            path,
+            columns=['id', 'source', 'name', 'category', 'colors', 'price', 'local_path'],
+            filters=with_local_image(),
+        )
+        products = []
+        for row in table.to_pylist():
+            if not os.path.exists(row['local_path']):
+                continue
+            colors = row.pop('colors') or []
+            row['brand'] = row.pop('source').title()
+            row['title'] = row['name']
+            row['color'] = colors[0] if colors else None
+            row['local_image_path'] = row.pop('local_path')
+            products.append(row)
+        logger.info(f"Loaded {len(products)} products with local images from {path}")
+        return products
+    
     def create_training_args(self, output_dir: str, num_epochs: int = 3) -> TrainingArguments:
         """Create training arguments for Hugging Face Trainer"""
         return TrainingArguments(
             output_dir=output_dir,
             num_train_epochs=num_epochs,
-            per_device_train_batch_size=8,  # Reduced for memory constraints
-            per_device_eval_batch_size=8,
+            per_device_train_batch_size=self.batch_size,
+            per_device_eval_batch_size=self.batch_size,
             warmup_steps=500,
             weight_decay=0.01,
             logging_dir=f'{output_dir}/logs',
@@ -250,16 +228,22 @@ class LocalSigLIPTrainer:
             eval_steps=500,
             save_strategy="steps",
             remove_unused_columns=False,
-            dataloader_pin_memory=False,
-            gradient_accumulation_steps=2,  # Effective batch size = 8 * 2 = 16
+            bf16=self.precision == "bf16",
+            use_cpu=not torch.cuda.is_available(),  # bf16 on CPU needs this set explicitly
+            gradient_checkpointing=self.gradient_checkpointing,
+            **trainer_dataloader_args(self.dataloader_kwargs),
+            gradient_accumulation_steps=self.gradient_accumulation_steps,  # Effective batch size = batch_size * steps
         )
     
-    def train_model(self, output_dir: str = "./fashion_siglip_model", num_epochs: int = 3):
-        """Main training function"""
-        logger.info("Starting SigLIP model training for fashion items using local images...")
-        
-        # Load training data
-        products = self.load_products_from_json()
+    def load_training_split(self):
+        """(products, train_products, eval_products) with an 80/20 split of the products not held out"""
+        if self.catalog_snapshot:
+            products = self.load_products_from_snapshot(self.catalog_snapshot)
+        else:
+            products = self.load_products_from_json()
+        held_out = sum(1 for p in products if in_holdout(p['id'], self.holdout))
+        products = [p for p in products if not in_holdout(p['id'], self.holdout)]
+        logger.info(f"Held out {held_out} evaluation products (holdout={self.holdout})")
         if len(products) < 100:
             logger.warning(f"Only {len(products)} products found. Consider adding more data for better training.")
         
@@ -270,10 +254,26 @@ class LocalSigLIPTrainer:
         eval_products = products[split_idx:]
         
         logger.info(f"Training on {len(train_products)} products, evaluating on {len(eval_products)} products")
+        return products, train_products, eval_products
+    
+    def train_model(self, output_dir: str = "./fashion_siglip_model", num_epochs: int = 3, benchmark_batches: int = 0):
+        """Main training function"""
+        logger.info("Starting SigLIP model training for fashion items using local images...")
+        
+        # Load training data
+        products, train_products, eval_products = self.load_training_split()
         
         # Create datasets
-        train_dataset = LocalFashionDataset(train_products, self.processor)
-        eval_dataset = LocalFashionDataset(eval_products, self.processor)
+        train_dataset = LocalFashionDataset(train_products, self.image_size, resized_cache=self.resized_cache)
+        eval_dataset = LocalFashionDataset(eval_products, self.image_size, resized_cache=self.resized_cache)
+        pretokenize_captions(self.collator, [train_dataset, eval_dataset], self.token_cache)
+        
+        if benchmark_batches:
+            batch_size = self.create_training_args(output_dir).per_device_train_batch_size
+            loader = make_dataloader(train_dataset, self.collator, batch_size, shuffle=True, **self.dataloader_kwargs)
+            result = benchmark_dataloader(loader, benchmark_batches)
+            log_benchmark(result)
+            return result
         
         # Create training arguments
         training_args = self.create_training_args(output_dir, num_epochs)
@@ -284,6 +284,7 @@ class LocalSigLIPTrainer:
             args=training_args,
             train_dataset=train_dataset,
             eval_dataset=eval_dataset,
+            data_collator=self.collator,
         )
         
         # Train the model
@@ -302,6 +303,7 @@ class LocalSigLIPTrainer:
             'num_train_products': len(train_products),
             'num_eval_products': len(eval_products),
             'num_epochs': num_epochs,
+            'holdout': self.holdout,
             'brands': list(set(p.get('brand', '') for p in products)),
         }
         
@@ -310,20 +312,163 @@ class LocalSigLIPTrainer:
         
         logger.info("Training completed successfully!")
         return output_dir
+    
+    def train_adapters_on_features(self, output_dir: str = "./fashion_siglip_model", num_epochs: int = 3,
+                                   feature_cache_dir: str = "feature_cache", batch_size: int = 256,
+                                   learning_rate: float = 1e-3):
+        """
+        Train only the fashion adapters, on frozen-tower features computed once
+        and memory-mapped by feature_cache.py. An epoch is an MLP step per batch
+        instead of a full SigLIP forward pass per image.
+        """
+        logger.info("Training fashion adapters on cached backbone features...")
+        products, train_products, eval_products = self.load_training_split()
+        device = next(self.model.parameters()).device
+        
+        # Build any missing features with the frozen towers (a no-op on later runs)
+        cache = FeatureCache(feature_cache_dir, self.model_name)
+        self.model.eval()
+        start = time.perf_counter()
+        captioner = LocalFashionDataset(products, self.image_size)
+        paths = [p['local_image_path'] for p in products]
+        captions = [captioner.caption(p) for p in products]
+        added_images = cache.build_vision(self.model, self.processor, paths, device,
+                                          resized_cache=self.resized_cache, dataloader_kwargs=self.dataloader_kwargs)
+        added_texts = cache.build_text(self.model, self.processor, captions, device)
+        logger.info(f"Feature cache: {added_images} images and {added_texts} captions embedded "
+                    f"in {time.perf_counter() - start:.1f}s ({len(cache.vision)} / {len(cache.text)} cached)")
+        
+        def tensors(split):
+            vision, text = cache.features([p['local_image_path'] for p in split],
+                                          [captioner.caption(p) for p in split])
+            return torch.from_numpy(vision).to(device), torch.from_numpy(text).to(device)
+        
+        train_vision, train_text = tensors(train_products)
+        eval_vision, eval_text = tensors(eval_products)
+        
+        # Residual adapters: start from the pretrained embedding space
+        def embed(vision, text):
+            return (vision + self.fashion_vision_adapter(vision),
+                    text + self.fashion_text_adapter(text))
+        
+        logit_scale = nn.Parameter(self.model.logit_scale.detach().clone())
+        logit_bias = nn.Parameter(self.model.logit_bias.detach().clone())
+        params = (list(self.fashion_vision_adapter.parameters()) + list(self.fashion_text_adapter.parameters())
+                  + [logit_scale, logit_bias])
+        optimizer = torch.optim.AdamW(params, lr=learning_rate, weight_decay=0.01)
+        
+        best_loss = float('inf')
+        epoch_seconds = []
+        for epoch in range(num_epochs):
+            self.fashion_vision_adapter.train()
+            self.fashion_text_adapter.train()
+            start = time.perf_counter()
+            order = torch.randperm(len(train_vision), device=device)
+            total_loss, steps = 0.0, 0
+            for i in range(0, len(order), batch_size):
+                idx = order[i:i + batch_size]
+                if len(idx) < 2:
+                    continue
+                image_embeds, text_embeds = embed(train_vision[idx], train_text[idx])
+                loss = sigmoid_contrastive_loss(image_embeds, text_embeds, logit_scale, logit_bias)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                total_loss += loss.item()
+                steps += 1
+            epoch_seconds.append(time.perf_counter() - start)
+            
+            self.fashion_vision_adapter.eval()
+            self.fashion_text_adapter.eval()
+            eval_loss, eval_steps = 0.0, 0
+            with torch.no_grad():
+                for i in range(0, len(eval_vision), batch_size):
+                    if len(eval_vision[i:i + batch_size]) < 2:
+                        continue
+                    image_embeds, text_embeds = embed(eval_vision[i:i + batch_size], eval_text[i:i + batch_size])
+                    eval_loss += sigmoid_contrastive_loss(image_embeds, text_embeds, logit_scale, logit_bias).item()
+                    eval_steps += 1
+            eval_loss /= max(eval_steps, 1)
+            logger.info(f"Epoch {epoch + 1}: Train Loss: {total_loss / max(steps, 1):.4f}, "
+                        f"Eval Loss: {eval_loss:.4f} ({epoch_seconds[-1]:.2f}s)")
+            
+            if eval_loss < best_loss:
+                best_loss = eval_loss
+                os.makedirs(output_dir, exist_ok=True)
+                torch.save({
+                    'vision_adapter': self.fashion_vision_adapter.state_dict(),
+                    'text_adapter': self.fashion_text_adapter.state_dict(),
+                    'logit_scale': logit_scale.detach().cpu(),
+                    'logit_bias': logit_bias.detach().cpu(),
+                    'residual': True,
+                }, f"{output_dir}/fashion_adapters.pt")
+        
+        self.processor.save_pretrained(output_dir)
+        metadata = {
+            'model_name': self.model_name,
+            'mode': 'adapters_on_cached_features',
+            'training_date': datetime.now().isoformat(),
+            'num_train_products': len(train_products),
+            'num_eval_products': len(eval_products),
+            'num_epochs': num_epochs,
+            'batch_size': batch_size,
+            'learning_rate': learning_rate,
+            'best_eval_loss': best_loss,
+            'epoch_seconds': [round(s, 3) for s in epoch_seconds],
+            'holdout': self.holdout,
+            'brands': list(set(p.get('brand', '') for p in products)),
+        }
+        with open(f"{output_dir}/training_metadata.json", 'w') as f:
+            json.dump(metadata, f, indent=2)
+        
+        logger.info(f"Adapters saved to {output_dir}/fashion_adapters.pt")
+        return output_dir
+
+def sigmoid_contrastive_loss(image_embeds, text_embeds, logit_scale, logit_bias):
+    """SigLIP's pairwise sigmoid loss: matching pairs on the diagonal, every other pair negative"""
+    image_embeds = image_embeds / image_embeds.norm(p=2, dim=-1, keepdim=True)
+    text_embeds = text_embeds / text_embeds.norm(p=2, dim=-1, keepdim=True)
+    logits = image_embeds @ text_embeds.t() * logit_scale.exp() + logit_bias
+    labels = 2 * torch.eye(logits.shape[0], device=logits.device) - 1
+    return -torch.nn.functional.logsigmoid(labels * logits).sum() / logits.shape[0]
 
 def main():
     parser = argparse.ArgumentParser(description="Train SigLIP model on local fashion images")
     parser.add_argument("--output_dir", default="./fashion_siglip_model", help="Output directory for trained model")
     parser.add_argument("--epochs", type=int, default=3, help="Number of training epochs")
     parser.add_argument("--model_name", default="google/siglip-base-patch16-224", help="Base SigLIP model to fine-tune")
+    parser.add_argument("--image_store", default=None, help="Content-addressed image store (image_store.py) to load images from")
+    parser.add_argument("--catalog_snapshot", default=None, help="catalog_snapshot.py Parquet file to load products from instead of the JSON catalog")
+    parser.add_argument("--resized_cache", default=None, help="image_cache.py directory of pre-resized images (skips decode + resize)")
+    parser.add_argument("--feature_cache", default=None,
+                        help="Train only the adapters, on frozen-backbone features cached in this directory (feature_cache.py)")
+    parser.add_argument("--adapter_batch_size", type=int, default=256, help="Batch size with --feature_cache")
+    parser.add_argument("--adapter_learning_rate", type=float, default=1e-3, help="Learning rate with --feature_cache")
+    parser.add_argument("--batch_size", type=int, default=8, help="Per-device batch size")
+    parser.add_argument("--gradient_accumulation_steps", type=int, default=2, help="Steps per optimizer update")
+    
+    add_holdout_args(parser)
+    add_dataloader_args(parser)
+    add_perf_args(parser, search=False)
     
     args = parser.parse_args()
     
     # Create trainer
-    trainer = LocalSigLIPTrainer(model_name=args.model_name)
+    trainer = LocalSigLIPTrainer(model_name=args.model_name, image_store=args.image_store,
+                                 resized_cache=args.resized_cache, catalog_snapshot=args.catalog_snapshot,
+                                 dataloader_kwargs=loader_kwargs_from_args(args), token_cache=args.token_cache,
+                                 batch_size=args.batch_size, gradient_accumulation_steps=args.gradient_accumulation_steps,
+                                 precision=args.precision, gradient_checkpointing=args.gradient_checkpointing,
+                                 holdout=args.holdout)
     
     # Train model
-    trainer.train_model(output_dir=args.output_dir, num_epochs=args.epochs)
+    if args.feature_cache and not args.benchmark_data:
+        trainer.train_adapters_on_features(output_dir=args.output_dir, num_epochs=args.epochs,
+                                           feature_cache_dir=args.feature_cache, batch_size=args.adapter_batch_size,
+                                           learning_rate=args.adapter_learning_rate)
+    else:
+        trainer.train_model(output_dir=args.output_dir, num_epochs=args.epochs,
+                            benchmark_batches=args.benchmark_batches if args.benchmark_data else 0)
 
 if __name__ == "__main__":
     main()
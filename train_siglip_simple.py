@@ -15,87 +15,57 @@ from datetime import datetime
 import numpy as np
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader
-from transformers import AutoModel, AutoProcessor, Trainer, TrainingArguments, DataCollatorWithPadding
+from transformers import AutoModel, AutoProcessor, Trainer, TrainingArguments
 from PIL import Image
 from pathlib import Path
 import random
 from tqdm import tqdm
 
+from image_cache import ResizedImageCache
+from training_data import (DEFAULT_HOLDOUT, BatchCollator, ImageTextDataset, add_dataloader_args, add_holdout_args,
+                           benchmark_dataloader, drop_holdout_paths, image_caption_from_path, loader_kwargs,
+                           loader_kwargs_from_args, log_benchmark, make_dataloader, pretokenize_captions,
+                           trainer_dataloader_args)
+from training_perf import add_perf_args
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class LocalFashionDataset(Dataset):
+class LocalFashionDataset(ImageTextDataset):
     """Custom dataset for fashion items using local images"""
     
-    def __init__(self, image_paths: List[str], processor, max_length: int = 77):
-        self.image_paths = image_paths
-        self.processor = processor
-        self.max_length = max_length
-    
-    def __len__(self):
-        return len(self.image_paths)
+    def image_path(self, item):
+        return item
     
-    def __getitem__(self, idx):
-        image_path = self.image_paths[idx]
-        
-        # Load local image
-        try:
-            image = Image.open(image_path).convert('RGB')
-        except Exception as e:
-            logger.warning(f"Failed to load image {image_path}: {e}")
-            # Create a blank image as fallback
-            image = Image.new('RGB', (224, 224), color='white')
-        
+    def caption(self, item):
         # Create text description from filename and path
-        brand = Path(image_path).parent.name
-        filename = Path(image_path).stem
-        
-        # Clean up filename for better text description
-        text_parts = []
-        text_parts.append(brand)
-        
-        # Extract product info from filename
-        if '_main' in filename:
-            filename = filename.replace('_main', '')
-        if '_secondary' in filename:
-            filename = filename.replace('_secondary_1', '').replace('_secondary_2', '').replace('_secondary_3', '').replace('_secondary_4', '')
-        
-        # Add cleaned filename as description
-        text_parts.append(filename)
-        
-        text = " ".join(text_parts)
-        
-        # Process with SigLIP processor
-        inputs = self.processor(
-            text=text,
-            images=image,
-            return_tensors="pt",
-            padding=True,
-            truncation=True,
-            max_length=self.max_length
-        )
-        
-        # Handle different processor outputs
-        result = {
-            'input_ids': inputs['input_ids'].squeeze(),
-            'pixel_values': inputs['pixel_values'].squeeze(),
-        }
-        
-        # Add attention_mask if available
-        if 'attention_mask' in inputs:
-            result['attention_mask'] = inputs['attention_mask'].squeeze()
-        
-        return result
+        return image_caption_from_path(item)
 
 class LocalSigLIPTrainer:
     """Handles training of SigLIP model using local fashion images"""
     
-    def __init__(self, model_name: str = "google/siglip-base-patch16-224"):
+    def __init__(self, model_name: str = "google/siglip-base-patch16-224", resized_cache: Optional[str] = None,
+                 dataloader_kwargs: Optional[Dict] = None, token_cache: Optional[str] = None,
+                 batch_size: int = 8, gradient_accumulation_steps: int = 2, precision: str = "fp32",
+                 gradient_checkpointing: bool = False, holdout: float = DEFAULT_HOLDOUT):
         self.model_name = model_name
+        # products evaluate_retrieval.py scores on are never trained on
+        self.holdout = holdout
+        self.batch_size = batch_size
+        self.gradient_accumulation_steps = gradient_accumulation_steps
+        # bf16 autocast / activation recomputation, passed through to TrainingArguments
+        self.precision = precision
+        self.gradient_checkpointing = gradient_checkpointing
         self.processor = AutoProcessor.from_pretrained(model_name)
         self.model = AutoModel.from_pretrained(model_name)
+        image_size = self.processor.image_processor.size["height"]
+        self.image_size = image_size
+        self.resized_cache = ResizedImageCache(resized_cache, image_size) if resized_cache else None
+        # workers / prefetch / pinned memory for the Trainer's DataLoaders
+        self.dataloader_kwargs = dataloader_kwargs if dataloader_kwargs is not None else loader_kwargs()
+        self.collator = BatchCollator(self.processor)
+        self.token_cache = token_cache
         
         # Setup model for fine-tuning
         self.setup_model_for_finetuning()
@@ -161,8 +131,8 @@ class LocalSigLIPTrainer:
         return TrainingArguments(
             output_dir=output_dir,
             num_train_epochs=num_epochs,
-            per_device_train_batch_size=8,  # Reduced for memory constraints
-            per_device_eval_batch_size=8,
+            per_device_train_batch_size=self.batch_size,
+            per_device_eval_batch_size=self.batch_size,
             warmup_steps=500,
             weight_decay=0.01,
             logging_dir=f'{output_dir}/logs',
@@ -171,16 +141,19 @@ class LocalSigLIPTrainer:
             eval_steps=500,
             save_strategy="steps",
             remove_unused_columns=False,
-            dataloader_pin_memory=False,
-            gradient_accumulation_steps=2,  # Effective batch size = 8 * 2 = 16
+            bf16=self.precision == "bf16",
+            use_cpu=not torch.cuda.is_available(),  # bf16 on CPU needs this set explicitly
+            gradient_checkpointing=self.gradient_checkpointing,
+            **trainer_dataloader_args(self.dataloader_kwargs),
+            gradient_accumulation_steps=self.gradient_accumulation_steps,  # Effective batch size = batch_size * steps
         )
     
-    def train_model(self, output_dir: str = "./fashion_siglip_model", num_epochs: int = 3):
+    def train_model(self, output_dir: str = "./fashion_siglip_model", num_epochs: int = 3, benchmark_batches: int = 0):
         """Main training function"""
         logger.info("Starting SigLIP model training for fashion items using local images...")
         
         # Load training data
-        image_paths = self.load_images_from_directories()
+        image_paths = drop_holdout_paths(self.load_images_from_directories(), self.holdout)
         if len(image_paths) < 100:
             logger.warning(f"Only {len(image_paths)} images found. Consider adding more data for better training.")
         
@@ -193,8 +166,16 @@ class LocalSigLIPTrainer:
         logger.info(f"Training on {len(train_images)} images, evaluating on {len(eval_images)} images")
         
         # Create datasets
-        train_dataset = LocalFashionDataset(train_images, self.processor)
-        eval_dataset = LocalFashionDataset(eval_images, self.processor)
+        train_dataset = LocalFashionDataset(train_images, self.image_size, resized_cache=self.resized_cache)
+        eval_dataset = LocalFashionDataset(eval_images, self.image_size, resized_cache=self.resized_cache)
+        pretokenize_captions(self.collator, [train_dataset, eval_dataset], self.token_cache)
+        
+        if benchmark_batches:
+            batch_size = self.create_training_args(output_dir).per_device_train_batch_size
+            loader = make_dataloader(train_dataset, self.collator, batch_size, shuffle=True, **self.dataloader_kwargs)
+            result = benchmark_dataloader(loader, benchmark_batches)
+            log_benchmark(result)
+            return result
         
         # Create training arguments
         training_args = self.create_training_args(output_dir, num_epochs)
@@ -205,7 +186,7 @@ class LocalSigLIPTrainer:
             args=training_args,
             train_dataset=train_dataset,
             eval_dataset=eval_dataset,
-            data_collator=DataCollatorWithPadding(tokenizer=self.processor.tokenizer),
+            data_collator=self.collator,
         )
         
         # Train the model
@@ -224,6 +205,7 @@ class LocalSigLIPTrainer:
             'num_train_images': len(train_images),
             'num_eval_images': len(eval_images),
             'num_epochs': num_epochs,
+            'holdout': self.holdout,
             'brands': list(set(Path(p).parent.name for p in image_paths)),
         }
         
@@ -238,14 +220,26 @@ def main():
     parser.add_argument("--output_dir", default="./fashion_siglip_model", help="Output directory for trained model")
     parser.add_argument("--epochs", type=int, default=3, help="Number of training epochs")
     parser.add_argument("--model_name", default="google/siglip-base-patch16-224", help="Base SigLIP model to fine-tune")
+    parser.add_argument("--resized_cache", default=None, help="image_cache.py directory of pre-resized images (skips decode + resize)")
+    parser.add_argument("--batch_size", type=int, default=8, help="Per-device batch size")
+    parser.add_argument("--gradient_accumulation_steps", type=int, default=2, help="Steps per optimizer update")
+    
+    add_holdout_args(parser)
+    add_dataloader_args(parser)
+    add_perf_args(parser, search=False)
     
     args = parser.parse_args()
     
     # Create trainer
-    trainer = LocalSigLIPTrainer(model_name=args.model_name)
+    trainer = LocalSigLIPTrainer(model_name=args.model_name, resized_cache=args.resized_cache,
+                                 dataloader_kwargs=loader_kwargs_from_args(args), token_cache=args.token_cache,
+                                 batch_size=args.batch_size, gradient_accumulation_steps=args.gradient_accumulation_steps,
+                                 precision=args.precision, gradient_checkpointing=args.gradient_checkpointing,
+                                 holdout=args.holdout)
     
     # Train model
-    trainer.train_model(output_dir=args.output_dir, num_epochs=args.epochs)
+    trainer.train_model(output_dir=args.output_dir, num_epochs=args.epochs,
+                        benchmark_batches=args.benchmark_batches if args.benchmark_data else 0)
 
 if __name__ == "__main__":
     main()
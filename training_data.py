@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+"""
+Training Input Pipeline
+
+Shared by the train_siglip_*.py scripts so the model never waits on image
+decoding or tokenization:
+
+  - datasets only decode + resize (or read the pre-resized array from
+    image_cache.py) and return uint8 arrays plus the caption text; this runs
+    in DataLoader worker processes
+  - captions are tokenized once per run (CaptionTokens, saved under
+    --token_cache to be reused across runs); BatchCollator stacks the
+    token rows and normalizes the stacked images in one vectorized step,
+    instead of a processor(...) call per sample. With a frozen text tower,
+    cached text features (feature_cache.py) replace the tokens altogether
+  - loader_kwargs() turns --num_workers / --prefetch_factor /
+    --persistent_workers / --pin_memory into DataLoader arguments
+  - in_holdout() picks the products evaluate_retrieval.py scores checkpoints
+    on (by a hash of the product id); every training script leaves them out,
+    so retrieval metrics are measured on products no checkpoint has seen
+
+benchmark_dataloader() times the data path alone (no model), so input
+throughput can be tuned separately from training:
+
+    python train_siglip_custom.py --benchmark_data --num_workers 8
+"""
+
+import os
+import time
+import hashlib
+import logging
+import argparse
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Set
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+
+from catalog import DEFAULT_DIRS, Product, downloaded_image_path, iter_products
+from catalog_snapshot import product_id
+from image_cache import ResizedImageCache, content_key, pixel_values, resize_for_model
+from image_store import ImageStore
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_NUM_WORKERS = min(8, os.cpu_count() or 1)
+DEFAULT_PREFETCH_FACTOR = 4
+DEFAULT_HOLDOUT = 0.2  # fraction of products reserved for evaluate_retrieval.py
+
+
+def load_image_array(path: str, size: int, resized_cache: Optional[ResizedImageCache] = None) -> np.ndarray:
+    """(size, size, 3) uint8 for the image at path; a white image if it can't be read"""
+    if resized_cache is not None:
+        try:
+            cached = resized_cache.get(content_key(path))
+        except OSError:
+            cached = None
+        if cached is not None:
+            return np.array(cached)
+    try:
+        with Image.open(path) as image:
+            return resize_for_model(image, size)
+    except Exception as e:
+        logger.warning(f"Failed to load image {path}: {e}")
+        return np.full((size, size, 3), 255, dtype=np.uint8)
+
+
+class ImagePathDataset(Dataset):
+    """(S, S, 3) uint8 images for a list of paths, no captions"""
+
+    def __init__(self, paths: List[str], image_size: int, resized_cache: Optional[ResizedImageCache] = None):
+        self.paths = paths
+        self.image_size = image_size
+        self.resized_cache = resized_cache
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        return load_image_array(self.paths[idx], self.image_size, self.resized_cache)
+
+
+class CaptionTokens:
+    """
+    Every caption tokenized once, as an (N, max_length) int32 matrix padded
+    with the tokenizer's pad id plus per-row lengths, so collation is a
+    numpy stack + slice instead of a tokenizer call per batch.
+    """
+
+    def __init__(self, ids: np.ndarray, lengths: np.ndarray, with_attention_mask: bool):
+        self.ids = ids
+        self.lengths = lengths
+        self.with_attention_mask = with_attention_mask
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, tokenizer, captions: List[str], max_length: int = 77, cache_dir: Optional[str] = None,
+              batch_size: int = 1024) -> 'CaptionTokens':
+        max_length = min(max_length, getattr(tokenizer, 'model_max_length', max_length))
+        path = None
+        if cache_dir:
+            digest = hashlib.sha1(f"{getattr(tokenizer, 'name_or_path', '')}|{max_length}".encode())
+            for caption in captions:
+                digest.update(caption.encode('utf-8') + b'\0')
+            path = Path(cache_dir) / f"captions_{digest.hexdigest()[:16]}.npz"
+            if path.exists():
+                with np.load(path) as data:
+                    return cls(data['ids'], data['lengths'], bool(data['with_attention_mask']))
+
+        pad_id = getattr(tokenizer, 'pad_token_id', None) or 0
+        ids = np.full((len(captions), max_length), pad_id, dtype=np.int32)
+        lengths = np.zeros(len(captions), dtype=np.int32)
+        with_attention_mask = False
+        for start in range(0, len(captions), batch_size):
+            # one unpadded call per chunk; rows are copied into the preallocated matrix
+            tokens = tokenizer(captions[start:start + batch_size], truncation=True, max_length=max_length)
+            with_attention_mask = with_attention_mask or 'attention_mask' in tokens
+            for row, token_ids in enumerate(tokens['input_ids'], start):
+                ids[row, :len(token_ids)] = token_ids
+                lengths[row] = len(token_ids)
+
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix('.tmp')
+            with open(tmp, 'wb') as f:
+                np.savez(f, ids=ids, lengths=lengths, with_attention_mask=with_attention_mask)
+            os.replace(tmp, path)
+        return cls(ids, lengths, with_attention_mask)
+
+
+class ImageTextDataset(Dataset):
+    """
+    Base dataset yielding {'image': (S, S, 3) uint8} plus the caption as one of
+    'text' (str), 'input_ids'/'length' (pre-tokenized, see pretokenize()) or
+    'text_embeds' (frozen text-tower features, see use_text_features()).
+    Subclasses say where an item's image is and how to caption it.
+    """
+
+    def __init__(self, items: List, image_size: int, resized_cache: Optional[ResizedImageCache] = None):
+        self.items = items
+        self.image_size = image_size
+        # pre-resized images from image_cache.py skip JPEG decode + resize
+        self.resized_cache = resized_cache
+        self.tokens: Optional[CaptionTokens] = None
+        self.text_features: Optional[np.ndarray] = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def image_path(self, item) -> str:
+        raise NotImplementedError
+
+    def caption(self, item) -> str:
+        raise NotImplementedError
+
+    def captions(self) -> List[str]:
+        return [self.caption(item) for item in self.items]
+
+    def pretokenize(self, tokenizer, max_length: int = 77, cache_dir: Optional[str] = None) -> CaptionTokens:
+        self.tokens = CaptionTokens.build(tokenizer, self.captions(), max_length, cache_dir)
+        return self.tokens
+
+    def use_text_features(self, features: np.ndarray):
+        """(N, D) features aligned with items, used instead of running the text tower"""
+        self.text_features = features
+
+    def __getitem__(self, idx):
+        item = self.items[idx]
+        sample = {'image': load_image_array(self.image_path(item), self.image_size, self.resized_cache)}
+        if self.text_features is not None:
+            sample['text_embeds'] = self.text_features[idx]
+        elif self.tokens is not None:
+            sample['input_ids'] = self.tokens.ids[idx]
+            sample['length'] = self.tokens.lengths[idx]
+        else:
+            sample['text'] = self.caption(item)
+        return sample
+
+
+class BatchCollator:
+    """
+    Turn a list of samples into model inputs with one vectorized step per
+    field: pre-tokenized ids are stacked and sliced, raw captions are
+    tokenized in a single call, images are normalized as one array.
+    """
+
+    def __init__(self, processor, max_length: int = 77, padding="max_length", with_attention_mask: bool = False):
+        self.tokenizer = processor.tokenizer
+        self.image_mean = processor.image_processor.image_mean
+        self.image_std = processor.image_processor.image_std
+        # never past the text model's position embeddings (64 for SigLIP)
+        self.max_length = min(max_length, getattr(self.tokenizer, 'model_max_length', max_length))
+        # SigLIP was trained on max_length-padded text
+        self.padding = padding
+        # for pre-tokenized batches; CaptionTokens.with_attention_mask says whether the tokenizer makes one
+        self.with_attention_mask = with_attention_mask
+
+    def _text(self, samples: List[Dict]) -> Dict[str, torch.Tensor]:
+        if 'text_embeds' in samples[0]:
+            return {'text_embeds': torch.from_numpy(np.stack([s['text_embeds'] for s in samples]))}
+        if 'input_ids' in samples[0]:
+            ids = np.stack([s['input_ids'] for s in samples])
+            lengths = np.array([s['length'] for s in samples])
+            if self.padding != "max_length":
+                ids = ids[:, :max(int(lengths.max()), 1)]
+            batch = {'input_ids': torch.from_numpy(ids.astype(np.int64))}
+            if self.with_attention_mask:
+                mask = np.arange(ids.shape[1])[None, :] < lengths[:, None]
+                batch['attention_mask'] = torch.from_numpy(mask.astype(np.int64))
+            return batch
+        tokens = self.tokenizer(
+            [s['text'] for s in samples],
+            padding=self.padding,
+            truncation=True,
+            max_length=self.max_length,
+            return_tensors="pt",
+        )
+        batch = {'input_ids': tokens['input_ids']}
+        # Handle different tokenizer outputs (the SigLIP tokenizer has no attention mask)
+        if 'attention_mask' in tokens:
+            batch['attention_mask'] = tokens['attention_mask']
+        return batch
+
+    def __call__(self, samples: List[Dict]) -> Dict[str, torch.Tensor]:
+        batch = self._text(samples)
+        images = np.stack([s['image'] for s in samples])
+        batch['pixel_values'] = torch.from_numpy(pixel_values(images, self.image_mean, self.image_std))
+        return batch
+
+
+def pretokenize_captions(collator: BatchCollator, datasets: List[ImageTextDataset], cache_dir: Optional[str] = None):
+    """Tokenize every dataset's captions once, up front, with the collator's settings"""
+    start = time.perf_counter()
+    for dataset in datasets:
+        tokens = dataset.pretokenize(collator.tokenizer, collator.max_length, cache_dir)
+        collator.with_attention_mask = tokens.with_attention_mask
+    logger.info(f"Pre-tokenized {sum(len(d) for d in datasets)} captions in {time.perf_counter() - start:.2f}s")
+
+
+# ---------------------------------------------------------------- loaders
+
+def add_dataloader_args(parser: argparse.ArgumentParser):
+    group = parser.add_argument_group("input pipeline")
+    group.add_argument("--num_workers", type=int, default=DEFAULT_NUM_WORKERS,
+                       help="DataLoader worker processes decoding images (0 = main process)")
+    group.add_argument("--prefetch_factor", type=int, default=DEFAULT_PREFETCH_FACTOR,
+                       help="Batches each worker prepares ahead")
+    group.add_argument("--no_persistent_workers", dest="persistent_workers", action="store_false",
+                       help="Restart workers every epoch")
+    group.add_argument("--pin_memory", choices=["auto", "on", "off"], default="auto",
+                       help="Page-locked batches for faster host-to-GPU copies (auto: when CUDA is available)")
+    group.add_argument("--token_cache", default=None,
+                       help="Directory to keep pre-tokenized captions in (reused while captions are unchanged)")
+    group.add_argument("--benchmark_data", action="store_true",
+                       help="Only time the input pipeline (samples/sec) and exit")
+    group.add_argument("--benchmark_batches", type=int, default=50, help="Batches to time with --benchmark_data")
+
+
+def resolve_pin_memory(setting: str = "auto") -> bool:
+    if setting == "auto":
+        return torch.cuda.is_available()
+    return setting == "on"
+
+
+def loader_kwargs(num_workers: int = DEFAULT_NUM_WORKERS, prefetch_factor: int = DEFAULT_PREFETCH_FACTOR,
+                  persistent_workers: bool = True, pin_memory: str = "auto") -> Dict:
+    """DataLoader keyword arguments; worker-only options are dropped when num_workers is 0"""
+    kwargs = {'num_workers': num_workers, 'pin_memory': resolve_pin_memory(pin_memory)}
+    if num_workers > 0:
+        kwargs['prefetch_factor'] = prefetch_factor
+        kwargs['persistent_workers'] = persistent_workers
+    return kwargs
+
+
+def loader_kwargs_from_args(args) -> Dict:
+    return loader_kwargs(args.num_workers, args.prefetch_factor, args.persistent_workers, args.pin_memory)
+
+
+def trainer_dataloader_args(kwargs: Dict) -> Dict:
+    """loader_kwargs() as transformers.TrainingArguments fields"""
+    out = {
+        'dataloader_num_workers': kwargs['num_workers'],
+        'dataloader_pin_memory': kwargs['pin_memory'],
+    }
+    if kwargs['num_workers'] > 0:
+        out['dataloader_prefetch_factor'] = kwargs['prefetch_factor']
+        out['dataloader_persistent_workers'] = kwargs['persistent_workers']
+    return out
+
+
+def make_dataloader(dataset: Dataset, collate_fn, batch_size: int, shuffle: bool = False, **kwargs) -> DataLoader:
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=collate_fn, **kwargs)
+
+
+def benchmark_dataloader(loader: DataLoader, max_batches: int = 50) -> Dict:
+    """
+    Iterate the loader without a model and report input throughput.
+    The first batch (worker startup + prefetch fill) is timed separately.
+    """
+    start = time.perf_counter()
+    iterator = iter(loader)
+    first = next(iterator, None)
+    first_batch_seconds = time.perf_counter() - start
+    if first is None:
+        return {'batches': 0, 'samples': 0, 'samples_per_sec': 0.0, 'first_batch_seconds': first_batch_seconds}
+
+    batches = samples = 0
+    start = time.perf_counter()
+    for batch in iterator:
+        samples += batch['pixel_values'].shape[0]
+        batches += 1
+        if batches >= max_batches:
+            break
+    elapsed = time.perf_counter() - start
+    return {
+        'batches': batches,
+        'samples': samples,
+        'seconds': round(elapsed, 3),
+        'samples_per_sec': round(samples / elapsed, 1) if elapsed > 0 else 0.0,
+        'first_batch_seconds': round(first_batch_seconds, 3),
+        'num_workers': loader.num_workers,
+        'pin_memory': loader.pin_memory,
+    }
+
+
+def log_benchmark(result: Dict):
+    logger.info(
+        f"Input pipeline: {result['samples_per_sec']} samples/sec over {result['batches']} batches "
+        f"(first batch {result['first_batch_seconds']}s, workers={result.get('num_workers')}, "
+        f"pin_memory={result.get('pin_memory')})"
+    )
+
+
+def image_caption_from_path(image_path: str) -> str:
+    """'downloaded_images/Nike/Air Max 90_secondary_2.jpg' -> 'Nike Air Max 90'"""
+    brand = Path(image_path).parent.name
+    filename = Path(image_path).stem
+    # Extract product info from filename
+    if '_main' in filename:
+        filename = filename.replace('_main', '')
+    if '_secondary' in filename:
+        filename = filename.split('_secondary')[0]
+    return f"{brand} {filename}"
+
+
+# ---------------------------------------------------------------- held-out products
+
+def in_holdout(pid: str, fraction: float = DEFAULT_HOLDOUT) -> bool:
+    """Whether a product (catalog_snapshot.product_id) is reserved for retrieval evaluation"""
+    return int(pid[:8], 16) % 10000 < fraction * 10000
+
+
+def locate_image(product: Product, url: str, image_type: str, images_dir: str = "downloaded_images",
+                 store: Optional[ImageStore] = None) -> Optional[str]:
+    """Local file for one of a product's images: the image store first, then download_all_images.py's layout"""
+    if store is not None:
+        sha = store.hash_for_url(url)
+        path = store.path_for_hash(sha) if sha else None
+        if path is not None:
+            return str(path)
+    path = downloaded_image_path(images_dir, product.brand, product.name, url, image_type)
+    return str(path) if path is not None else None
+
+
+def holdout_image_paths(fraction: float = DEFAULT_HOLDOUT, dirs: Sequence[str] = DEFAULT_DIRS,
+                        images_dir: str = "downloaded_images", store: Optional[ImageStore] = None) -> Set[str]:
+    """Real paths of every downloaded image (main and secondary) of a held-out product"""
+    paths = set()
+    if fraction <= 0:
+        return paths
+    for product in iter_products(dirs):
+        if not in_holdout(product_id(product), fraction):
+            continue
+        for url, image_type in product.image_urls():
+            path = locate_image(product, url, image_type, images_dir, store)
+            if path is not None:
+                paths.add(os.path.realpath(path))
+    return paths
+
+
+def drop_holdout_paths(image_paths: List[str], fraction: float = DEFAULT_HOLDOUT, **kwargs) -> List[str]:
+    """image_paths without the images of held-out products"""
+    held_out = holdout_image_paths(fraction, **kwargs)
+    kept = [p for p in image_paths if os.path.realpath(p) not in held_out]
+    logger.info(f"Held out {len(image_paths) - len(kept)} images of evaluation products (holdout={fraction})")
+    return kept
+
+
+def add_holdout_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--holdout", type=float, default=DEFAULT_HOLDOUT,
+                        help="Fraction of products (by id hash) kept out of training for evaluate_retrieval.py "
+                             "(use the same value there)")
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Training Memory / Speed Controls
+
+Shared by the train_siglip_*.py scripts to fit larger models (so400m) on
+the same hardware:
+
+  - autocast(): bf16 autocast on CPU or GPU (--precision bf16); losses are
+    still computed in fp32
+  - enable_gradient_checkpointing(): recompute a tower's activations in
+    the backward pass instead of keeping them (--gradient_checkpointing)
+  - find_batch_size(): probe full training steps on synthetic batches and
+    return the largest batch whose peak memory fits a budget
+    (--memory_budget_gb)
+  - profile_configs(): peak memory and samples/sec for each
+    precision x checkpointing combination (--profile_training)
+
+Peak memory is the process high-water mark (VmHWM), reset between probes
+through /proc/self/clear_refs, or the CUDA allocator's peak on GPU.
+"""
+
+import gc
+import time
+import ctypes
+import resource
+import logging
+import argparse
+import contextlib
+import functools
+from typing import Callable, Dict, List, Optional
+
+import torch
+import torch.utils.checkpoint
+
+logger = logging.getLogger(__name__)
+
+PRECISIONS = ("fp32", "bf16")
+
+
+def add_perf_args(parser: argparse.ArgumentParser, search: bool = True):
+    """--precision / --gradient_checkpointing, plus the batch size search and profiling flags if search"""
+    group = parser.add_argument_group("memory / speed")
+    group.add_argument("--precision", choices=PRECISIONS, default="fp32",
+                       help="bf16 runs forward/backward under bfloat16 autocast (CPU or GPU)")
+    group.add_argument("--gradient_checkpointing", action="store_true",
+                       help="Recompute vision tower activations in backward instead of storing them")
+    if not search:
+        return
+    group.add_argument("--memory_budget_gb", type=float, default=None,
+                       help="Pick the largest batch size whose training step fits in this much memory")
+    group.add_argument("--max_batch_size", type=int, default=256, help="Upper bound for the batch size search")
+    group.add_argument("--profile_training", action="store_true",
+                       help="Report peak memory and samples/sec per precision/checkpointing setting and exit")
+
+
+def autocast(precision: str, device) -> contextlib.AbstractContextManager:
+    if precision == "bf16":
+        return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def enable_gradient_checkpointing(module: torch.nn.Module, enabled: bool = True) -> int:
+    """
+    Turn activation checkpointing on/off for every layer in module that
+    supports it (e.g. model.vision_model only). Returns the number of layers.
+    """
+    checkpoint = functools.partial(torch.utils.checkpoint.checkpoint, use_reentrant=False)
+    count = 0
+    for sub in module.modules():
+        if hasattr(sub, 'gradient_checkpointing'):
+            sub.gradient_checkpointing = enabled
+            sub._gradient_checkpointing_func = checkpoint
+            count += 1
+    return count
+
+
+# ---------------------------------------------------------------- memory
+
+def _read_hwm_mb() -> Optional[float]:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_memory(device=None):
+    gc.collect()
+    if device is not None and torch.device(device).type == 'cuda':
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+        return
+    try:
+        # hand freed heap back to the OS so the reset starts from live memory only
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+    try:
+        # "5" resets the peak RSS (VmHWM) to the current RSS
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_memory_mb(device=None) -> float:
+    if device is not None and torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    hwm = _read_hwm_mb()
+    if hwm is not None:
+        return hwm
+    # ru_maxrss can't be reset, so it only bounds the peak from above
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# ---------------------------------------------------------------- probing
+
+def synthetic_batch(batch_size: int, image_size: int, seq_len: int = 64, vocab_size: int = 32000,
+                    text_dim: Optional[int] = None) -> Dict:
+    """A collated batch of the given size; with text_dim, cached text features replace token ids"""
+    batch = {'pixel_values': torch.randn(batch_size, 3, image_size, image_size)}
+    if text_dim:
+        batch['text_embeds'] = torch.randn(batch_size, text_dim)
+    else:
+        batch['input_ids'] = torch.randint(0, vocab_size, (batch_size, seq_len))
+    return batch
+
+
+def measure_step(step: Callable[[Dict], None], batch_size: int, make_batch: Callable[[int], Dict],
+                 device=None, iters: int = 2) -> Dict:
+    """
+    Run `iters` training steps on a synthetic batch after one warmup step;
+    returns peak memory and samples/sec
+    """
+    batch = make_batch(batch_size)
+    reset_peak_memory(device)
+    step(batch)
+    start = time.perf_counter()
+    for _ in range(iters):
+        step(batch)
+    if device is not None and torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+    elapsed = time.perf_counter() - start
+    result = {
+        'batch_size': batch_size,
+        'peak_memory_mb': round(peak_memory_mb(device), 1),
+        'samples_per_sec': round(batch_size * iters / elapsed, 2) if elapsed > 0 else 0.0,
+    }
+    del batch
+    return result
+
+
+def find_batch_size(step: Callable[[Dict], None], make_batch: Callable[[int], Dict], budget_mb: float,
+                    device=None, start: int = 2, max_batch_size: int = 256) -> Dict:
+    """
+    Largest batch size whose training step peaks under budget_mb: double until
+    the budget is exceeded (or an allocation fails), then bisect.
+    """
+    probes: List[Dict] = []
+
+    def fits(batch_size: int) -> bool:
+        try:
+            result = measure_step(step, batch_size, make_batch, device, iters=1)
+        except RuntimeError as e:  # CUDA OOM / allocator failure
+            logger.info(f"batch_size={batch_size}: {e.__class__.__name__}")
+            probes.append({'batch_size': batch_size, 'error': str(e)[:200]})
+            gc.collect()
+            return False
+        probes.append(result)
+        logger.info(f"batch_size={batch_size}: peak {result['peak_memory_mb']:.0f}MB, "
+                    f"{result['samples_per_sec']} samples/sec")
+        return result['peak_memory_mb'] <= budget_mb
+
+    if not fits(start):
+        return {'batch_size': None, 'budget_mb': budget_mb, 'probes': probes}
+    good, bad = start, None
+    while good < max_batch_size:
+        candidate = min(good * 2, max_batch_size)
+        if fits(candidate):
+            good = candidate
+        else:
+            bad = candidate
+            break
+    while bad is not None and bad - good > 1:
+        mid = (good + bad) // 2
+        if fits(mid):
+            good = mid
+        else:
+            bad = mid
+    return {'batch_size': good, 'budget_mb': budget_mb, 'probes': probes}
+
+
+def profile_configs(make_step: Callable[[str, bool], Callable[[Dict], None]], make_batch: Callable[[int], Dict],
+                    batch_size: int, device=None) -> List[Dict]:
+    """
+    Peak memory and samples/sec for every precision x gradient checkpointing
+    setting at one batch size. make_step(precision, checkpointing) builds the
+    training step for that setting.
+    """
+    results = []
+    for precision in PRECISIONS:
+        for checkpointing in (False, True):
+            step = make_step(precision, checkpointing)
+            try:
+                result = measure_step(step, batch_size, make_batch, device)
+            except RuntimeError as e:
+                result = {'batch_size': batch_size, 'error': str(e)[:200]}
+            result.update({'precision': precision, 'gradient_checkpointing': checkpointing})
+            logger.info(f"{precision:>4} checkpointing={checkpointing!s:5}: "
+                        f"peak {result.get('peak_memory_mb', '-')}MB, {result.get('samples_per_sec', '-')} samples/sec")
+            results.append(result)
+    return results